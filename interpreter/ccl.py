@@ -0,0 +1,148 @@
+"""
+Embedding API: compile a program once and run it any number of times, each run with its own state.
+
+    import ccl
+    program = ccl.compile('>a <a')
+    result = program.run(input=b'x')
+    result.output, result.exit_code, result.stats
+
+    # In a coroutine, with input and output on asyncio streams:
+    result = await program.run_async(reader, writer)
+
+Compiled programs are never changed by running them, so one Program can be shared between threads and runs.
+"""
+from __future__ import annotations
+import io
+import time
+from copy import copy
+from dataclasses import dataclass, field
+from typing import Callable
+from ccl_exceptions import CCLExit, CCLRuntimeError
+from ccl_internals import MainProcedure, Instruction, Variables
+from ccl_source import SourceCode, SourceMap
+from ccl_parser import Parser
+from ccl_optimizer import Optimizer
+from ccl_closures import ClosureEngine
+from ccl_transpiler import Transpiler, PythonProgram
+from ccl_bytecode import Lowering, VirtualMachine
+from ccl_async import AsyncRunner, AsyncWriter, DEFAULT_QUANTUM
+from ccl_streams import AsyncReader
+
+
+def run_default(main: MainProcedure, source_filepath: str):
+    try:
+        main.run()
+    except CCLExit:
+        pass
+
+
+def run_closures(main: MainProcedure, source_filepath: str):
+    ClosureEngine(main).run()
+
+
+def run_python(main: MainProcedure, source_filepath: str):
+    PythonProgram.from_source(main, Transpiler(main, source_filepath).transpile(), source_filepath).run()
+
+
+def run_bytecode(main: MainProcedure, source_filepath: str):
+    VirtualMachine(Lowering(main).lower(), main).run()
+
+
+ENGINES: dict[str, Callable[[MainProcedure, str], None]] = {
+    'default': run_default,
+    'closures': run_closures,
+    'python': run_python,
+    'bytecode': run_bytecode,
+}
+
+
+@dataclass(frozen=True)
+class Result:
+    """
+    Result of one run: whole output of the program and its exit code (0, or 1 if it failed with 'error').
+    'stats' holds the engine and the time of the run in seconds
+    """
+    output: str
+    exit_code: int
+    stats: dict[str, object] = field(default_factory=dict)
+    error: CCLRuntimeError | None = None
+
+
+@dataclass(frozen=True)
+class Program:
+    """
+    Parsed and resolved program. Its instructions are templates, which are never run themselves:
+    every run() copies the top-level instructions into a fresh MainProcedure
+    (instructions of procedures are copied when a procedure is defined anyway), and gets new stack,
+    variables, loop counters and streams. Slots assigned by Resolver are copied along, so programs are not resolved again.
+    Programs can be pickled, e.g. to be sent to worker processes.
+    """
+    name: str
+    instruction_stack: tuple[Instruction, ...]
+    source_map: SourceMap
+    global_names: tuple[str, ...]
+    loop_depth: int
+
+    @classmethod
+    def from_main(cls, main: MainProcedure, name: str) -> Program:
+        """Takes the program of a parsed MainProcedure, which must not be run afterwards"""
+        return cls(name, tuple(main.instruction_stack), main.source_map, tuple(main.global_variables.names), len(main.loop_counters))
+
+    def instantiate(self) -> MainProcedure:
+        """Returns a fresh MainProcedure, which is ready to run the program"""
+        main = MainProcedure()
+        main.source_map = self.source_map
+        main.global_variables = Variables(list(self.global_names))
+        main.loop_counters = [0] * self.loop_depth
+        instruction_stack = main.instruction_stack
+        for instruction in self.instruction_stack:
+            instruction = copy(instruction)
+            instruction.namespace = main
+            instruction_stack.append(instruction)
+        return main
+
+    def run(self, input: bytes | str = b'', engine: str = 'default') -> Result:
+        """Runs the program with the given input (decoded as UTF-8 if it is bytes), on one of ENGINES"""
+        start = time.perf_counter()
+        output = io.StringIO()
+        main = self.instantiate()
+        main.stream_stdout(output)
+        main.stream_stdin(io.StringIO(input.decode('utf-8', errors='replace') if isinstance(input, bytes) else input))
+        exit_code, error = 0, None
+        try:
+            ENGINES[engine](main, self.name)
+        except CCLRuntimeError as Error:
+            exit_code, error = 1, Error
+        finally:
+            main.flush_stdout()
+        return Result(output.getvalue(), exit_code, {'engine': engine, 'time': time.perf_counter() - start}, error)
+
+    async def run_async(self, reader: AsyncReader, writer: AsyncWriter, quantum: int = DEFAULT_QUANTUM) -> Result:
+        """
+        Runs the program on the default engine with AsyncRunner: input is read from 'reader' and output is written to 'writer'
+        (e.g. asyncio.StreamReader and StreamWriter) as the program runs, so the output of the result is empty
+        """
+        start = time.perf_counter()
+        exit_code, error = 0, None
+        try:
+            await AsyncRunner(self.instantiate(), reader, writer, quantum).run()
+        except CCLRuntimeError as Error:
+            exit_code, error = 1, Error
+        return Result('', exit_code, {'engine': 'default', 'time': time.perf_counter() - start}, error)
+
+
+def compile(source: str, name: str = '<string>', optimize: bool = False) -> Program:
+    """Compiles the source code of a program; raises CCLParseError if it is not valid"""
+    return compile_parser(Parser(name, SourceCode.from_text(source)), optimize)
+
+
+def compile_file(source_filepath: str, optimize: bool = False) -> Program:
+    """Compiles the program in a source file; raises CCLParseError if it is not valid"""
+    return compile_parser(Parser(source_filepath), optimize)
+
+
+def compile_parser(parser: Parser, optimize: bool) -> Program:
+    main = parser.parse()
+    if optimize:
+        Optimizer(main).optimize()
+    return Program.from_main(main, parser.source_filepath)
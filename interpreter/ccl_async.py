@@ -0,0 +1,72 @@
+from __future__ import annotations
+import asyncio
+import io
+from typing import Awaitable, Protocol
+from ccl_exceptions import CCLExit
+from ccl_internals import MainProcedure, StdIn
+from ccl_streams import AsyncReader, AsyncStreamInput
+
+# Instructions run between two yields to the event loop
+DEFAULT_QUANTUM = 10000
+
+
+class AsyncWriter(Protocol):
+    """Output of AsyncRunner, e.g. asyncio.StreamWriter"""
+    def write(self, data: bytes) -> object: ...
+
+    def drain(self) -> Awaitable[None]: ...
+
+
+class AsyncRunner:
+    """
+    Runs a program of the default engine in an asyncio event loop, with input and output on asynchronous streams.
+    Instructions run in quanta: after every 'quantum' instructions, and whenever '>' would wait for input,
+    the output is written to the writer and the runner yields to the event loop,
+    so one process can run many programs (e.g. interactive sessions over the network) at once.
+    """
+    def __init__(self, main: MainProcedure, reader: AsyncReader, writer: AsyncWriter, quantum: int = DEFAULT_QUANTUM):
+        self.main = main
+        self.writer = writer
+        self.quantum = quantum
+        self.output = io.StringIO()
+        self.stdin = AsyncStreamInput(reader)
+        main.stream_stdout(self.output)
+        main.stdin = self.stdin
+
+    async def run(self):
+        """Runs the program until it exits (CCLExit is raised) or fails"""
+        try:
+            while True:
+                waiting = self.run_quantum()
+                await self.write_output()
+                if waiting:
+                    await self.stdin.fill()
+                else:
+                    await asyncio.sleep(0)
+        except CCLExit:
+            pass
+        finally:
+            await self.write_output()
+
+    def run_quantum(self) -> bool:
+        """Runs up to 'quantum' instructions; returns True if it stopped early, before '>' which needs input that has not arrived yet"""
+        main = self.main
+        call_stack = main.call_stack
+        stdin = self.stdin
+        for _ in range(self.quantum):
+            procedure = call_stack[-1] if call_stack else main
+            instruction = procedure.instruction_stack[procedure.instruction_pointer]
+            if type(instruction) is StdIn and stdin.needs_input():
+                return True
+            instruction.execute()
+        return False
+
+    async def write_output(self):
+        self.main.flush_stdout()
+        text = self.output.getvalue()
+        if not text:
+            return
+        self.output.seek(0)
+        self.output.truncate()
+        self.writer.write(text.encode('utf-8'))
+        await self.writer.drain()
@@ -0,0 +1,128 @@
+from __future__ import annotations
+import json
+import os
+import sys
+import traceback as python_traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, TextIO
+from ccl_exceptions import CCLParseError, CCLRuntimeError
+from ccl_internals import MainProcedure
+from ccl_parser import Parser
+from ccl import Program
+
+# Jobs sent to a worker at once; larger chunks mean less inter-process traffic, smaller ones mean earlier results
+MAX_CHUNK_SIZE = 16
+
+# Compiled programs of the batch, set once per worker process by load_programs()
+programs: dict[str, Program] = dict()
+engine_name: str = 'default'
+
+
+def error_info(Error: Exception) -> dict:
+    """Returns JSON description of an error; errors of the program carry their position in the source code"""
+    info = {'type': Error.__class__.__name__, 'message': str(Error)}
+    if isinstance(Error, (CCLParseError, CCLRuntimeError)):
+        info['line'] = Error.traceback.position[0]
+        info['symbol'] = Error.traceback.position[1]
+        info['source'] = Error.traceback.line
+    else:
+        info['traceback'] = ''.join(python_traceback.format_exception(Error))
+    return info
+
+
+def load_programs(compiled_programs: dict[str, Program], engine: str):
+    """Initializer of worker processes"""
+    global engine_name
+    programs.update(compiled_programs)
+    engine_name = engine
+
+
+def run_job(job: dict) -> dict:
+    """Runs one job in a worker process, with a fresh state of the program, and returns its result"""
+    try:
+        result = programs[job['program']].run(job['input'], engine_name)
+    except Exception as Error:
+        return {'id': job['id'], 'program': job['program'], 'exit_code': 1,
+                'output': '', 'error': error_info(Error), 'time': 0.0}
+    return {'id': job['id'], 'program': job['program'], 'exit_code': result.exit_code, 'output': result.output,
+            'error': None if result.error is None else error_info(result.error), 'time': result.stats['time']}
+
+
+def read_jobs(file: TextIO) -> Iterator[dict]:
+    """
+    Yields jobs of a JSON lines file: {"program": "<path>", "input": "<text>", "id": <any>}.
+    Only "program" is required; "id" defaults to the line number. Invalid lines are yielded with an "error".
+    """
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            if not isinstance(job, dict) or not isinstance(job.get('program'), str):
+                raise ValueError("job must be an object with a string 'program'")
+            if not isinstance(job.get('input', ''), str):
+                raise ValueError("'input' of a job must be a string")
+        except ValueError as Error:
+            yield {'id': line_number, 'program': None, 'input': '', 'error': error_info(Error)}
+            continue
+        yield {'id': job.get('id', line_number), 'program': job['program'], 'input': job.get('input', '')}
+
+
+class BatchRunner:
+    """
+    Runs every job of a batch over a pool of worker processes.
+    Each distinct program is parsed once, in this process, and sent to every worker as a compiled Program;
+    workers run each job on a fresh state of the program with the job's input.
+    Results are written as JSON lines as soon as they are ready, in the order of the jobs.
+    """
+    def __init__(self, parse: Callable[[Parser], MainProcedure], engine: str = 'default', workers: int | None = None):
+        self.parse = parse
+        self.engine = engine
+        self.workers = workers or os.cpu_count() or 1
+
+    def compile(self, jobs: list[dict]) -> tuple[dict[str, Program], dict[str, dict]]:
+        """Returns (compiled programs, parse errors) for every distinct program of the batch"""
+        compiled_programs = dict()
+        errors = dict()
+        for job in jobs:
+            filepath = job['program']
+            if filepath is None or filepath in compiled_programs or filepath in errors:
+                continue
+            try:
+                compiled_programs[filepath] = Program.from_main(self.parse(Parser(filepath)), filepath)
+            except (CCLParseError, OSError, UnicodeDecodeError) as Error:
+                errors[filepath] = error_info(Error)
+        return compiled_programs, errors
+
+    def run(self, jobs_file: TextIO, results_file: TextIO = sys.stdout) -> bool:
+        """Returns True if every job finished with exit code 0"""
+        jobs = list(read_jobs(jobs_file))
+        compiled_programs, errors = self.compile(jobs)
+        for job in jobs:
+            job['error'] = job.get('error') or errors.get(job['program'])
+        runnable = [job for job in jobs if job['error'] is None]
+        if not runnable:
+            return self.write_results(results_file, jobs, iter(()))
+
+        chunk_size = max(1, min(MAX_CHUNK_SIZE, len(runnable) // (self.workers * 4)))
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=load_programs,
+                                 initargs=(compiled_programs, self.engine)) as executor:
+            return self.write_results(results_file, jobs, executor.map(run_job, runnable, chunksize=chunk_size))
+
+    def write_results(self, results_file: TextIO, jobs: list[dict], results: Iterator[dict]) -> bool:
+        """Writes results in the order of the jobs: jobs that failed before running take their place among 'results' of the runnable jobs"""
+        success = True
+        for job in jobs:
+            if job['error'] is None:
+                result = next(results)
+            else:
+                result = {'id': job['id'], 'program': job['program'], 'exit_code': 1,
+                          'output': '', 'error': job['error'], 'time': 0.0}
+            success = success and result['exit_code'] == 0
+            self.write(results_file, result)
+        return success
+
+    @staticmethod
+    def write(results_file: TextIO, result: dict):
+        results_file.write(json.dumps(result) + '\n')
+        results_file.flush()
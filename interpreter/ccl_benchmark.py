@@ -0,0 +1,286 @@
+"""
+Benchmark suite over the sample programs.
+
+USAGE: python ccl_benchmark.py [names...] [-parser] [-engine <name>] [-O] [-repeat <n>] [-save <path>] [-compare <path>] [-threshold <percent>]
+
+Every program is parsed and run non-interactively with a fixed input; the best time of all repeats is reported.
+Instructions are counted on the default engine, so instructions/second of every engine are comparable.
+With '-parser', large generated sources are only parsed.
+"""
+from __future__ import annotations
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import string
+from pathlib import Path
+from typing import Callable
+from ccl_exceptions import CCLExit
+from ccl_internals import MainProcedure, Instruction, TraceEvent
+from ccl_parser import Parser
+from ccl_optimizer import Optimizer
+from ccl_cache import interpreter_version
+from ccl import ENGINES
+
+PROGRAMS_DIRECTORY = Path(__file__).resolve().parent.parent / 'programs'
+# Name: (path relative to PROGRAMS_DIRECTORY, input)
+BENCHMARKS: dict[str, tuple[str, str]] = {
+    '99_bottles': ('with_comments/99_bottles.ccl', ''),
+    'fizzbuzz': ('with_comments/fizzbuzz.ccl', ''),
+    'rule110': ('rule110.ccl', ''),
+    'fibs': ('fibs.ccl', ''),
+    'add': ('add.ccl', '7\n5\n'),
+    'sequence_sum': ('with_comments/sequence_sum.ccl', ''),
+    '32767': ('with_comments/32767.ccl', ''),
+}
+
+
+def nested_blocks(depth: int) -> str:
+    """REPEAT, WHILE and compare blocks nested 'depth' times"""
+    opening = '^ + = n n[ ( ?n # ; $n - = n\n' * depth
+    closing = ')]\n' * depth
+    return opening + closing
+
+
+def procedures(count: int) -> str:
+    """'count' procedure definitions, names are reused"""
+    return ''.join(f'{string.ascii_letters[index % 52]} {{ &a $a + = a ?a # ; @g }}\n' for index in range(count))
+
+
+def nested_procedures(depth: int) -> str:
+    return 'p{ ^ + \n' * depth + '}\n' * depth
+
+
+def long_program(lines: int) -> str:
+    return '^ +++ = x $x $x * <x    / comment\n' * lines
+
+
+# Name: (generator of the source code, its argument)
+PARSER_BENCHMARKS: dict[str, tuple[Callable[[int], str], int]] = {
+    'nested_blocks': (nested_blocks, 500),
+    'procedures': (procedures, 5000),
+    'nested_procedures': (nested_procedures, 200),
+    'long_program': (long_program, 20000),
+}
+DEFAULT_REPEAT = 3
+# Relative slowdown, after which a measurement is reported as a regression
+DEFAULT_THRESHOLD = 0.10
+# Slowdowns smaller than this (in seconds) are timer noise and never reported as regressions
+MIN_REGRESSION_TIME = 0.005
+MEASUREMENTS = ('parse_time', 'exec_time')
+
+
+def parse(filepath: str, optimize: bool) -> MainProcedure:
+    main = Parser(filepath).parse()
+    if optimize:
+        Optimizer(main).optimize()
+    return main
+
+
+def prepare(main: MainProcedure, input_text: str) -> io.StringIO:
+    """Streams input and output of the program from and into memory; returns the output"""
+    output = io.StringIO()
+    main.stream_stdout(output)
+    main.stream_stdin(io.StringIO(input_text))
+    return output
+
+
+def count_instructions(filepath: str, input_text: str, optimize: bool) -> int:
+    main = parse(filepath, optimize)
+    prepare(main, input_text)
+    instructions = 0
+
+    def count(event: TraceEvent, instruction: Instruction, argument: object):
+        nonlocal instructions
+        if event is TraceEvent.INSTRUCTION:
+            instructions += 1
+
+    main.settrace(count)
+    try:
+        main.run()
+    except CCLExit:
+        return instructions
+
+
+def run_benchmark(filepath: str, input_text: str, engine: str, optimize: bool, repeat: int) -> dict:
+    parse_times = list()
+    exec_times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        main = parse(filepath, optimize)
+        parse_times.append(time.perf_counter() - start)
+
+        output = prepare(main, input_text)
+        start = time.perf_counter()
+        ENGINES[engine](main, filepath)
+        main.flush_stdout()
+        exec_times.append(time.perf_counter() - start)
+
+    instructions = count_instructions(filepath, input_text, optimize)
+    return {
+        'parse_time': min(parse_times),
+        'exec_time': min(exec_times),
+        'instructions': instructions,
+        'ips': instructions / min(exec_times),
+        'output_sha256': hashlib.sha256(output.getvalue().encode('utf-8')).hexdigest(),
+    }
+
+
+def run_suite(names: list[str], engine: str, optimize: bool, repeat: int) -> dict:
+    results = {
+        'engine': engine,
+        'optimize': optimize,
+        'repeat': repeat,
+        'python': sys.version,
+        'interpreter': interpreter_version(),
+        'benchmarks': dict(),
+    }
+    print(f"{'PROGRAM':<14}{'PARSE (s)':>12}{'EXEC (s)':>12}{'INSTRUCTIONS':>16}{'INSTR/S':>14}")
+    for name in names:
+        relative_path, input_text = BENCHMARKS[name]
+        result = run_benchmark(str(PROGRAMS_DIRECTORY / relative_path), input_text, engine, optimize, repeat)
+        results['benchmarks'][name] = result
+        print(f"{name:<14}{result['parse_time']:>12.4f}{result['exec_time']:>12.4f}"
+              f"{result['instructions']:>16,}{result['ips']:>14,.0f}")
+    return results
+
+
+def run_parser_suite(names: list[str], repeat: int) -> dict:
+    results = {
+        'engine': 'parser',
+        'optimize': False,
+        'repeat': repeat,
+        'python': sys.version,
+        'interpreter': interpreter_version(),
+        'benchmarks': dict(),
+    }
+    print(f"{'SOURCE':<20}{'SYMBOLS':>12}{'PARSE (s)':>12}{'SYMBOLS/S':>14}")
+    for name in names:
+        generate, argument = PARSER_BENCHMARKS[name]
+        source = generate(argument)
+        descriptor, filepath = tempfile.mkstemp(suffix='.ccl')
+        try:
+            with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+                file.write(source)
+            parse_times = list()
+            for _ in range(repeat):
+                start = time.perf_counter()
+                Parser(filepath).parse()
+                parse_times.append(time.perf_counter() - start)
+        finally:
+            os.remove(filepath)
+        result = {'parse_time': min(parse_times), 'symbols': len(source)}
+        results['benchmarks'][name] = result
+        print(f"{name:<20}{result['symbols']:>12,}{result['parse_time']:>12.4f}{result['symbols'] / result['parse_time']:>14,.0f}")
+    return results
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list[str]:
+    """Prints relative change of every measurement and returns the regressions, which are slower by more than 'threshold'"""
+    regressions = list()
+    print()
+    print(f"Compared to: engine '{baseline['engine']}'{' with -O' if baseline['optimize'] else ''}")
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        old_result = baseline['benchmarks'][name]
+        changes = list()
+        for measurement in [measurement for measurement in MEASUREMENTS if measurement in result and measurement in old_result]:
+            change = result[measurement] / old_result[measurement] - 1 if old_result[measurement] else 0.0
+            flag = ''
+            if change > threshold and result[measurement] - old_result[measurement] > MIN_REGRESSION_TIME:
+                flag = ' REGRESSION'
+                regressions.append(f'{name} {measurement}')
+            changes.append(f'{measurement} {change:+.1%}{flag}')
+        if result.get('output_sha256') != old_result.get('output_sha256'):
+            changes.append('OUTPUT DIFFERS')
+            regressions.append(f'{name} output')
+        print(f"{name:<14}" + ', '.join(changes))
+    return regressions
+
+
+def print_usage():
+    print(__doc__.strip().splitlines()[2])
+    print('ARGUMENTS:')
+    print(f"    names...               Programs to run (default: all): {', '.join(BENCHMARKS)}")
+    print(f"                           or sources to parse with '-parser': {', '.join(PARSER_BENCHMARKS)}")
+    print('    -parser                Only parse large generated sources')
+    print('    -engine <name>         Run programs with the given engine: ' + ', '.join(ENGINES))
+    print('    -O                     Optimize programs before running them')
+    print(f'    -repeat <n>            Run every program n times and report the best time (default: {DEFAULT_REPEAT})')
+    print('    -save <path>           Save results as JSON')
+    print('    -compare <path>        Compare results with the JSON of an earlier run, exit with code 1 on regressions')
+    print(f'    -threshold <percent>   Slowdown reported as a regression (default: {DEFAULT_THRESHOLD:.0%})')
+    print()
+
+
+def usage_error(message: str):
+    print_usage()
+    print(f'ERROR: {message}')
+    print()
+    sys.exit(1)
+
+
+def benchmark():
+    names = list()
+    options = {'-engine': 'default', '-repeat': str(DEFAULT_REPEAT), '-save': None, '-compare': None,
+               '-threshold': str(DEFAULT_THRESHOLD * 100)}
+    optimize = False
+    parser_suite = False
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == '-O':
+            optimize = True
+        elif arg == '-parser':
+            parser_suite = True
+        elif arg in options:
+            value = next(args, None)
+            if value is None:
+                usage_error(f"argument '{arg}' requires a value")
+            options[arg] = value
+        elif not arg.startswith('-'):
+            names.append(arg)
+        else:
+            usage_error(f"unknown argument '{arg}'")
+
+    for name in names:
+        if name not in (PARSER_BENCHMARKS if parser_suite else BENCHMARKS):
+            usage_error(f"unknown {'source' if parser_suite else 'program'} '{name}'")
+
+    if options['-engine'] not in ENGINES:
+        usage_error(f"unknown value '{options['-engine']}' for argument '-engine'")
+    if not options['-repeat'].isdigit() or int(options['-repeat']) == 0:
+        usage_error(f"value of argument '-repeat' must be a positive integer, not '{options['-repeat']}'")
+    try:
+        threshold = float(options['-threshold']) / 100
+    except ValueError:
+        usage_error(f"value of argument '-threshold' must be a number, not '{options['-threshold']}'")
+
+    baseline = None
+    if options['-compare'] is not None:
+        try:
+            with open(options['-compare'], 'r', encoding='utf-8') as file:
+                baseline = json.load(file)
+        except (OSError, ValueError) as Error:
+            usage_error(f"cannot read results file '{options['-compare']}': {Error}")
+
+    if parser_suite:
+        results = run_parser_suite(names or list(PARSER_BENCHMARKS), int(options['-repeat']))
+    else:
+        results = run_suite(names or list(BENCHMARKS), options['-engine'], optimize, int(options['-repeat']))
+    if options['-save'] is not None:
+        with open(options['-save'], 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    if baseline is not None:
+        regressions = compare(baseline, results, threshold)
+        if regressions:
+            print()
+            print(f"Regressions beyond {threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,534 @@
+from __future__ import annotations
+from array import array
+from bisect import bisect_right
+from collections import deque
+from ccl_exceptions import CCLRuntimeError, CCLTraceback
+from ccl_source import SourceMap
+from ccl_internals import (CELL_MIN, CELL_MAX, OUTPUT_CHARS,
+                           Context, MainProcedure, Instruction,
+                           DefineProcedure, CallProcedure, EndProcedure,
+                           Add, Subtract, PopAdd, PopSubtract, Reverse,
+                           PushZero, Assign, CreateLocal, Delete, PushVariable,
+                           PushConstant, AddConstant, AddVariable, SubtractVariable,
+                           MultiplyAdd, RepeatPush, SetToVariable,
+                           StdOut, StdIn,
+                           StartCompare, EndCompare,
+                           StartRepeat, EndRepeat, StartWhile, EndWhile,
+                           ExitBlock, ContinueBlock)
+
+# Opcodes. Operands follow the opcode in the code array; amount of operands is fixed for each opcode.
+(PUSH_ZERO, ADD, SUBTRACT, POP_ADD, POP_SUBTRACT, REVERSE_ALL, REVERSE,
+ ASSIGN, POP, CREATE_LOCAL, DELETE, PUSH_VARIABLE, STDOUT, STDIN, FLUSH, RAISE,
+ COMPARE, START_REPEAT, END_REPEAT, EXIT_REPEAT, JUMP,
+ DEFINE, CALL, TAIL_CALL, RETURN, HALT,
+ PUSH_CONSTANT, ADD_CONSTANT, ADD_VARIABLE, SUBTRACT_VARIABLE,
+ MULTIPLY_ADD, REPEAT_PUSH, SET_TO_VARIABLE) = range(33)
+
+OPERAND_COUNT = {
+    PUSH_ZERO: 0, ADD: 0, SUBTRACT: 0, POP_ADD: 0, POP_SUBTRACT: 0, REVERSE_ALL: 0, REVERSE: 1,
+    PUSH_CONSTANT: 1, ADD_CONSTANT: 2, ADD_VARIABLE: 1, SUBTRACT_VARIABLE: 1,
+    MULTIPLY_ADD: 4, REPEAT_PUSH: 3, SET_TO_VARIABLE: 2,
+    ASSIGN: 1, POP: 0, CREATE_LOCAL: 1, DELETE: 1, PUSH_VARIABLE: 1, STDOUT: 1, STDIN: 1, FLUSH: 0, RAISE: 1,
+    COMPARE: 2, START_REPEAT: 2, END_REPEAT: 1, EXIT_REPEAT: 1, JUMP: 1,
+    DEFINE: 1, CALL: 1, TAIL_CALL: 1, RETURN: 0, HALT: 0,
+}
+
+class BytecodeProgram:
+    """
+    Program lowered into a flat array of opcodes and operands with resolved jump addresses.
+    Variable and procedure names are stored as indexes into 'names'.
+    Debug info is kept in separate arrays and is only turned into CCLTraceback when an error occurs.
+    """
+    def __init__(self, source_map: SourceMap):
+        self.code = array('i')
+        self.names: list[str] = list()
+        self.messages: list[str] = list()
+        # DEFINE operand is an index into 'procedures': (name index, address of the first instruction)
+        self.procedures: list[tuple[int, int]] = list()
+        # Operands of variable length are stored as tuples, MULTIPLY_ADD and REPEAT_PUSH refer to them by index
+        self.tables: list[tuple[int, ...]] = list()
+        # Debug info: for every instruction address, debug index of the instruction in the source map of the program
+        self.source_map = source_map
+        self.debug_addresses = array('i')
+        self.debug_indexes = array('i')
+
+    def traceback(self, address: int) -> CCLTraceback:
+        index = bisect_right(self.debug_addresses, address) - 1
+        return self.source_map.traceback(self.debug_indexes[index])
+
+    def error(self, address: int, message: str) -> CCLRuntimeError:
+        return CCLRuntimeError(message, traceback=self.traceback(address))
+
+
+class Lowering:
+    """Lowers instruction stacks produced by Parser.parse() into BytecodeProgram"""
+    def __init__(self, main: MainProcedure):
+        self.main = main
+        self.program = BytecodeProgram(main.source_map)
+        self.name_indexes: dict[str, int] = dict()
+        self.pending_procedures: deque[tuple[int, DefineProcedure]] = deque()
+
+    def lower(self) -> BytecodeProgram:
+        self.lower_block(self.main.instruction_stack, in_procedure=False)
+        while self.pending_procedures:
+            procedure_index, instruction = self.pending_procedures.popleft()
+            name_index = self.program.procedures[procedure_index][0]
+            self.program.procedures[procedure_index] = (name_index, len(self.program.code))
+            self.lower_block([*instruction.instruction_stack, EndProcedure(namespace=None, debug_index=instruction.end_debug_index)],
+                             in_procedure=True)
+        return self.program
+
+    def name_index(self, name: str) -> int:
+        if name not in self.name_indexes:
+            self.name_indexes[name] = len(self.program.names)
+            self.program.names.append(name)
+        return self.name_indexes[name]
+
+    def table_index(self, table: tuple[int, ...]) -> int:
+        self.program.tables.append(table)
+        return len(self.program.tables) - 1
+
+    def message_index(self, message: str) -> int:
+        self.program.messages.append(message)
+        return len(self.program.messages) - 1
+
+    def lower_block(self, instruction_stack: list[Instruction], in_procedure: bool):
+        # Address of every instruction in the code array, used to resolve jump addresses.
+        # Instructions which are lowered into nothing share the address with the next instruction.
+        addresses = list()
+        address = len(self.program.code)
+        for instruction in instruction_stack:
+            addresses.append(address)
+            address += sum(OPERAND_COUNT[opcode] + 1 for opcode, *_ in self.lower_instruction(instruction, None, in_procedure))
+        addresses.append(address)
+
+        for instruction in instruction_stack:
+            operations = self.lower_instruction(instruction, addresses, in_procedure)
+            for opcode, *operands in operations:
+                self.add_debug_info(instruction.debug_index)
+                self.program.code.append(opcode)
+                if opcode in (ADD_VARIABLE, SUBTRACT_VARIABLE):
+                    # Errors of the fused '*' or '~' are reported at the address of the operand
+                    self.add_debug_info(instruction.operation_debug_index)
+                self.program.code.extend(operands)
+
+    def add_debug_info(self, debug_index: int):
+        if debug_index < 0:
+            return
+        self.program.debug_addresses.append(len(self.program.code))
+        self.program.debug_indexes.append(debug_index)
+
+    def lower_instruction(self, instruction: Instruction, addresses: list[int] | None, in_procedure: bool) -> list[tuple[int, ...]]:
+        """
+        Returns list of (opcode, *operands) tuples for the instruction.
+        When 'addresses' is None, only the amount and kind of operations matter (operands are dummy values).
+        """
+        def jump(index: int) -> int:
+            return addresses[index] if addresses is not None else 0
+
+        name = getattr(instruction, 'name_parameter', None)
+        lower_name = self.name_index if addresses is not None else (lambda _: 0)
+        lower_message = self.message_index if addresses is not None else (lambda _: 0)
+        lower_table = self.table_index if addresses is not None else (lambda _: 0)
+
+        if isinstance(instruction, DefineProcedure):
+            if addresses is None:
+                return [(DEFINE, 0)]
+            self.program.procedures.append((self.name_index(name), -1))
+            self.pending_procedures.append((len(self.program.procedures) - 1, instruction))
+            return [(DEFINE, len(self.program.procedures) - 1)]
+        if isinstance(instruction, CallProcedure):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '@_': name must be provided and cannot be '_'"))]
+            return [(TAIL_CALL if instruction.tail_call else CALL, lower_name(name))]
+        if isinstance(instruction, PushZero):
+            return [(PUSH_ZERO,)]
+        if isinstance(instruction, Add):
+            return [(ADD,)]
+        if isinstance(instruction, Subtract):
+            return [(SUBTRACT,)]
+        if isinstance(instruction, PopAdd):
+            return [(POP_ADD,)]
+        if isinstance(instruction, PopSubtract):
+            return [(POP_SUBTRACT,)]
+        if isinstance(instruction, PushConstant):
+            return [(PUSH_CONSTANT, instruction.value)]
+        if isinstance(instruction, AddConstant):
+            if instruction.symbol == '+':
+                return [(ADD_CONSTANT, instruction.amount, lower_message("Instruction '+': cannot add to an empty stack"))]
+            return [(ADD_CONSTANT, instruction.amount, lower_message("Instruction '-': cannot subtract from an empty stack"))]
+        if isinstance(instruction, (AddVariable, SubtractVariable)):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '$_': name must be provided and cannot be '_'"))]
+            return [(SUBTRACT_VARIABLE if isinstance(instruction, SubtractVariable) else ADD_VARIABLE, lower_name(name))]
+        if isinstance(instruction, MultiplyAdd):
+            # Table holds (sign, name index) pairs, name index is -1 for '_', which is never defined
+            table = tuple(value for sign, variable in instruction.variables
+                          for value in (sign, -1 if variable is None else lower_name(variable)))
+            return [(MULTIPLY_ADD, lower_name(name), instruction.constant, lower_table(table), jump(instruction.jump_address + 1))]
+        if isinstance(instruction, RepeatPush):
+            return [(REPEAT_PUSH, lower_name(name), lower_table(tuple(instruction.values)), jump(instruction.jump_address + 1))]
+        if isinstance(instruction, SetToVariable):
+            return [(SET_TO_VARIABLE, -1 if name is None else lower_name(name), jump(instruction.jump_address + 1))]
+        if isinstance(instruction, Reverse):
+            if not name:
+                return [(REVERSE_ALL,)]
+            return [(REVERSE, lower_name(name))]
+        if isinstance(instruction, Assign):
+            if name is None:
+                return [(POP,)]
+            return [(ASSIGN, lower_name(name))]
+        if isinstance(instruction, CreateLocal):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '&_': name must be provided and cannot be '_'"))]
+            if not in_procedure:
+                return [(RAISE, lower_message(f"Instruction '&{name}': cannot create local variable outside of procedure"))]
+            return [(CREATE_LOCAL, lower_name(name))]
+        if isinstance(instruction, Delete):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '!_': name must be provided and cannot be '_'"))]
+            return [(DELETE, lower_name(name))]
+        if isinstance(instruction, PushVariable):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '$_': name must be provided and cannot be '_'"))]
+            return [(PUSH_VARIABLE, lower_name(name))]
+        if isinstance(instruction, StdOut):
+            if name is None:
+                return [(RAISE, lower_message(f"Instruction '<_': name must be provided and cannot be '_'"))]
+            return [(STDOUT, lower_name(name))]
+        if isinstance(instruction, StdIn):
+            if name is None:
+                return [(FLUSH,), (RAISE, lower_message(f"Instruction '>_': name must be provided and cannot be '_'"))]
+            return [(STDIN, lower_name(name))]
+        if isinstance(instruction, StartCompare):
+            return [(COMPARE, lower_name(name), jump(instruction.jump_address + 1))]
+        if isinstance(instruction, StartRepeat):
+            return [(START_REPEAT, lower_name(name), jump(instruction.jump_address + 1))]
+        if isinstance(instruction, EndRepeat):
+            return [(END_REPEAT, jump(instruction.jump_address + 1))]
+        if isinstance(instruction, EndWhile):
+            return [(JUMP, jump(instruction.jump_address + 1))]
+        if isinstance(instruction, (StartWhile, EndCompare)):
+            return []
+        if isinstance(instruction, ExitBlock):
+            if instruction.context == Context.REPEAT:
+                return [(EXIT_REPEAT, jump(instruction.jump_address + 1))]
+            if instruction.context == Context.WHILE:
+                return [(JUMP, jump(instruction.jump_address + 1))]
+            return [(RETURN,)] if in_procedure else [(HALT,)]
+        if isinstance(instruction, ContinueBlock):
+            if instruction.context == Context.REPEAT:
+                # Continue in REPEAT block goes to EndRepeat, which decides whether to repeat again
+                return [(JUMP, jump(instruction.jump_address))]
+            if instruction.context == Context.WHILE:
+                return [(JUMP, jump(instruction.jump_address + 1))]
+            return [(RAISE, lower_message(f"Instruction ':': cannot be used outside of REPEAT or WHILE block"))]
+        if isinstance(instruction, EndProcedure):
+            return [(RETURN,)] if in_procedure else [(HALT,)]
+        raise TypeError(f"Cannot lower instruction '{type(instruction).__name__}'")
+
+
+class VirtualMachine:
+    """Executes BytecodeProgram. All hot state lives in local variables of run()"""
+    def __init__(self, program: BytecodeProgram, main: MainProcedure):
+        self.program = program
+        self.main = main
+        self.stack: list[int] = list()
+        self.global_variables: dict[int, int] = dict()
+        # Name index: (address of the first instruction,). Every DEFINE stores a new tuple, so that calls tell a redefined
+        # procedure from the one which is running by identity, as they do with Procedure objects
+        self.defined_procedures: dict[int, tuple[int]] = dict()
+
+    def run(self):
+        program = self.program
+        code = program.code
+        names = program.names
+        error = program.error
+        stack = self.stack
+        push = stack.append
+        pop = stack.pop
+        global_variables = self.global_variables
+        defined_procedures = self.defined_procedures
+        write = self.main.stdout.append
+        flush_stdout = self.main.flush_stdout
+        flush_before_input = self.main.flush_before_input
+        read_char = self.main.read_char
+        # Each frame is (return address, local variables, running procedure)
+        frames: list[tuple[int, dict[int, int], tuple[int] | None]] = list()
+        repeat_counters: list[int] = list()
+        local_variables: dict[int, int] = dict()
+        procedure = None
+        address = 0
+
+        while True:
+            opcode = code[address]
+
+            if opcode == PUSH_VARIABLE:
+                name = code[address + 1]
+                if name in local_variables:
+                    push(local_variables[name])
+                elif name in global_variables:
+                    push(global_variables[name])
+                else:
+                    raise error(address, f"Instruction '${names[name]}': variable '{names[name]}' is undefined")
+                address += 2
+
+            elif opcode == ADD:
+                if not stack:
+                    raise error(address, "Instruction '+': cannot add to an empty stack")
+                value = stack[-1]
+                stack[-1] = CELL_MIN if value == CELL_MAX else value + 1
+                address += 1
+
+            elif opcode == SUBTRACT:
+                if not stack:
+                    raise error(address, "Instruction '-': cannot subtract from an empty stack")
+                value = stack[-1]
+                stack[-1] = CELL_MAX if value == CELL_MIN else value - 1
+                address += 1
+
+            elif opcode == ADD_CONSTANT:
+                if not stack:
+                    raise error(address, program.messages[code[address + 2]])
+                stack[-1] = ((stack[-1] + code[address + 1] + 32768) & 65535) - 32768
+                address += 3
+
+            elif opcode == PUSH_CONSTANT:
+                push(code[address + 1])
+                address += 2
+
+            elif opcode == ADD_VARIABLE or opcode == SUBTRACT_VARIABLE:
+                name = code[address + 1]
+                if name in local_variables:
+                    value = local_variables[name]
+                elif name in global_variables:
+                    value = global_variables[name]
+                else:
+                    raise error(address, f"Instruction '${names[name]}': variable '{names[name]}' is undefined")
+                if not stack:
+                    # Pushed value stays on the stack, as it does without fusing
+                    push(value)
+                    symbol = '*' if opcode == ADD_VARIABLE else '~'
+                    raise error(address + 1, f"Instruction '{symbol}': not enough elements on the stack (1); at least 2 required")
+                stack[-1] = ((stack[-1] + (value if opcode == ADD_VARIABLE else -value) + 32768) & 65535) - 32768
+                address += 2
+
+            elif opcode == MULTIPLY_ADD:
+                # Falls through into the REPEAT block when it has to report an error
+                name = code[address + 1]
+                amount = local_variables[name] if name in local_variables else global_variables.get(name)
+                if amount is None or amount < 0:
+                    address += 5
+                elif amount == 0:
+                    address = code[address + 4]
+                elif stack:
+                    delta = code[address + 2]
+                    table = program.tables[code[address + 3]]
+                    for index in range(0, len(table), 2):
+                        name = table[index + 1]
+                        value = local_variables[name] if name in local_variables else global_variables.get(name)
+                        if value is None:
+                            address += 5
+                            break
+                        delta += table[index] * value
+                    else:
+                        stack[-1] = ((stack[-1] + amount * delta + 32768) & 65535) - 32768
+                        address = code[address + 4]
+                else:
+                    address += 5
+
+            elif opcode == REPEAT_PUSH:
+                name = code[address + 1]
+                amount = local_variables[name] if name in local_variables else global_variables.get(name)
+                if amount is None or amount < 0:
+                    address += 4
+                else:
+                    stack.extend(program.tables[code[address + 2]] * amount)
+                    address = code[address + 3]
+
+            elif opcode == SET_TO_VARIABLE:
+                name = code[address + 1]
+                value = local_variables[name] if name in local_variables else global_variables.get(name)
+                if value is None or not stack:
+                    address += 3
+                else:
+                    stack[-1] = value
+                    address = code[address + 2]
+
+            elif opcode == ASSIGN:
+                if not stack:
+                    raise error(address, "Instruction '=': cannot pop from an empty stack")
+                name = code[address + 1]
+                if name in local_variables:
+                    local_variables[name] = pop()
+                else:
+                    global_variables[name] = pop()
+                address += 2
+
+            elif opcode == PUSH_ZERO:
+                push(0)
+                address += 1
+
+            elif opcode == COMPARE:
+                if not stack:
+                    raise error(address, "Instruction '?': cannot compare with an empty stack")
+                name = code[address + 1]
+                if name in local_variables:
+                    value = local_variables[name]
+                elif name in global_variables:
+                    value = global_variables[name]
+                else:
+                    raise error(address, f"Instruction '?{names[name]}': variable '{names[name]}' is undefined")
+                address = address + 3 if value == stack[-1] else code[address + 2]
+
+            elif opcode == POP:
+                if not stack:
+                    raise error(address, "Instruction '=': cannot pop from an empty stack")
+                pop()
+                address += 1
+
+            elif opcode == POP_ADD or opcode == POP_SUBTRACT:
+                if len(stack) < 2:
+                    symbol = '*' if opcode == POP_ADD else '~'
+                    raise error(address, f"Instruction '{symbol}': not enough elements on the stack ({len(stack)}); at least 2 required")
+                value = pop()
+                stack[-1] = ((stack[-1] + (value if opcode == POP_ADD else -value) + 32768) & 65535) - 32768
+                address += 1
+
+            elif opcode == STDOUT:
+                name = code[address + 1]
+                if name in local_variables:
+                    value = local_variables[name]
+                elif name in global_variables:
+                    value = global_variables[name]
+                else:
+                    raise error(address, f"Instruction '<{names[name]}': variable '{names[name]}' is undefined")
+                if value not in OUTPUT_CHARS:
+                    raise error(address, f"Instruction '<{names[name]}': character with code {value} is not a printable ASCII character")
+                write(OUTPUT_CHARS[value])
+                address += 2
+
+            elif opcode == END_REPEAT:
+                if repeat_counters[-1] == 0:
+                    repeat_counters.pop()
+                    address += 2
+                else:
+                    repeat_counters[-1] -= 1
+                    address = code[address + 1]
+
+            elif opcode == JUMP:
+                address = code[address + 1]
+
+            elif opcode == START_REPEAT:
+                name = code[address + 1]
+                if name in local_variables:
+                    amount = local_variables[name]
+                elif name in global_variables:
+                    amount = global_variables[name]
+                else:
+                    raise error(address, f"Instruction '{names[name]}[...]': variable '{names[name]}' is undefined")
+                if amount < 0:
+                    raise error(address, f"Instruction '{names[name]}[...]': parameter ('{names[name]}' = {amount}) cannot be less than 0")
+                if amount == 0:
+                    address = code[address + 2]
+                else:
+                    repeat_counters.append(amount - 1)
+                    address += 3
+
+            elif opcode == EXIT_REPEAT:
+                repeat_counters.pop()
+                address = code[address + 1]
+
+            elif opcode == CALL:
+                name = code[address + 1]
+                if name not in defined_procedures:
+                    raise error(address, f"Instruction '@{names[name]}': procedure '{names[name]}' is undefined")
+                frames.append((address + 2, local_variables, procedure))
+                # Recursive call starts with a copy of caller's local variables, as Procedure.enter() does
+                callee = defined_procedures[name]
+                local_variables = dict(local_variables) if callee is procedure else dict()
+                procedure = callee
+                address = callee[0]
+
+            elif opcode == TAIL_CALL:
+                name = code[address + 1]
+                if name not in defined_procedures:
+                    raise error(address, f"Instruction '@{names[name]}': procedure '{names[name]}' is undefined")
+                # Callee takes over the frame of the caller, and returns straight to the caller's caller.
+                # Recursive call keeps the local variables, which the caller no longer needs
+                callee = defined_procedures[name]
+                if callee is not procedure:
+                    local_variables = dict()
+                procedure = callee
+                address = callee[0]
+
+            elif opcode == RETURN:
+                address, local_variables, procedure = frames.pop()
+
+            elif opcode == CREATE_LOCAL:
+                local_variables[code[address + 1]] = 0
+                address += 2
+
+            elif opcode == DEFINE:
+                name, procedure_address = program.procedures[code[address + 1]]
+                defined_procedures[name] = (procedure_address,)
+                address += 2
+
+            elif opcode == REVERSE_ALL:
+                stack.reverse()
+                address += 1
+
+            elif opcode == REVERSE:
+                name = code[address + 1]
+                if name in local_variables:
+                    amount = local_variables[name]
+                elif name in global_variables:
+                    amount = global_variables[name]
+                else:
+                    raise error(address, f"Instruction '%{names[name]}': variable '{names[name]}' is undefined")
+                if len(stack) < amount:
+                    raise error(address, f"Instruction '%{names[name]}': parameter ('{names[name]}' = {amount}) exceeds length of the stack ({len(stack)})")
+                if amount < 1:
+                    raise error(address, f"Instruction '%{names[name]}': parameter ('{names[name]}' = {amount}) cannot be less than 1")
+                stack[-amount:] = stack[-amount:][::-1]
+                address += 2
+
+            elif opcode == DELETE:
+                name = code[address + 1]
+                if name in local_variables:
+                    del local_variables[name]
+                elif name in global_variables:
+                    del global_variables[name]
+                else:
+                    raise error(address, f"Instruction '!{names[name]}': variable '{names[name]}' is undefined")
+                address += 2
+
+            elif opcode == STDIN:
+                flush_before_input()
+                name = code[address + 1]
+                if name not in local_variables and name not in global_variables:
+                    raise error(address, f"Instruction '>{names[name]}': variable '{names[name]}' is undefined")
+                char = read_char(names[name], program.traceback(address))
+                if name in local_variables:
+                    local_variables[name] = ord(char)
+                else:
+                    global_variables[name] = ord(char)
+                address += 2
+
+            elif opcode == FLUSH:
+                flush_before_input()
+                address += 1
+
+            elif opcode == RAISE:
+                raise error(address, program.messages[code[address + 1]])
+
+            elif opcode == HALT:
+                flush_stdout()
+                return
+
+    def export_state(self):
+        """Copies final state into MainProcedure, so that MainProcedure.debug() can print it"""
+        names = self.program.names
+        self.main.load_state(self.stack,
+                             {names[name]: value for name, value in self.global_variables.items()},
+                             {names[name]: procedure[0] for name, procedure in self.defined_procedures.items()})
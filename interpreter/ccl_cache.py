@@ -0,0 +1,131 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from ccl_internals import MainProcedure, Instruction, DefineProcedure
+from ccl_parser import Parser
+from ccl_resolver import Resolver
+from ccl_source import SourceMap
+
+CACHE_DIRECTORY_NAME = '__cclcache__'
+CACHE_SUFFIX = '.cclc'
+# Total size of all entries in one cache directory; least recently used entries are evicted first
+CACHE_MAX_SIZE = 32 * 1024 * 1024
+# Cached programs are pickled instruction objects, so any change to these modules invalidates the cache
+VERSIONED_MODULES = ('ccl_exceptions.py', 'ccl_internals.py', 'ccl_parser.py', 'ccl_resolver.py', 'ccl_cache.py', 'ccl_source.py')
+
+
+def interpreter_version() -> str:
+    """Returns hash of the interpreter source code and Python version"""
+    digest = hashlib.sha256(sys.version.encode())
+    directory = Path(__file__).resolve().parent
+    for module in VERSIONED_MODULES:
+        digest.update((directory / module).read_bytes())
+    return digest.hexdigest()
+
+
+class ProgramCache:
+    """
+    On-disk cache of parsed programs, similar to __pycache__.
+    Entries are keyed by the hash of the source code and the interpreter version,
+    so a changed file or an updated interpreter never gets a stale program.
+    Names of entries also hold the hash of the resolved source path, so that files with the same name
+    in different directories, which share one cache directory, do not evict each other's entries.
+    """
+    version: str | None = None
+
+    def __init__(self, directory: str | Path, max_size: int = CACHE_MAX_SIZE):
+        self.directory = Path(directory)
+        self.max_size = max_size
+        if ProgramCache.version is None:
+            ProgramCache.version = interpreter_version()
+
+    @staticmethod
+    def default_directory(source_filepath: str) -> Path:
+        return Path(source_filepath).resolve().parent / CACHE_DIRECTORY_NAME
+
+    def entry_path(self, parser: Parser) -> Path:
+        source_path = Path(parser.source_filepath)
+        path_digest = hashlib.sha256(str(source_path.resolve()).encode())
+        digest = hashlib.sha256(self.version.encode())
+        digest.update(parser.code.data)
+        return self.directory / f'{source_path.stem}.{path_digest.hexdigest()[:16]}.{digest.hexdigest()[:32]}{CACHE_SUFFIX}'
+
+    def parse(self, parser: Parser) -> MainProcedure:
+        """Returns cached program if there is one, otherwise parses the program and stores it in the cache"""
+        path = self.entry_path(parser)
+        entry = self.load(path)
+        if entry is None:
+            main = parser.parse()
+            self.store(path, main)
+            return main
+
+        instruction_stack, lines, symbols = entry
+        main = parser.main
+        # Positions are cached without the source code, which the parser has already mapped
+        main.source_map = SourceMap(parser.code, lines, symbols)
+        self.bind(instruction_stack, main)
+        main.instruction_stack.extend(instruction_stack)
+        return Resolver(main).resolve()
+
+    @staticmethod
+    def bind(instruction_stack: list[Instruction], main: MainProcedure):
+        """Instructions are unpickled without a namespace, so they are bound to 'main' here"""
+        for instruction in instruction_stack:
+            instruction.namespace = main
+            if isinstance(instruction, DefineProcedure):
+                ProgramCache.bind(instruction.instruction_stack, main)
+
+    def load(self, path: Path) -> tuple[list, array, array] | None:
+        """Returns (instruction stack, lines, symbols) of the source map, or None if there is no usable entry"""
+        try:
+            with open(path, 'rb') as entry:
+                instruction_stack, lines, symbols = pickle.load(entry)
+            os.utime(path)
+            return instruction_stack, lines, symbols
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+            # Corrupted or incompatible entry is parsed again and overwritten
+            return None
+
+    def store(self, path: Path, main: MainProcedure):
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so that concurrent runs never see a partially written entry
+            descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(descriptor, 'wb') as entry:
+                pickle.dump((main.instruction_stack, main.source_map.lines, main.source_map.symbols), entry, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+            self.evict(path)
+        except OSError:
+            # Cache is an optimization; read-only or full disk must not break the run
+            pass
+
+    def evict(self, current_path: Path):
+        """Removes older entries of the same source file and keeps the cache directory under max_size"""
+        # Entries of one source file share the name up to the hash of the source code: '<stem>.<path hash>.'
+        prefix = current_path.name.rsplit('.', 2)[0] + '.'
+        entries = list()
+        for path in self.directory.glob(f'*{CACHE_SUFFIX}'):
+            try:
+                if path != current_path and path.name.startswith(prefix) and path.name[len(prefix):].count('.') == 1:
+                    path.unlink()
+                    continue
+                entries.append((path.stat().st_mtime, path.stat().st_size, path))
+            except OSError:
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size or path == current_path:
+                continue
+            try:
+                path.unlink()
+                total_size -= size
+            except OSError:
+                pass
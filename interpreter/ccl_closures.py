@@ -0,0 +1,629 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Callable
+from ccl_exceptions import CCLRuntimeError
+from ccl_internals import (CELL_MIN, CELL_MAX, OUTPUT_CHARS, wrap,
+                           Context, MainProcedure, Instruction,
+                           DefineProcedure, CallProcedure, EndProcedure,
+                           Add, Subtract, PopAdd, PopSubtract, Reverse,
+                           PushZero, Assign, CreateLocal, Delete, PushVariable,
+                           PushConstant, AddConstant, AddVariable, SubtractVariable,
+                           MultiplyAdd, RepeatPush, SetToVariable,
+                           StdOut, StdIn,
+                           StartCompare, EndCompare,
+                           StartRepeat, EndRepeat, StartWhile, EndWhile,
+                           ExitBlock, ContinueBlock)
+
+# Every compiled instruction is an Operation: it does its work and returns the next Operation to run.
+# Returning None ends the program.
+Operation = Callable[[], 'Operation | None']
+
+
+@dataclass
+class CompiledProcedure:
+    name: str
+    entry: Operation
+
+
+class ClosureEngine:
+    """
+    Compiles instruction stacks produced by Parser.parse() into a chain of pre-bound closures.
+    Jump addresses are resolved to closure references, so running a program is a single
+    'operation = operation()' loop without instruction objects, namespaces or an instruction pointer.
+    """
+    def __init__(self, main: MainProcedure):
+        self.main = main
+        # Tracebacks are made once per instruction when it is compiled, their lines are read only on errors
+        self.source_map = main.source_map
+        self.stack: list[int] = list()
+        self.global_variables: dict[str, int] = dict()
+        self.defined_procedures: dict[str, CompiledProcedure] = dict()
+        # Each frame is (return operation, local variables, running procedure)
+        self.frames: list[tuple[Operation, dict[str, int], CompiledProcedure]] = list()
+        self.repeat_counters: list[int] = list()
+        self.links: list[Callable[[list[Operation]], None]] = list()
+        self.entry = self.compile_block(main.instruction_stack, None)
+
+    def run(self):
+        operation = self.entry
+        while operation:
+            operation = operation()
+
+    def export_state(self):
+        """Copies final state into MainProcedure, so that MainProcedure.debug() can print it"""
+        self.main.load_state(self.stack, self.global_variables, self.defined_procedures)
+
+    def compile_block(self, instruction_stack: list[Instruction], procedure_name: str | None) -> Operation:
+        """Compiles an instruction stack of MainProcedure (procedure_name is None) or a procedure body"""
+        if procedure_name is not None:
+            instruction_stack = [*instruction_stack, EndProcedure(namespace=None, debug_index=-1)]
+
+        links = self.links
+        self.links = list()
+        operations = [self.compile_instruction(instruction, address, procedure_name)
+                      for address, instruction in enumerate(instruction_stack)]
+        for link in self.links:
+            link(operations)
+        self.links = links
+        return operations[0]
+
+    def link(self, operation: Operation, next_address: int | None = None, jump_address: int | None = None) -> Operation:
+        """
+        Returns the operation, whose 'next_operation' and 'jump_operation' variables are set to operations
+        of the given addresses once the whole block is compiled. Operations read them as free variables,
+        so following a link costs the same as reading a local variable
+        """
+        cells = dict(zip(operation.__code__.co_freevars, operation.__closure__ or ()))
+
+        def link(operations: list[Operation]):
+            if next_address is not None:
+                cells['next_operation'].cell_contents = operations[next_address]
+            if jump_address is not None:
+                cells['jump_operation'].cell_contents = operations[jump_address]
+        self.links.append(link)
+        return operation
+
+    def compile_instruction(self, instruction: Instruction, address: int, procedure_name: str | None) -> Operation:
+        compilers = {
+            DefineProcedure: self.compile_define_procedure,
+            CallProcedure: self.compile_call_procedure,
+            EndProcedure: self.compile_end_procedure,
+            PushZero: self.compile_push_zero,
+            Add: self.compile_add,
+            Subtract: self.compile_subtract,
+            PopAdd: self.compile_pop_add,
+            PopSubtract: self.compile_pop_subtract,
+            PushConstant: self.compile_push_constant,
+            AddConstant: self.compile_add_constant,
+            AddVariable: self.compile_add_variable,
+            SubtractVariable: self.compile_add_variable,
+            Reverse: self.compile_reverse,
+            Assign: self.compile_assign,
+            CreateLocal: self.compile_create_local,
+            Delete: self.compile_delete,
+            PushVariable: self.compile_push_variable,
+            StdOut: self.compile_stdout,
+            StdIn: self.compile_stdin,
+            StartCompare: self.compile_start_compare,
+            EndCompare: self.compile_nop,
+            StartRepeat: self.compile_start_repeat,
+            EndRepeat: self.compile_end_repeat,
+            StartWhile: self.compile_nop,
+            EndWhile: self.compile_end_while,
+            ExitBlock: self.compile_exit_block,
+            ContinueBlock: self.compile_continue_block,
+            MultiplyAdd: self.compile_multiply_add,
+            RepeatPush: self.compile_repeat_push,
+            SetToVariable: self.compile_set_to_variable,
+        }
+        return compilers[type(instruction)](instruction, address, procedure_name)
+
+    def compile_lookup(self, procedure_name: str | None) -> Callable[[str], int | None]:
+        """Returns a function which finds variable value by name (local first, then global)"""
+        global_variables = self.global_variables
+        frames = self.frames
+
+        if procedure_name is None:
+            return global_variables.get
+
+        def lookup(name: str) -> int | None:
+            local_variables = frames[-1][1]
+            if name in local_variables:
+                return local_variables[name]
+            return global_variables.get(name)
+        return lookup
+
+    def compile_store(self, procedure_name: str | None) -> Callable[[str, int], None]:
+        """Returns a function which sets existing local variable, or global variable otherwise"""
+        global_variables = self.global_variables
+        frames = self.frames
+
+        if procedure_name is None:
+            return global_variables.__setitem__
+
+        def store(name: str, value: int):
+            local_variables = frames[-1][1]
+            if name in local_variables:
+                local_variables[name] = value
+                return
+            global_variables[name] = value
+        return store
+
+    def compile_nop(self, instruction: Instruction, address: int, procedure_name: str | None) -> Operation:
+        next_operation = None
+
+        def operation():
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_define_procedure(self, instruction: DefineProcedure, address: int, procedure_name: str | None) -> Operation:
+        defined_procedures = self.defined_procedures
+        name = instruction.name_parameter
+        entry = self.compile_block(instruction.instruction_stack, name)
+        next_operation = None
+
+        def operation():
+            # Every definition makes a new procedure, like DefineProcedure does, so that calls tell a redefined procedure
+            # from the one which is running
+            defined_procedures[name] = CompiledProcedure(name, entry)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_call_procedure(self, instruction: CallProcedure, address: int, procedure_name: str | None) -> Operation:
+        defined_procedures = self.defined_procedures
+        frames = self.frames
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def check():
+            if name is None:
+                raise CCLRuntimeError(f"Instruction '@_': name must be provided and cannot be '_'", traceback=traceback)
+            if name not in defined_procedures:
+                raise CCLRuntimeError(f"Instruction '@{name}': procedure '{name}' is undefined", traceback=traceback)
+
+        if instruction.tail_call:
+            def operation():
+                check()
+                # Callee takes over the frame of the caller, and returns straight to the caller's caller.
+                # Recursive call keeps the local variables, which the caller no longer needs
+                procedure = defined_procedures[name]
+                if procedure is not frames[-1][2]:
+                    frames[-1] = (frames[-1][0], dict(), procedure)
+                return procedure.entry
+            return operation
+
+        if procedure_name is None:
+            def operation():
+                check()
+                procedure = defined_procedures[name]
+                frames.append((next_operation, dict(), procedure))
+                return procedure.entry
+        else:
+            def operation():
+                check()
+                # Recursive call starts with a copy of caller's local variables, as Procedure.enter() does
+                procedure = defined_procedures[name]
+                if procedure is frames[-1][2]:
+                    frames.append((next_operation, dict(frames[-1][1]), procedure))
+                else:
+                    frames.append((next_operation, dict(), procedure))
+                return procedure.entry
+        return self.link(operation, next_address=address + 1)
+
+    def compile_end_procedure(self, instruction: Instruction, address: int, procedure_name: str | None) -> Operation:
+        frames = self.frames
+        flush_stdout = self.main.flush_stdout
+
+        if procedure_name is None:
+            def operation():
+                flush_stdout()
+                return None
+            return operation
+
+        def operation():
+            return frames.pop()[0]
+        return operation
+
+    def compile_push_zero(self, instruction: PushZero, address: int, procedure_name: str | None) -> Operation:
+        push = self.stack.append
+        next_operation = None
+
+        def operation():
+            push(0)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_add(self, instruction: Add, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if not stack:
+                raise CCLRuntimeError("Instruction '+': cannot add to an empty stack", traceback=traceback)
+            value = stack[-1]
+            stack[-1] = CELL_MIN if value == CELL_MAX else value + 1
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_subtract(self, instruction: Subtract, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if not stack:
+                raise CCLRuntimeError("Instruction '-': cannot subtract from an empty stack", traceback=traceback)
+            value = stack[-1]
+            stack[-1] = CELL_MAX if value == CELL_MIN else value - 1
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_pop_add(self, instruction: PopAdd, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if len(stack) < 2:
+                raise CCLRuntimeError(f"Instruction '*': not enough elements on the stack ({len(stack)}); at least 2 required", traceback=traceback)
+            value = stack.pop() + stack[-1]
+            if not CELL_MIN <= value <= CELL_MAX:
+                value = wrap(value)
+            stack[-1] = value
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_pop_subtract(self, instruction: PopSubtract, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if len(stack) < 2:
+                raise CCLRuntimeError(f"Instruction '~': not enough elements on the stack ({len(stack)}); at least 2 required", traceback=traceback)
+            top_value = stack.pop()
+            value = stack[-1] - top_value
+            if not CELL_MIN <= value <= CELL_MAX:
+                value = wrap(value)
+            stack[-1] = value
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_push_constant(self, instruction: PushConstant, address: int, procedure_name: str | None) -> Operation:
+        push = self.stack.append
+        value = instruction.value
+        next_operation = None
+
+        def operation():
+            push(value)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_add_constant(self, instruction: AddConstant, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        amount = instruction.amount
+        if instruction.symbol == '+':
+            message = "Instruction '+': cannot add to an empty stack"
+        else:
+            message = "Instruction '-': cannot subtract from an empty stack"
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if not stack:
+                raise CCLRuntimeError(message, traceback=traceback)
+            value = stack[-1] + amount
+            if not CELL_MIN <= value <= CELL_MAX:
+                value = wrap(value)
+            stack[-1] = value
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_add_variable(self, instruction: AddVariable, address: int, procedure_name: str | None) -> Operation:
+        """Compiles both AddVariable and SubtractVariable"""
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        sign = -1 if isinstance(instruction, SubtractVariable) else 1
+        symbol = '~' if isinstance(instruction, SubtractVariable) else '*'
+        traceback = self.source_map.traceback(instruction.debug_index)
+        operation_traceback = self.source_map.traceback(instruction.operation_debug_index)
+        next_operation = None
+
+        def operation():
+            value = lookup(name)
+            if value is None:
+                if name is None:
+                    raise CCLRuntimeError(f"Instruction '$_': name must be provided and cannot be '_'", traceback=traceback)
+                raise CCLRuntimeError(f"Instruction '${name}': variable '{name}' is undefined", traceback=traceback)
+            if not stack:
+                # Pushed value stays on the stack, as it does without fusing
+                stack.append(value)
+                raise CCLRuntimeError(f"Instruction '{symbol}': not enough elements on the stack (1); at least 2 required", traceback=operation_traceback)
+            value = stack[-1] + sign * value
+            if not CELL_MIN <= value <= CELL_MAX:
+                value = wrap(value)
+            stack[-1] = value
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_reverse(self, instruction: Reverse, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if not name:
+                stack.reverse()
+                return next_operation
+            amount = lookup(name)
+            if amount is None:
+                raise CCLRuntimeError(f"Instruction '%{name}': variable '{name}' is undefined", traceback=traceback)
+            if len(stack) < amount:
+                raise CCLRuntimeError(f"Instruction '%{name}': parameter ('{name}' = {amount}) exceeds length of the stack ({len(stack)})", traceback=traceback)
+            if amount < 1:
+                raise CCLRuntimeError(f"Instruction '%{name}': parameter ('{name}' = {amount}) cannot be less than 1", traceback=traceback)
+            stack[-amount:] = stack[-amount:][::-1]
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_assign(self, instruction: Assign, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        store = self.compile_store(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if not stack:
+                raise CCLRuntimeError("Instruction '=': cannot pop from an empty stack", traceback=traceback)
+            value = stack.pop()
+            if name is not None:
+                store(name, value)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_create_local(self, instruction: CreateLocal, address: int, procedure_name: str | None) -> Operation:
+        frames = self.frames
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if name is None:
+                raise CCLRuntimeError(f"Instruction '&_': name must be provided and cannot be '_'", traceback=traceback)
+            if procedure_name is None:
+                raise CCLRuntimeError(f"Instruction '&{name}': cannot create local variable outside of procedure", traceback=traceback)
+            frames[-1][1][name] = 0
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_delete(self, instruction: Delete, address: int, procedure_name: str | None) -> Operation:
+        global_variables = self.global_variables
+        frames = self.frames
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            if name is None:
+                raise CCLRuntimeError(f"Instruction '!_': name must be provided and cannot be '_'", traceback=traceback)
+            if procedure_name is not None and name in frames[-1][1]:
+                frames[-1][1].pop(name)
+            elif name in global_variables:
+                global_variables.pop(name)
+            else:
+                raise CCLRuntimeError(f"Instruction '!{name}': variable '{name}' is undefined", traceback=traceback)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_push_variable(self, instruction: PushVariable, address: int, procedure_name: str | None) -> Operation:
+        push = self.stack.append
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            value = lookup(name)
+            if value is None:
+                if name is None:
+                    raise CCLRuntimeError(f"Instruction '$_': name must be provided and cannot be '_'", traceback=traceback)
+                raise CCLRuntimeError(f"Instruction '${name}': variable '{name}' is undefined", traceback=traceback)
+            push(value)
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_stdout(self, instruction: StdOut, address: int, procedure_name: str | None) -> Operation:
+        write = self.main.stdout.append
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            value = lookup(name)
+            if value is None:
+                if name is None:
+                    raise CCLRuntimeError(f"Instruction '<_': name must be provided and cannot be '_'", traceback=traceback)
+                raise CCLRuntimeError(f"Instruction '<{name}': variable '{name}' is undefined", traceback=traceback)
+            if value not in OUTPUT_CHARS:
+                raise CCLRuntimeError(f"Instruction '<{name}': character with code {value} is not a printable ASCII character", traceback=traceback)
+            write(OUTPUT_CHARS[value])
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_stdin(self, instruction: StdIn, address: int, procedure_name: str | None) -> Operation:
+        read_char = self.main.read_char
+        flush_before_input = self.main.flush_before_input
+        lookup = self.compile_lookup(procedure_name)
+        store = self.compile_store(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+
+        def operation():
+            flush_before_input()
+            if name is None:
+                raise CCLRuntimeError(f"Instruction '>_': name must be provided and cannot be '_'", traceback=traceback)
+            if lookup(name) is None:
+                raise CCLRuntimeError(f"Instruction '>{name}': variable '{name}' is undefined", traceback=traceback)
+            char = read_char(name, traceback)
+            store(name, ord(char))
+            return next_operation
+        return self.link(operation, next_address=address + 1)
+
+    def compile_start_compare(self, instruction: StartCompare, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            if name is None:
+                raise CCLRuntimeError(f"Instruction '?_': name must be provided and cannot be '_'", traceback=traceback)
+            if not stack:
+                raise CCLRuntimeError("Instruction '?': cannot compare with an empty stack", traceback=traceback)
+            value = lookup(name)
+            if value is None:
+                raise CCLRuntimeError(f"Instruction '?{name}': variable '{name}' is undefined", traceback=traceback)
+            if value != stack[-1]:
+                return jump_operation
+            return next_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
+
+    def compile_start_repeat(self, instruction: StartRepeat, address: int, procedure_name: str | None) -> Operation:
+        counters = self.repeat_counters
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        traceback = self.source_map.traceback(instruction.debug_index)
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            amount = lookup(name)
+            if amount is None:
+                raise CCLRuntimeError(f"Instruction '{name}[...]': variable '{name}' is undefined", traceback=traceback)
+            if amount < 0:
+                raise CCLRuntimeError(f"Instruction '{name}[...]': parameter ('{name}' = {amount}) cannot be less than 0", traceback=traceback)
+            if amount == 0:
+                return jump_operation
+            counters.append(amount - 1)
+            return next_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
+
+    def compile_end_repeat(self, instruction: EndRepeat, address: int, procedure_name: str | None) -> Operation:
+        counters = self.repeat_counters
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            if counters[-1] == 0:
+                counters.pop()
+                return next_operation
+            counters[-1] -= 1
+            return jump_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
+
+    def compile_end_while(self, instruction: EndWhile, address: int, procedure_name: str | None) -> Operation:
+        jump_operation = None
+
+        def operation():
+            return jump_operation
+        return self.link(operation, jump_address=instruction.jump_address + 1)
+
+    def compile_exit_block(self, instruction: ExitBlock, address: int, procedure_name: str | None) -> Operation:
+        if instruction.context == Context.PROCEDURE:
+            return self.compile_end_procedure(instruction, address, procedure_name)
+
+        counters = self.repeat_counters
+        context = instruction.context
+        jump_operation = None
+
+        def operation():
+            if context == Context.REPEAT:
+                counters.pop()
+            return jump_operation
+        return self.link(operation, jump_address=instruction.jump_address + 1)
+
+    def compile_continue_block(self, instruction: ContinueBlock, address: int, procedure_name: str | None) -> Operation:
+        traceback = self.source_map.traceback(instruction.debug_index)
+
+        if instruction.context == Context.PROCEDURE:
+            def operation():
+                raise CCLRuntimeError(f"Instruction ':': cannot be used outside of REPEAT or WHILE block", traceback=traceback)
+            return operation
+
+        jump_operation = None
+
+        def operation():
+            return jump_operation
+        # Continue in REPEAT block goes to EndRepeat, which decides whether to repeat again
+        if instruction.context == Context.REPEAT:
+            return self.link(operation, jump_address=instruction.jump_address)
+        return self.link(operation, jump_address=instruction.jump_address + 1)
+
+    def compile_multiply_add(self, instruction: MultiplyAdd, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        constant = instruction.constant
+        variables = instruction.variables
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            # Falling through into the REPEAT block lets it report the error
+            amount = lookup(name)
+            if amount is None or amount < 0:
+                return next_operation
+            if amount == 0:
+                return jump_operation
+            if not stack:
+                return next_operation
+            delta = constant
+            for sign, variable in variables:
+                value = lookup(variable)
+                if value is None:
+                    return next_operation
+                delta += sign * value
+            stack[-1] = ((stack[-1] + amount * delta + 32768) & 65535) - 32768
+            return jump_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
+
+    def compile_repeat_push(self, instruction: RepeatPush, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        values = instruction.values
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            amount = lookup(name)
+            if amount is None or amount < 0:
+                return next_operation
+            stack.extend(values * amount)
+            return jump_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
+
+    def compile_set_to_variable(self, instruction: SetToVariable, address: int, procedure_name: str | None) -> Operation:
+        stack = self.stack
+        lookup = self.compile_lookup(procedure_name)
+        name = instruction.name_parameter
+        next_operation = None
+        jump_operation = None
+
+        def operation():
+            value = lookup(name)
+            if value is None or not stack:
+                return next_operation
+            stack[-1] = value
+            return jump_operation
+        return self.link(operation, address + 1, instruction.jump_address + 1)
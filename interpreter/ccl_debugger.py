@@ -0,0 +1,307 @@
+from __future__ import annotations
+import os
+import re
+from colorama import Fore, Back
+from ccl_internals import Context, MainProcedure, Instruction, DefineProcedure, EndProcedure, ExitBlock, TraceEvent
+
+# Condition of a breakpoint: '<name> <operator> <number>', where name is a variable, 'top' (top of the stack)
+# or 'depth' (length of the stack). Names of variables are single letters, so they never clash with 'top' and 'depth'
+CONDITION = re.compile(r'^\s*([A-Za-z]+)\s*(==|!=|<=|>=|<|>)\s*(-?\d+)\s*$')
+OPERATORS = {
+    '==': int.__eq__,
+    '!=': int.__ne__,
+    '<=': int.__le__,
+    '>=': int.__ge__,
+    '<': int.__lt__,
+    '>': int.__gt__,
+}
+HELP = '''\
+COMMANDS:
+    s, step                       Run one instruction
+    n, next                       Run one instruction, stepping over procedure calls
+    c, continue                   Run until a breakpoint or a watchpoint stops the program
+    b, break <line>[:<symbol>]    Stop before the line (or the symbol) is run
+    b, break <line>[:<symbol>] if <name> <op> <number>
+                                  Stop only if the condition holds; <name> is a variable, 'top' or 'depth',
+                                  <op> is one of == != < <= > >=
+    w, watch <name>               Stop after the value of the variable changes
+    d, delete <number>            Delete a breakpoint or a watchpoint
+    l, list                       List breakpoints and watchpoints
+    p, print                      Print stack, variables and procedures
+    q, quit                       Stop debugging
+    h, help                       Show this message
+'''
+
+
+class Quit(Exception):
+    """Raised by the tracer of the debugger to stop the program, when the user quits"""
+
+
+class Breakpoint:
+    __slots__ = ('line', 'symbol', 'condition', 'hits')
+
+    def __init__(self, line: int, symbol: int | None, condition: tuple[str, str, int] | None):
+        self.line = line
+        self.symbol = symbol
+        self.condition = condition
+        self.hits = 0
+
+    def __str__(self) -> str:
+        location = f'line {self.line}' if self.symbol is None else f'line {self.line}, symbol {self.symbol}'
+        condition = '' if self.condition is None else ' if {} {} {}'.format(*self.condition)
+        return f'breakpoint at {location}{condition} (hit {self.hits} times)'
+
+
+class Watchpoint:
+    __slots__ = ('name', 'value', 'hits')
+
+    def __init__(self, name: str, value: int | None):
+        self.name = name
+        self.value = value
+        self.hits = 0
+
+    def __str__(self) -> str:
+        return f"watchpoint on '{self.name}' (hit {self.hits} times)"
+
+
+class Debugger:
+    """
+    Debugger of the default engine, built on the tracer of MainProcedure:
+    stops before the first instruction and then runs the program on commands.
+    Breakpoints are resolved to debug indexes of the source map when they are set, so while the program runs
+    between two stops, every instruction costs a set lookup and nothing is printed.
+    Watchpoints compare the watched variables before every instruction, so they are only checked while there are any.
+    """
+    def __init__(self, main: MainProcedure, code: list[str]):
+        self.main = main
+        self.code = code
+        self.points: dict[int, Breakpoint | Watchpoint] = dict()
+        self.next_number = 1
+        # Debug indexes, at which any breakpoint may stop the program
+        self.stops: set[int] = set()
+        self.watchpoints: list[Watchpoint] = list()
+        self.reason = 'program started'
+        # Stop before the next instruction, or before the first one that is not deeper in the call stack than 'depth'
+        self.stepping = True
+        self.depth: int | None = None
+        # Last instruction that was run, see check_breakpoints()
+        self.previous: Instruction | None = None
+
+    def current(self) -> Instruction:
+        procedure = self.main.call_stack[-1] if self.main.call_stack else self.main
+        return procedure.instruction_stack[procedure.instruction_pointer]
+
+    def variable(self, name: str) -> int | None:
+        """Returns value of the variable as the current instruction sees it (local first, then global)"""
+        if self.main.call_stack:
+            local_variables = self.main.call_stack[-1].local_variables
+            if name in local_variables.indexes and local_variables[name] is not None:
+                return local_variables[name]
+        if name in self.main.global_variables.indexes:
+            return self.main.global_variables[name]
+        return None
+
+    def value(self, name: str) -> int | None:
+        if name == 'top':
+            return self.main.stack[-1] if self.main.stack else None
+        if name == 'depth':
+            return len(self.main.stack)
+        return self.variable(name)
+
+    def run(self):
+        """Runs the program until it exits (CCLExit is raised), fails or the user quits"""
+        self.main.settrace(self.trace)
+        try:
+            self.main.run()
+        except Quit:
+            pass
+        finally:
+            self.main.settrace(None)
+
+    def trace(self, event: TraceEvent, instruction: Instruction, argument: object):
+        if event is not TraceEvent.INSTRUCTION:
+            return
+        if ((self.watchpoints and self.check_watchpoints()) or self.stepping
+                or (self.depth is not None and len(self.main.call_stack) <= self.depth)
+                or (instruction.debug_index in self.stops and self.check_breakpoints(instruction, self.previous))):
+            if not self.prompt():
+                raise Quit
+        self.previous = instruction
+
+    def prompt(self) -> bool:
+        """Shows the current stop and runs commands until the program is resumed; returns False to quit"""
+        self.show()
+        while True:
+            try:
+                command = input('(ccl) ').strip()
+            except EOFError:
+                return False
+            name, _, argument = command.partition(' ')
+            if name in ('s', 'step', 'n', 'next', 'c', 'continue'):
+                self.reason = 'step'
+                # 'next' stops at the first instruction, which is not deeper in the call stack than the current one
+                self.stepping = name in ('s', 'step')
+                self.depth = len(self.main.call_stack) if name in ('n', 'next') else None
+                return True
+            if name in ('q', 'quit'):
+                return False
+            if name in ('b', 'break'):
+                print(self.add_breakpoint(argument.strip()))
+            elif name in ('w', 'watch'):
+                print(self.add_watchpoint(argument.strip()))
+            elif name in ('d', 'delete'):
+                print(self.delete(argument.strip()))
+            elif name in ('l', 'list'):
+                self.list_points()
+            elif name in ('p', 'print'):
+                self.print_state()
+            elif name in ('h', 'help', ''):
+                print(HELP)
+            else:
+                print(f"Unknown command '{command}', type 'h' for help")
+
+    def add_breakpoint(self, argument: str) -> str:
+        location, _, condition_text = argument.partition(' if ')
+        line_text, _, symbol_text = location.strip().partition(':')
+        if not line_text.isdigit() or (symbol_text and not symbol_text.isdigit()):
+            return 'Usage: b <line>[:<symbol>] [if <name> <op> <number>]'
+        condition = None
+        if condition_text:
+            match = CONDITION.match(condition_text)
+            if match is None:
+                return "Condition must be '<name> <op> <number>', for example 'x > 3'"
+            condition = (match.group(1), match.group(2), int(match.group(3)))
+
+        breakpoint = Breakpoint(int(line_text), int(symbol_text) if symbol_text else None, condition)
+        indexes = self.resolve(breakpoint)
+        if not indexes:
+            return f'No instruction at line {breakpoint.line}' + ('' if breakpoint.symbol is None else f', symbol {breakpoint.symbol}')
+        self.stops.update(indexes)
+        return f'#{self.add_point(breakpoint)}: {breakpoint}'
+
+    def add_watchpoint(self, name: str) -> str:
+        if len(name) != 1 or not name.isalpha():
+            return 'Usage: w <name>, where name is a single letter'
+        watchpoint = Watchpoint(name, self.variable(name))
+        self.watchpoints.append(watchpoint)
+        return f'#{self.add_point(watchpoint)}: {watchpoint}'
+
+    def add_point(self, point: Breakpoint | Watchpoint) -> int:
+        number = self.next_number
+        self.points[number] = point
+        self.next_number += 1
+        return number
+
+    def delete(self, argument: str) -> str:
+        if not argument.isdigit() or int(argument) not in self.points:
+            return f"No breakpoint or watchpoint #{argument}"
+        point = self.points.pop(int(argument))
+        if isinstance(point, Watchpoint):
+            self.watchpoints.remove(point)
+        else:
+            self.stops = set()
+            for other in self.points.values():
+                if isinstance(other, Breakpoint):
+                    self.stops.update(self.resolve(other))
+        return f'Deleted {point}'
+
+    def resolve(self, breakpoint: Breakpoint) -> set[int]:
+        """Returns debug indexes of the positions, at which the breakpoint may stop the program"""
+        source_map = self.main.source_map
+        return {index for index, line in enumerate(source_map.lines)
+                if line == breakpoint.line and (breakpoint.symbol is None or source_map.symbols[index] == breakpoint.symbol)}
+
+    def list_points(self):
+        if not self.points:
+            print('No breakpoints or watchpoints')
+        for number, point in self.points.items():
+            print(f'#{number}: {point}')
+
+    def check_breakpoints(self, instruction: Instruction, previous: Instruction | None) -> bool:
+        """Returns True if a breakpoint stops the program before the instruction"""
+        source_map = self.main.source_map
+        line, symbol = source_map.position(instruction.debug_index)
+        if isinstance(previous, EndProcedure) or (isinstance(previous, ExitBlock) and previous.context == Context.PROCEDURE):
+            # Returning from a call continues the line of the call
+            procedure = self.main.call_stack[-1] if self.main.call_stack else self.main
+            previous = procedure.instruction_stack[procedure.instruction_pointer - 1]
+        # Line breakpoint stops once when the line is entered, not before every instruction of the line
+        same_line = previous is not None and previous.debug_index >= 0 and source_map.lines[previous.debug_index] == line
+        for number, point in self.points.items():
+            if not isinstance(point, Breakpoint) or point.line != line:
+                continue
+            if point.symbol is None and same_line:
+                continue
+            if point.symbol is not None and point.symbol != symbol:
+                continue
+            if point.condition is not None:
+                name, operator, number_value = point.condition
+                value = self.value(name)
+                if value is None or not OPERATORS[operator](value, number_value):
+                    continue
+            point.hits += 1
+            self.reason = f'#{number}: {point}'
+            return True
+        return False
+
+    def check_watchpoints(self) -> bool:
+        """Returns True if the value of a watched variable has changed"""
+        changed = False
+        for watchpoint in self.watchpoints:
+            value = self.variable(watchpoint.name)
+            if value != watchpoint.value:
+                number = next(number for number, point in self.points.items() if point is watchpoint)
+                watchpoint.hits += 1
+                self.reason = f"#{number}: '{watchpoint.name}' changed from {watchpoint.value} to {value}"
+                watchpoint.value = value
+                changed = True
+        return changed
+
+    def show(self):
+        """Clears the console once per stop and shows the position, the output and the state of the program"""
+        os.system('cls')
+        instruction = self.current()
+        print(f'[DEBUG]: stopped: {self.reason}')
+        if instruction.traceback is not None:
+            self.print_position(instruction)
+        print()
+        if self.main.streaming:
+            self.main.flush_stdout()
+        else:
+            self.print_output()
+        self.print_state()
+
+    def print_position(self, instruction: Instruction):
+        traceback = instruction.traceback
+        line, index = traceback.position
+        print(f'[DEBUG]: at line {line}, at symbol {index}')
+        print(f'[DEBUG]: in namespace {instruction.namespace}')
+        formatted_line = (
+            traceback.line[:index]
+            + Back.LIGHTGREEN_EX + Fore.BLACK + traceback.line[index] + Back.RESET + Fore.RESET
+            + traceback.line[index + 1:]
+        )
+        if line - 2 >= 0:
+            print(f'ln [ {line - 1} ]: ' + self.code[line - 2])
+        print(Fore.LIGHTGREEN_EX + f'ln [ {line} ]:' + Fore.RESET + ' ' + formatted_line)
+        if line < len(self.code):
+            print(f'ln [ {line + 1} ]: ' + self.code[line])
+        if isinstance(instruction, DefineProcedure):
+            print(f"[DEBUG]: DefineProcedure(namespace={instruction.namespace}, name_parameter='{instruction.name_parameter}', instruction_stack=<...>)")
+        else:
+            print(f'[DEBUG]: {instruction}')
+
+    def print_output(self):
+        print('== OUTPUT ==')
+        print(''.join(self.main.stdout))
+        print('=' * 12)
+
+    def print_state(self):
+        self.main.print_stack()
+        self.main.print_variables()
+        self.main.print_procedures()
+        if self.main.call_stack:
+            print('-- CALL STACK --')
+            for procedure in reversed(self.main.call_stack):
+                print(f'{procedure.name}{{...}}')
+            print()
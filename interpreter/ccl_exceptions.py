@@ -1,10 +1,32 @@
-from dataclasses import dataclass
+from __future__ import annotations
+from typing import Sequence
 
 
-@dataclass
 class CCLTraceback:
-    position: tuple[int, int]
-    line: str
+    """
+    Position (line, symbol) of an instruction in the source code.
+    Text of the line is either given, or looked up in 'source' (lines of the program) only when it is needed.
+    """
+    __slots__ = ('position', 'text', 'source')
+
+    def __init__(self, position: tuple[int, int], line: str | None = None, source: Sequence[str] | None = None):
+        self.position = position
+        self.text = line
+        self.source = source
+
+    @property
+    def line(self) -> str:
+        if self.text is None:
+            return self.source[self.position[0] - 1]
+        return self.text
+
+    def __repr__(self) -> str:
+        return f'CCLTraceback(position={self.position!r}, line={self.line!r})'
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CCLTraceback):
+            return NotImplemented
+        return self.position == other.position and self.line == other.line
 
 
 class CCLParseError(Exception):
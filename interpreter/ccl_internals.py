@@ -1,72 +1,28 @@
 from __future__ import annotations
 import os
+import sys
 from abc import ABC, abstractmethod
+from contextlib import contextmanager, redirect_stdout
 from dataclasses import dataclass
-from copy import copy, deepcopy
+from typing import Callable, ClassVar, TextIO
+from copy import copy
 from enum import Enum, StrEnum
 from click import getchar
-from ccl_exceptions import CCLRuntimeError, CCLExit, CCLTraceback
-
-
-class Cell:
-    _value = 0
-    _min = -32768
-    _max = 32767
-    def __init__(self, _value: int, /, *,
-                 min_value: int = -32768,
-                 max_value: int = 32767):
-        self._value = _value
-        self._min = min_value
-        self._max = max_value
-
-    def __setattr__(self, name, value):
-        if name != '_value':
-            self.__dict__[name] = value
-            return
-
-        if value > self._max:
-            self.__dict__[name] = self._min + (value - self._max - 1)
-        elif value < self._min:
-            self.__dict__[name] = self._max - (abs(value) + self._min - 1)
-        else:
-            self.__dict__[name] = value
-
-    def __repr__(self):
-        return f'[ {self._value} ]'
-
-    def __bool__(self):
-        return True
-
-    def __iadd__(self, other):
-        if not isinstance(other, (type(self), int)):
-            raise TypeError(f"Cannot use += between type '{type(self).__name__}' and type '{type(other).__name__}'")
+from colorama import Fore, Back
+from ccl_exceptions import CCLParseError, CCLRuntimeError, CCLExit, CCLTraceback
+from ccl_streams import StreamOutput, StreamInput
+from ccl_source import SourceMap
 
-        if isinstance(other, int):
-            self._value += other
-        else:
-            self._value += other._value
 
-        return self
+CELL_MIN = -32768
+CELL_MAX = 32767
+# Characters '<' can output by their code; \x03 and \r are output as a newline
+OUTPUT_CHARS = {code: ('\n' if code in (3, 13) else chr(code)) for code in (*range(32, 127), 3, 9, 10, 13)}
 
-    def __isub__(self, other):
-        if not isinstance(other, (type(self), int)):
-            raise TypeError(f"Cannot use -= between type '{type(self).__name__}' and type '{type(other).__name__}'")
 
-        if isinstance(other, int):
-            self._value -= other
-        else:
-            self._value -= other._value
-
-        return self
-
-    def __eq__(self, other):
-        if not isinstance(other, (type(self), int)):
-            raise TypeError(f"Cannot use == between type '{type(self).__name__}' and type '{type(other).__name__}'")
-
-        if isinstance(other, int):
-            return self._value == other
-        else:
-            return self._value == other._value
+def wrap(value: int) -> int:
+    """Wraps value into the 16-bit range of stack and variable values"""
+    return ((value + 32768) & 65535) - 32768
 
 
 class Context(Enum):
@@ -75,6 +31,23 @@ class Context(Enum):
     WHILE = 2
 
 
+class TraceEvent(StrEnum):
+    """
+    Events a tracer installed with MainProcedure.settrace() is called with, as tracer(event, instruction, argument):
+    INSTRUCTION before an instruction runs (argument is None), CALL and RETURN after a procedure is entered or left
+    (argument is the Procedure), OUTPUT after '<' has written a character (argument is the character)
+    and ERROR when an instruction fails (argument is the CCLRuntimeError, which is raised after the tracer returns)
+    """
+    INSTRUCTION = 'instruction'
+    CALL = 'call'
+    RETURN = 'return'
+    OUTPUT = 'output'
+    ERROR = 'error'
+
+
+Tracer = Callable[[TraceEvent, 'Instruction', object], None]
+
+
 class KeyIgnore(StrEnum):
     F1 = '\x00;'
     F2 = '\x00<'
@@ -106,111 +79,343 @@ class KeyIgnore(StrEnum):
     VSCODE_RIGHT = '\x00M'
 
 
+def read_char(name_parameter: str, traceback: CCLTraceback) -> str:
+    """Reads a single printable ASCII character from the console for the '>' instruction"""
+    print()
+    while True:
+        char = getchar()
+        if char in KeyIgnore:
+            continue
+        if len(char) > 1:
+            raise CCLRuntimeError(f"Instruction '>{name_parameter}': bad input provided; input must be a printable ASCII character", traceback=traceback)
+        if ord(char) not in range(32, 127) and ord(char) not in (3, 9, 10, 13):
+            raise CCLRuntimeError(f"Instruction '>{name_parameter}': bad input provided; input must be a printable ASCII character", traceback=traceback)
+        break
+
+    if ord(char) in (3, 10, 13):
+        char = '\n'
+    return char
+
+
+def print_error(Error: CCLParseError | CCLRuntimeError):
+    print(f'Error occurred at line {Error.traceback.position[0]}:')
+    err_index = Error.traceback.position[1]
+    formatted_line = (
+        Error.traceback.line[:err_index]
+        + Back.LIGHTRED_EX + Fore.BLACK + Error.traceback.line[err_index] + Back.RESET + Fore.RESET
+        + Error.traceback.line[err_index + 1:]
+    )
+    print(formatted_line)
+    print(f'{Error.__class__.__name__}: {Error}\n')
+    print(Fore.LIGHTRED_EX + 'Process finished with exit code 1\n' + Fore.RESET)
+
+
+@contextmanager
+def report_stream(main: MainProcedure | None):
+    """In streaming mode the final report goes to stderr, so that stdout only carries the output of the program"""
+    if main is None or not main.streaming:
+        yield
+        return
+    main.flush_stdout()
+    with redirect_stdout(sys.stderr):
+        yield
+
+
+class Variables:
+    """
+    Variables stored in slots, which are assigned to names by Resolver before the program runs.
+    Slot of an undefined variable holds None.
+    Can be read like a dict of defined variables, in the order they were defined.
+    """
+    __slots__ = ('names', 'indexes', 'slots', 'defined')
+
+    def __init__(self, names: list[str] | None = None, indexes: dict[str, int] | None = None):
+        self.names: list[str] = list() if names is None else names
+        self.indexes: dict[str, int] = {name: slot for slot, name in enumerate(self.names)} if indexes is None else indexes
+        self.slots: list[int | None] = [None] * len(self.names)
+        self.defined: dict[int, None] = dict()
+
+    def slot(self, name: str) -> int:
+        """Returns slot of the variable, a new slot is assigned to a name seen for the first time"""
+        if name not in self.indexes:
+            self.indexes[name] = len(self.names)
+            self.names.append(name)
+            self.slots.append(None)
+        return self.indexes[name]
+
+    def set(self, slot: int, value: int):
+        if self.slots[slot] is None:
+            self.defined[slot] = None
+        self.slots[slot] = value
+
+    def delete(self, slot: int):
+        self.slots[slot] = None
+        del self.defined[slot]
+
+    def clear(self):
+        self.slots[:] = [None] * len(self.slots)
+        self.defined.clear()
+
+    def fresh(self) -> Variables:
+        """Returns variables with the same names and no variable defined, names are shared, not copied"""
+        return Variables(self.names, self.indexes)
+
+    def copy(self) -> Variables:
+        variables = Variables(self.names, self.indexes)
+        variables.slots[:] = self.slots
+        variables.defined.update(self.defined)
+        return variables
+
+    def update(self, variables: dict[str, int]):
+        for name, value in variables.items():
+            self.set(self.slot(name), value)
+
+    def items(self) -> list[tuple[str, int]]:
+        return [(self.names[slot], self.slots[slot]) for slot in self.defined]
+
+    def __iter__(self):
+        return iter([self.names[slot] for slot in self.defined])
+
+    def __getitem__(self, name: str) -> int:
+        return self.slots[self.indexes[name]]
+
+    def __len__(self) -> int:
+        return len(self.defined)
+
+
+@dataclass(slots=True)
+class Frame:
+    """State of an activation of a procedure, which was put aside when the same procedure was called again"""
+    instruction_pointer: int
+    local_variables: Variables
+    loop_counters: list[int]
+
+
 class Procedure:
-    def __init__(self, name: str, global_namespace: MainProcedure):
+    """
+    Procedure is created once by DefineProcedure, and its instructions are bound to it once.
+    Its instruction_pointer, local_variables and loop_counters belong to the innermost activation;
+    a call saves them in a Frame on MainProcedure.frames, and a return restores them.
+    The caller keeps its own instruction_pointer, which points past the call, so it is the return address.
+    """
+    def __init__(self, name: str, global_namespace: MainProcedure, local_names: list[str], loop_depth: int, definition: int = -1):
         # Globals (imported from MainProcedure):
         self.stack = global_namespace.stack
         self.global_variables = global_namespace.global_variables
         self.defined_procedures = global_namespace.defined_procedures
         self.call_stack = global_namespace.call_stack
+        self.frames = global_namespace.frames
         self.stdout = global_namespace.stdout
-        self.debug_mode = global_namespace.debug_mode
+        self.flush_stdout = global_namespace.flush_stdout
+        self.flush_before_input = global_namespace.flush_before_input
+        self.read_char = global_namespace.read_char
+        self.source_map = global_namespace.source_map
         # Locals:
         self.name = name
-        self.local_variables: dict[str, Cell] | None = dict()
+        # Debug index of the DefineProcedure, which created the procedure
+        self.definition = definition
+        self.loop_depth = loop_depth
+        self.local_variables = Variables(local_names)
+        self.loop_counters: list[int] = [0] * loop_depth
         self.instruction_stack: list[Instruction] = list()
         self.instruction_pointer: int = 0
 
     def __repr__(self) -> str:
         return f"<Procedure '{self.name}'>"
 
+    def enter(self, self_call: bool):
+        """Starts a new activation. Recursive call starts with a copy of the local variables of its caller"""
+        self.frames.append(Frame(self.instruction_pointer, self.local_variables, self.loop_counters))
+        self.call_stack.append(self)
+        self.instruction_pointer = 0
+        # Procedure without '&' never writes its local variables, so all activations share the empty ones
+        if self.local_variables.names:
+            self.local_variables = self.local_variables.copy() if self_call else self.local_variables.fresh()
+        if self.loop_depth:
+            self.loop_counters = [0] * self.loop_depth
+
+    def leave(self):
+        frame = self.frames.pop()
+        self.call_stack.pop()
+        self.instruction_pointer = frame.instruction_pointer
+        self.local_variables = frame.local_variables
+        self.loop_counters = frame.loop_counters
+
     def next_instruction(self):
-        if self.debug_mode:
-            print(f'[DEBUG]: {self} instruction_pointer = {self.instruction_pointer}')
         self.instruction_stack[self.instruction_pointer].execute()
 
 
 class MainProcedure:
-    # Globals:
-    stack: list[Cell] = list()
-    global_variables: dict[str, Cell] = dict()
-    defined_procedures: dict[str, Procedure] = dict()
-    call_stack: list[Procedure] = list()
-    stdout: list[str] = list()
-    debug_mode: bool = False
-    # Locals:
-    stdout_buffer: list[str] = list()
-    instruction_stack: list[Instruction] = list()
-    locals_stack: list[dict[str, Cell]] = list()
-    instruction_pointer: int = 0
+    def __init__(self):
+        # Globals:
+        self.stack: list[int] = list()
+        self.global_variables: Variables = Variables()
+        self.defined_procedures: dict[str, Procedure] = dict()
+        self.call_stack: list[Procedure] = list()
+        self.frames: list[Frame] = list()
+        self.stdout: list[str] | StreamOutput = list()
+        # Output is written to a file as the program runs, instead of redrawing the console
+        self.streaming: bool = False
+        # Input is read from a file instead of the console, when it is not None
+        self.stdin: StreamInput | None = None
+        # Called on the events of TraceEvent while the program runs, see settrace()
+        self.tracer: Tracer | None = None
+        # Positions of instructions in the source code, see Instruction.debug_index
+        self.source_map: SourceMap = SourceMap()
+        # Locals:
+        self.stdout_buffer: list[str] = list()
+        self.instruction_stack: list[Instruction] = list()
+        self.loop_counters: list[int] = list()
+        self.instruction_pointer: int = 0
 
     def __repr__(self) -> str:
         return f"<Procedure 'MainProcedure'>"
 
     def next_instruction(self):
-        if len(self.call_stack) > 0:
-            try:
-                procedure = self.call_stack[-1]
-                instruction = procedure.instruction_stack[procedure.instruction_pointer]
-                if isinstance(instruction, CallProcedure):
-                    if instruction.name_parameter == procedure.name:
-                        self.locals_stack.append(
-                            deepcopy(procedure.local_variables)
-                        )
-                self.call_stack[-1].next_instruction()
-            except CCLExit:
-                self.call_stack[-1].local_variables.clear()
-                self.call_stack.pop()
-                if len(self.call_stack) > 0:
-                    self.call_stack[-1].instruction_pointer += 1
-                    if self.locals_stack:
-                        self.call_stack[-1].local_variables.update(self.locals_stack.pop())
-                        for instruction in self.call_stack[-1].instruction_stack:
-                            instruction.namespace = self.call_stack[-1]
+        if self.call_stack:
+            self.call_stack[-1].next_instruction()
             return
-
-        if self.debug_mode:
-            print(f'[DEBUG]: {self} instruction_pointer = {self.instruction_pointer}')
         self.instruction_stack[self.instruction_pointer].execute()
 
+    def settrace(self, tracer: Tracer | None):
+        """Installs the tracer for the next run(), or removes it if tracer is None"""
+        self.tracer = tracer
+
+    def run(self):
+        """
+        Runs the program until it exits (CCLExit is raised) or fails.
+        Without a tracer, the loop only dispatches instructions, so untraced programs do not pay for tracing
+        """
+        if self.tracer is not None:
+            self.run_traced()
+            return
+        call_stack = self.call_stack
+        if self.streaming:
+            while True:
+                procedure = call_stack[-1] if call_stack else self
+                procedure.instruction_stack[procedure.instruction_pointer].execute()
+        while True:
+            procedure = call_stack[-1] if call_stack else self
+            procedure.instruction_stack[procedure.instruction_pointer].execute()
+            self.print_stdout()
+
+    def run_traced(self):
+        """
+        Runs the program like run(), and calls the tracer around every instruction.
+        Calls and returns are found by changes of the call stack, so that instructions need no tracing code
+        """
+        tracer = self.tracer
+        call_stack = self.call_stack
+        console = not self.streaming
+        while True:
+            procedure = call_stack[-1] if call_stack else self
+            instruction = procedure.instruction_stack[procedure.instruction_pointer]
+            depth = len(call_stack)
+            tracer(TraceEvent.INSTRUCTION, instruction, None)
+            try:
+                instruction.execute()
+            except CCLRuntimeError as Error:
+                tracer(TraceEvent.ERROR, instruction, Error)
+                raise
+            if len(call_stack) < depth:
+                tracer(TraceEvent.RETURN, instruction, procedure)
+            elif len(call_stack) > depth:
+                tracer(TraceEvent.CALL, instruction, call_stack[-1])
+            elif call_stack and call_stack[-1] is not procedure:
+                # Tail call: the callee took over the activation of the caller
+                tracer(TraceEvent.RETURN, instruction, procedure)
+                tracer(TraceEvent.CALL, instruction, call_stack[-1])
+            elif type(instruction) is StdOut:
+                tracer(TraceEvent.OUTPUT, instruction, OUTPUT_CHARS[instruction.get_variable()])
+            if console:
+                self.print_stdout()
+
+    def stream_stdout(self, file: TextIO):
+        """Switches to streaming mode, must be called before the program runs"""
+        self.stdout = StreamOutput(file)
+        self.streaming = True
+
+    def stream_stdin(self, file: TextIO):
+        """Reads input from the file instead of the console, must be called before the program runs"""
+        self.stdin = StreamInput(file)
+
+    def open_standard_streams(self, stream_output: bool | None = None, input_file: TextIO | None = None):
+        """
+        Streams output to stdout when it is not a terminal, and reads input from stdin when it is not a terminal.
+        'stream_output' overrides the check of stdout, and 'input_file' is read instead of stdin
+        """
+        if stream_output or (stream_output is None and not sys.stdout.isatty()):
+            self.stream_stdout(sys.stdout)
+        if input_file is not None:
+            self.stream_stdin(input_file)
+        elif not sys.stdin.isatty():
+            self.stream_stdin(sys.stdin)
+
+    def read_char(self, name_parameter: str, traceback: CCLTraceback) -> str:
+        """Reads a character for the '>' instruction. Characters typed on the console are echoed into the output"""
+        if self.stdin is not None:
+            return self.stdin.read_char(name_parameter, traceback)
+        char = read_char(name_parameter, traceback)
+        self.stdout.append(char)
+        return char
+
+    def flush_before_input(self):
+        """Shows the output before '>' waits for a keypress; input from a file does not wait, so output stays buffered"""
+        if self.stdin is None:
+            self.flush_stdout()
+
     def print_stdout(self):
-        if self.debug_mode:
-            print('== OUTPUT ==')
-            print(''.join(self.stdout))
-            print('=' * 12)
-        else:
-            if self.stdout == self.stdout_buffer:
-                return
-            main_instruction = self.instruction_stack[self.instruction_pointer]
-            if not self.call_stack and isinstance(main_instruction, (StdIn, ExitBlock, EndProcedure)):
-                if isinstance(main_instruction, ExitBlock):
-                    if main_instruction.context != Context.PROCEDURE:
-                        return
-                os.system('cls')
-                print(''.join(self.stdout), end='')
-                self.stdout_buffer = copy(self.stdout)
-            if self.call_stack:
-                procedure = self.call_stack[-1]
-                procedure_instruction = procedure.instruction_stack[procedure.instruction_pointer]
-                if isinstance(procedure_instruction, StdIn):
-                    os.system('cls')
-                    print(''.join(self.stdout), end='')
-                    self.stdout_buffer = copy(self.stdout)
+        if self.streaming:
+            self.stdout.flush()
+            return
+        if self.stdout == self.stdout_buffer:
+            return
+        main_instruction = self.instruction_stack[self.instruction_pointer]
+        if not self.call_stack and isinstance(main_instruction, (StdIn, ExitBlock, EndProcedure)):
+            if isinstance(main_instruction, ExitBlock):
+                if main_instruction.context != Context.PROCEDURE:
+                    return
+            self.flush_stdout()
+        if self.call_stack:
+            procedure = self.call_stack[-1]
+            procedure_instruction = procedure.instruction_stack[procedure.instruction_pointer]
+            if isinstance(procedure_instruction, StdIn):
+                self.flush_stdout()
+
+    def flush_stdout(self):
+        """Redraws the console with the whole output, if it has changed since the last redraw"""
+        if self.streaming:
+            self.stdout.flush()
+            return
+        if self.stdout == self.stdout_buffer:
+            return
+        os.system('cls')
+        print(''.join(self.stdout), end='')
+        self.stdout_buffer = copy(self.stdout)
+
+    def load_state(self, stack: list[int], global_variables: dict[str, int], defined_procedures: dict[str, object]):
+        """Replaces program state with the final state of another engine, so that debug() can print it"""
+        self.stack[:] = stack
+        self.global_variables.clear()
+        self.global_variables.update(global_variables)
+        self.defined_procedures.clear()
+        self.defined_procedures.update(defined_procedures)
+        self.instruction_pointer = len(self.instruction_stack) - 1
 
     def print_stack(self):
         print('-- STACK --')
-        for cell in reversed(self.stack):
-            print(cell)
+        for value in reversed(self.stack):
+            print(f'[ {value} ]')
         print()
 
     def print_variables(self):
         print('-- VARIABLES --')
         for name in self.global_variables:
-            print(f'GLOBAL {name} = {self.global_variables[name]._value}')
+            print(f'GLOBAL {name} = {self.global_variables[name]}')
 
         if len(self.call_stack) > 0:
             for name in self.call_stack[-1].local_variables:
-                print(f'LOCAL {self.call_stack[-1].name}::{name} = {self.call_stack[-1].local_variables[name]._value}')
+                print(f'LOCAL {self.call_stack[-1].name}::{name} = {self.call_stack[-1].local_variables[name]}')
         print()
 
     def print_procedures(self):
@@ -229,29 +434,54 @@ class MainProcedure:
 @dataclass
 class Instruction(ABC):
     namespace: MainProcedure | Procedure | None
-    traceback: CCLTraceback
-
-    def get_global_variable(self, name: str) -> Cell | None:
-        if name not in self.namespace.global_variables:
-            return None
-
-        return self.namespace.global_variables[name]
-
-    def get_local_variable(self, name: str) -> Cell | None:
-        if not isinstance(self.namespace, Procedure):
-            return None
-
-        if name not in self.namespace.local_variables:
-            return None
-
-        return self.namespace.local_variables[name]
+    # Index of the position of the instruction in MainProcedure.source_map, -1 if it has none
+    debug_index: int
+
+    # Slots of the variable 'name_parameter', assigned by Resolver.
+    # local_slot is -1 when the name is never created with '&' in the procedure, so it is always global.
+    slot: ClassVar[int] = -1
+    local_slot: ClassVar[int] = -1
+
+    @property
+    def traceback(self) -> CCLTraceback | None:
+        """Position of the instruction; looked up only when an error is reported, so instructions stay small"""
+        return self.namespace.source_map.traceback(self.debug_index)
+
+    def __getstate__(self) -> dict:
+        """
+        Instructions are pickled without namespace, which would drag the whole program and its source code along;
+        unpickled instructions are bound to a namespace again before they run
+        """
+        state = self.__dict__.copy()
+        state['namespace'] = None
+        return state
+
+    def get_variable(self) -> int | None:
+        """Returns local variable if it exists, otherwise global variable, or None if both are undefined"""
+        if self.local_slot >= 0:
+            value = self.namespace.local_variables.slots[self.local_slot]
+            if value is not None:
+                return value
+        return self.namespace.global_variables.slots[self.slot]
+
+    def lookup(self, slot: int, local_slot: int) -> int | None:
+        """Same as get_variable(), for instructions which refer to more than one variable"""
+        if local_slot >= 0:
+            value = self.namespace.local_variables.slots[local_slot]
+            if value is not None:
+                return value
+        return self.namespace.global_variables.slots[slot]
+
+    def set_variable(self, value: int):
+        """Sets local variable if it exists, otherwise sets global variable"""
+        if self.local_slot >= 0 and self.namespace.local_variables.slots[self.local_slot] is not None:
+            self.namespace.local_variables.slots[self.local_slot] = value
+            return
+        self.namespace.global_variables.set(self.slot, value)
 
     def execute(self):
         self.callback()
         self.namespace.instruction_pointer += 1
-        if self.namespace.debug_mode:
-            print(f'[DEBUG]: Instruction.execute() {id(self.namespace) = }, {self.namespace.instruction_pointer = }')
-            print()
 
     @abstractmethod
     def callback(self):
@@ -262,25 +492,41 @@ class Instruction(ABC):
 class DefineProcedure(Instruction):
     name_parameter: str
     instruction_stack: list[Instruction]
-    end_traceback: CCLTraceback
+    end_debug_index: int
+    # Names created with '&' within the procedure, assigned by Resolver
+    local_names: ClassVar[list[str]] = list()
+    # Deepest nesting of REPEAT blocks within the procedure, assigned by Resolver
+    loop_depth: ClassVar[int] = 0
 
     def callback(self):
-        procedure = Procedure(name=self.name_parameter, global_namespace=self.namespace)
+        self.namespace.defined_procedures[self.name_parameter] = self.create(self.namespace)
+
+    def create(self, global_namespace: MainProcedure | Procedure) -> Procedure:
+        procedure = Procedure(name=self.name_parameter, global_namespace=global_namespace,
+                              local_names=self.local_names, loop_depth=self.loop_depth, definition=self.debug_index)
 
-        for instruction in deepcopy(self.instruction_stack):
+        # Instructions never change while the program runs, except for their namespace, so a shallow copy is enough.
+        # Positions are debug indexes, and bodies of nested procedures are copied when those are defined
+        for instruction in self.instruction_stack:
+            instruction = copy(instruction)
             instruction.namespace = procedure
             procedure.instruction_stack.append(instruction)
 
         procedure.instruction_stack.append(
-            EndProcedure(namespace=procedure, traceback=self.end_traceback)
+            EndProcedure(namespace=procedure, debug_index=self.end_debug_index)
         )
-
-        self.namespace.defined_procedures[self.name_parameter] = procedure
+        return procedure
 
 
 @dataclass
 class CallProcedure(Instruction):
     name_parameter: str
+    # Procedure returns right after the call, assigned by Resolver
+    tail_call: ClassVar[bool] = False
+
+    def execute(self):
+        # Instruction pointer of the caller is moved to the return address before the call, since a recursive call replaces it
+        self.callback()
 
     def callback(self):
         if self.name_parameter is None:
@@ -289,24 +535,25 @@ class CallProcedure(Instruction):
         if self.name_parameter not in self.namespace.defined_procedures:
             raise CCLRuntimeError(f"Instruction '@{self.name_parameter}': procedure '{self.name_parameter}' is undefined", traceback=self.traceback)
 
-        self.namespace.call_stack.append(
-            copy(
-                self.namespace.defined_procedures[self.name_parameter]
-            )
-        )
-        for instruction in self.namespace.call_stack[-1].instruction_stack:
-            instruction.namespace = self.namespace.call_stack[-1]
+        procedure = self.namespace.defined_procedures[self.name_parameter]
+        if self.tail_call:
+            # Caller would return right after the callee does, so the callee takes over the activation of the caller.
+            # Recursive call would start with a copy of local variables the caller no longer needs, so it keeps them
+            if procedure is self.namespace:
+                procedure.instruction_pointer = 0
+                return
+            self.namespace.leave()
+            procedure.enter(self_call=False)
+            return
 
-        if isinstance(self.namespace, Procedure):
-            self.namespace.instruction_pointer -= 1
+        self.namespace.instruction_pointer += 1
+        procedure.enter(self_call=procedure is self.namespace)
 
 
 @dataclass
 class PushZero(Instruction):
     def callback(self):
-        self.namespace.stack.append(
-            Cell(0)
-        )
+        self.namespace.stack.append(0)
 
 
 @dataclass
@@ -322,11 +569,7 @@ class Assign(Instruction):
         if self.name_parameter is None:
             return
 
-        if self.get_local_variable(self.name_parameter):
-            self.namespace.local_variables[self.name_parameter] = value
-            return
-
-        self.namespace.global_variables[self.name_parameter] = value
+        self.set_variable(value)
 
 
 @dataclass
@@ -337,12 +580,12 @@ class Delete(Instruction):
         if self.name_parameter is None:
             raise CCLRuntimeError(f"Instruction '!_': name must be provided and cannot be '_'", traceback=self.traceback)
 
-        if self.get_local_variable(self.name_parameter):
-            self.namespace.local_variables.pop(self.name_parameter)
+        if self.local_slot >= 0 and self.namespace.local_variables.slots[self.local_slot] is not None:
+            self.namespace.local_variables.delete(self.local_slot)
             return
 
-        if self.get_global_variable(self.name_parameter):
-            self.namespace.global_variables.pop(self.name_parameter)
+        if self.namespace.global_variables.slots[self.slot] is not None:
+            self.namespace.global_variables.delete(self.slot)
             return
 
         raise CCLRuntimeError(f"Instruction '!{self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
@@ -359,7 +602,7 @@ class CreateLocal(Instruction):
         if not isinstance(self.namespace, Procedure):
             raise CCLRuntimeError(f"Instruction '&{self.name_parameter}': cannot create local variable outside of procedure", traceback=self.traceback)
 
-        self.namespace.local_variables[self.name_parameter] = Cell(0)
+        self.namespace.local_variables.set(self.local_slot, 0)
 
 
 @dataclass
@@ -370,15 +613,11 @@ class PushVariable(Instruction):
         if self.name_parameter is None:
             raise CCLRuntimeError(f"Instruction '$_': name must be provided and cannot be '_'", traceback=self.traceback)
 
-        value = self.get_local_variable(self.name_parameter)
-        if not value:
-            value = self.get_global_variable(self.name_parameter)
-        if not value:
+        value = self.get_variable()
+        if value is None:
             raise CCLRuntimeError(f"Instruction '${self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
     
-        self.namespace.stack.append(
-            copy(value)
-        )
+        self.namespace.stack.append(value)
 
 
 @dataclass
@@ -387,7 +626,8 @@ class Add(Instruction):
         if not self.namespace.stack:
             raise CCLRuntimeError("Instruction '+': cannot add to an empty stack", traceback=self.traceback)
 
-        self.namespace.stack[-1] += 1
+        value = self.namespace.stack[-1]
+        self.namespace.stack[-1] = CELL_MIN if value == CELL_MAX else value + 1
 
 
 @dataclass
@@ -396,7 +636,8 @@ class Subtract(Instruction):
         if not self.namespace.stack:
             raise CCLRuntimeError("Instruction '-': cannot subtract from an empty stack", traceback=self.traceback)
 
-        self.namespace.stack[-1] -= 1
+        value = self.namespace.stack[-1]
+        self.namespace.stack[-1] = CELL_MAX if value == CELL_MIN else value - 1
 
 
 @dataclass
@@ -406,12 +647,7 @@ class PopAdd(Instruction):
             raise CCLRuntimeError(f"Instruction '*': not enough elements on the stack ({len(self.namespace.stack)}); at least 2 required", traceback=self.traceback)
 
         top_value = self.namespace.stack.pop()
-        next_value = self.namespace.stack.pop()
-        next_value += top_value
-
-        self.namespace.stack.append(
-            next_value
-        )
+        self.namespace.stack[-1] = wrap(self.namespace.stack[-1] + top_value)
 
 
 @dataclass
@@ -421,12 +657,71 @@ class PopSubtract(Instruction):
             raise CCLRuntimeError(f"Instruction '~': not enough elements on the stack ({len(self.namespace.stack)}); at least 2 required", traceback=self.traceback)
 
         top_value = self.namespace.stack.pop()
-        next_value = self.namespace.stack.pop()
-        next_value -= top_value
+        self.namespace.stack[-1] = wrap(self.namespace.stack[-1] - top_value)
+
+
+@dataclass
+class PushConstant(Instruction):
+    """'^' followed by a run of '+' and '-', folded by the optimizer"""
+    value: int
+
+    def callback(self):
+        self.namespace.stack.append(self.value)
+
+
+@dataclass
+class AddConstant(Instruction):
+    """Run of '+' and '-', folded by the optimizer. 'symbol' is the first instruction of the run"""
+    amount: int
+    symbol: str
+
+    def callback(self):
+        if not self.namespace.stack:
+            if self.symbol == '+':
+                raise CCLRuntimeError("Instruction '+': cannot add to an empty stack", traceback=self.traceback)
+            raise CCLRuntimeError("Instruction '-': cannot subtract from an empty stack", traceback=self.traceback)
+
+        self.namespace.stack[-1] = wrap(self.namespace.stack[-1] + self.amount)
 
-        self.namespace.stack.append(
-            next_value
-        )
+
+@dataclass
+class AddVariable(Instruction):
+    """'$x' followed by '*', fused by the optimizer. 'operation_debug_index' is the debug index of '*'"""
+    name_parameter: str
+    operation_debug_index: int
+
+    @property
+    def operation_traceback(self) -> CCLTraceback | None:
+        return self.namespace.source_map.traceback(self.operation_debug_index)
+
+    def get_value(self) -> int:
+        if self.name_parameter is None:
+            raise CCLRuntimeError(f"Instruction '$_': name must be provided and cannot be '_'", traceback=self.traceback)
+
+        value = self.get_variable()
+        if value is None:
+            raise CCLRuntimeError(f"Instruction '${self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
+        return value
+
+    def callback(self):
+        value = self.get_value()
+        if not self.namespace.stack:
+            self.namespace.stack.append(value)
+            raise CCLRuntimeError(f"Instruction '*': not enough elements on the stack (1); at least 2 required", traceback=self.operation_traceback)
+
+        self.namespace.stack[-1] = wrap(self.namespace.stack[-1] + value)
+
+
+@dataclass
+class SubtractVariable(AddVariable):
+    """'$x' followed by '~', fused by the optimizer. 'operation_debug_index' is the debug index of '~'"""
+    def callback(self):
+        value = self.get_value()
+        if not self.namespace.stack:
+            self.namespace.stack.append(value)
+            raise CCLRuntimeError(f"Instruction '~': not enough elements on the stack (1); at least 2 required", traceback=self.operation_traceback)
+
+        self.namespace.stack[-1] = wrap(self.namespace.stack[-1] - value)
 
 
 @dataclass
@@ -438,12 +733,9 @@ class Reverse(Instruction):
             self.namespace.stack.reverse()
             return
 
-        cell = self.get_local_variable(self.name_parameter)
-        if not cell:
-            cell = self.get_global_variable(self.name_parameter)
-        if not cell:
+        amount = self.get_variable()
+        if amount is None:
             raise CCLRuntimeError(f"Instruction '%{self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
-        amount = cell._value
 
         if len(self.namespace.stack) < amount:
             raise CCLRuntimeError(f"Instruction '%{self.name_parameter}': parameter ('{self.name_parameter}' = {amount}) exceeds length of the stack ({len(self.namespace.stack)})", traceback=self.traceback)
@@ -467,20 +759,16 @@ class StdOut(Instruction):
         if self.name_parameter is None:
             raise CCLRuntimeError(f"Instruction '<_': name must be provided and cannot be '_'", traceback=self.traceback)
 
-        cell = self.get_local_variable(self.name_parameter)
-        if not cell:
-            cell = self.get_global_variable(self.name_parameter)
-        if not cell:
+        char = self.get_variable()
+        if char is None:
             raise CCLRuntimeError(f"Instruction '<{self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
-        char = cell._value
 
-        if char not in range(32, 127) and char not in (3, 9, 10, 13):
+        if char not in OUTPUT_CHARS:
             raise CCLRuntimeError(f"Instruction '<{self.name_parameter}': character with code {char} is not a printable ASCII character", traceback=self.traceback)
 
         # <Enter> keypress returns code 13 (\r, carriage return) which is supposed to be code 10 (\n, line feed)
         # And sometimes it returns code 3 (\EOT, end of text)...
-        char = 10 if char in (3, 13) else char
-        self.namespace.stdout += chr(char)
+        self.namespace.stdout.append(OUTPUT_CHARS[char])
 
 
 @dataclass
@@ -491,30 +779,12 @@ class StdIn(Instruction):
         if self.name_parameter is None:
             raise CCLRuntimeError(f"Instruction '>_': name must be provided and cannot be '_'", traceback=self.traceback)
 
-        cell_local = self.get_local_variable(self.name_parameter)
-        cell_global = self.get_global_variable(self.name_parameter)
-
-        if not cell_global and not cell_local:
+        if self.get_variable() is None:
             raise CCLRuntimeError(f"Instruction '>{self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
 
-        print()
-        while True:
-            char = getchar()
-            if char in KeyIgnore:
-                continue
-            if len(char) > 1:
-                raise CCLRuntimeError(f"Instruction '>{self.name_parameter}': bad input provided; input must be a printable ASCII character", traceback=self.traceback)
-            if ord(char) not in range(32, 127) and ord(char) not in (3, 9, 10, 13):
-                raise CCLRuntimeError(f"Instruction '>{self.name_parameter}': bad input provided; input must be a printable ASCII character", traceback=self.traceback)
-            break
-
-        if ord(char) in (3, 10, 13):
-            char = '\n'
-        self.namespace.stdout += char
-        if cell_local:
-            self.namespace.local_variables[self.name_parameter] = Cell(ord(char))
-            return
-        self.namespace.global_variables[self.name_parameter] = Cell(ord(char))
+        self.namespace.flush_before_input()
+        char = self.namespace.read_char(self.name_parameter, self.traceback)
+        self.set_variable(ord(char))
 
 
 @dataclass
@@ -529,12 +799,9 @@ class StartCompare(Instruction):
         if not self.namespace.stack:
             raise CCLRuntimeError("Instruction '?': cannot compare with an empty stack", traceback=self.traceback)
 
-        cell = self.get_local_variable(self.name_parameter)
-        if not cell:
-            cell = self.get_global_variable(self.name_parameter)
-        if not cell:
+        variable = self.get_variable()
+        if variable is None:
             raise CCLRuntimeError(f"Instruction '?{self.name_parameter}': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
-        variable = cell._value
 
         if variable != self.namespace.stack[-1]:
             self.namespace.instruction_pointer = self.jump_address
@@ -545,14 +812,13 @@ class StartRepeat(Instruction):
     name_parameter: str
     jump_address: int
     uid: int
+    # Index of the counter in loop_counters of the procedure (nesting level of the block), assigned by Resolver
+    counter_index: ClassVar[int] = -1
 
     def callback(self):
-        cell = self.get_local_variable(self.name_parameter)
-        if not cell:
-            cell = self.get_global_variable(self.name_parameter)
-        if not cell:
+        amount = self.get_variable()
+        if amount is None:
             raise CCLRuntimeError(f"Instruction '{self.name_parameter}[...]': variable '{self.name_parameter}' is undefined", traceback=self.traceback)
-        amount = cell._value
 
         if amount < 0:
             raise CCLRuntimeError(f"Instruction '{self.name_parameter}[...]': parameter ('{self.name_parameter}' = {amount}) cannot be less than 0", traceback=self.traceback)
@@ -561,7 +827,7 @@ class StartRepeat(Instruction):
             self.namespace.instruction_pointer = self.jump_address
             return
 
-        self.namespace.global_variables[f'__repeat{self.uid}__'] = Cell(amount)
+        self.namespace.loop_counters[self.counter_index] = amount
         self.namespace.instruction_pointer = self.jump_address - 1
 
 
@@ -569,14 +835,85 @@ class StartRepeat(Instruction):
 class EndRepeat(Instruction):
     jump_address: int
     uid: int
+    counter_index: ClassVar[int] = -1
+
+    def callback(self):
+        counters = self.namespace.loop_counters
+        if counters[self.counter_index] == 0:
+            return
+
+        counters[self.counter_index] -= 1
+        self.namespace.instruction_pointer = self.jump_address
+
+
+@dataclass
+class LoopIdiom(Instruction):
+    """
+    Inserted by the optimizer right before a loop, which it computes in closed form.
+    On success jumps past the loop; if the result cannot be computed safely
+    (undefined variable, empty stack, ...), falls through into the loop, which then reports the error.
+    'jump_address' is the index of the last instruction of the loop.
+    """
+    jump_address: int
+
+
+@dataclass
+class MultiplyAdd(LoopIdiom):
+    """
+    'n[...]' whose body only adds constants and variables to the top of the stack.
+    Every iteration adds 'constant' and sign * value of every (sign, name) in 'variables'.
+    """
+    name_parameter: str
+    constant: int
+    variables: list[tuple[int, str | None]]
+    # (sign, slot, local slot) for every variable, assigned by Resolver; slot is -1 for '_'
+    variable_slots: ClassVar[list[tuple[int, int, int]]] = list()
+
+    def callback(self):
+        amount = self.get_variable()
+        if amount is None or amount < 0:
+            return
+
+        if amount > 0:
+            if not self.namespace.stack:
+                return
+            delta = self.constant
+            for sign, slot, local_slot in self.variable_slots:
+                value = self.lookup(slot, local_slot) if slot >= 0 else None
+                if value is None:
+                    return
+                delta += sign * value
+            self.namespace.stack[-1] = wrap(self.namespace.stack[-1] + amount * delta)
+
+        self.namespace.instruction_pointer = self.jump_address
+
+
+@dataclass
+class RepeatPush(LoopIdiom):
+    """'n[...]' whose body only pushes constants"""
+    name_parameter: str
+    values: list[int]
+
+    def callback(self):
+        amount = self.get_variable()
+        if amount is None or amount < 0:
+            return
+
+        self.namespace.stack.extend(self.values * amount)
+        self.namespace.instruction_pointer = self.jump_address
+
+
+@dataclass
+class SetToVariable(LoopIdiom):
+    """'(?x#; ...)' whose body only adds an odd constant to the top of the stack, so it always ends with top equal to x"""
+    name_parameter: str
 
     def callback(self):
-        counter = self.namespace.global_variables[f'__repeat{self.uid}__']
-        if counter == 0:
-            self.namespace.global_variables.pop(f'__repeat{self.uid}__')
+        value = self.get_variable()
+        if value is None or not self.namespace.stack:
             return
 
-        counter -= 1
+        self.namespace.stack[-1] = value
         self.namespace.instruction_pointer = self.jump_address
 
 
@@ -600,13 +937,21 @@ class ExitBlock(Instruction):
     jump_address: int
     uid: int
 
+    def execute(self):
+        if self.context == Context.PROCEDURE:
+            # Caller resumes at its own instruction pointer
+            self.callback()
+            return
+        super().execute()
+
     def callback(self):
         if self.context == Context.PROCEDURE:
+            if isinstance(self.namespace, Procedure):
+                self.namespace.leave()
+                return
             raise CCLExit
 
-        if self.context == Context.REPEAT:
-            self.namespace.global_variables.pop(f'__repeat{self.uid}__')
-
+        # Counter of a REPEAT block is simply left behind, StartRepeat overwrites it on the next entry
         self.namespace.instruction_pointer = self.jump_address
 
 
@@ -635,5 +980,12 @@ class EndCompare(Instruction):
 
 @dataclass
 class EndProcedure(Instruction):
+    def execute(self):
+        # Caller resumes at its own instruction pointer
+        self.callback()
+
     def callback(self):
+        if isinstance(self.namespace, Procedure):
+            self.namespace.leave()
+            return
         raise CCLExit
@@ -0,0 +1,173 @@
+from __future__ import annotations
+from typing import Callable
+from ccl_internals import (Context, MainProcedure, Instruction, DefineProcedure,
+                           Add, Subtract, PopAdd, PopSubtract, PushZero, PushVariable,
+                           PushConstant, AddConstant, AddVariable, SubtractVariable,
+                           StartCompare, EndCompare, StartRepeat, StartWhile, EndWhile, ExitBlock,
+                           MultiplyAdd, RepeatPush, SetToVariable, wrap)
+from ccl_resolver import Resolver
+
+# Step of a rewrite: returns (new instructions, amount of original instructions they replace)
+Rewrite = Callable[[list[Instruction], int], tuple[list[Instruction], int]]
+
+
+class Optimizer:
+    """
+    Optimizer, which rewrites instruction stacks produced by Parser.parse().
+
+    Peephole pass: runs of '+' and '-' become AddConstant, '^' followed by such a run becomes PushConstant,
+    '$x *' and '$x ~' become AddVariable and SubtractVariable.
+
+    Loop pass: REPEAT and WHILE blocks, which only change the top of the stack, get a LoopIdiom
+    instruction in front of them, which computes the whole loop at once and jumps past it.
+
+    Only instructions without jump targets are replaced, so every jump address is remapped
+    to the new index of the same block instruction.
+    """
+    def __init__(self, main: MainProcedure):
+        self.main = main
+
+    def optimize(self) -> MainProcedure:
+        self.main.instruction_stack[:] = self.optimize_block(self.main.instruction_stack)
+        # New instructions have no slots yet
+        return Resolver(self.main).resolve()
+
+    def optimize_block(self, instruction_stack: list[Instruction]) -> list[Instruction]:
+        instruction_stack = self.rewrite(instruction_stack, self.fold)
+        return self.rewrite(instruction_stack, self.recognize_loop)
+
+    def rewrite(self, instruction_stack: list[Instruction], step: Rewrite) -> list[Instruction]:
+        """Applies 'step' at every address; replaced instructions are mapped to the last new instruction"""
+        rewritten = list()
+        # New index of every instruction in the old instruction stack
+        addresses = list()
+
+        address = 0
+        while address < len(instruction_stack):
+            instructions, length = step(instruction_stack, address)
+            rewritten.extend(instructions)
+            addresses.extend([len(rewritten) - 1] * length)
+            address += length
+
+        for instruction in rewritten:
+            jump_address = getattr(instruction, 'jump_address', None)
+            if jump_address is not None and jump_address >= 0:
+                instruction.jump_address = addresses[jump_address]
+        return rewritten
+
+    def count_increments(self, instruction_stack: list[Instruction], address: int) -> tuple[int, int]:
+        """Returns (amount, length) of the run of '+' and '-' that starts at 'address'"""
+        amount = 0
+        end = address
+        while end < len(instruction_stack):
+            if isinstance(instruction_stack[end], Add):
+                amount += 1
+            elif isinstance(instruction_stack[end], Subtract):
+                amount -= 1
+            else:
+                break
+            end += 1
+        return wrap(amount), end - address
+
+    def fold(self, instruction_stack: list[Instruction], address: int) -> tuple[list[Instruction], int]:
+        instruction = instruction_stack[address]
+        next_instruction = instruction_stack[address + 1] if address + 1 < len(instruction_stack) else None
+
+        if isinstance(instruction, DefineProcedure):
+            instruction.instruction_stack = self.optimize_block(instruction.instruction_stack)
+
+        if isinstance(instruction, PushZero):
+            value, length = self.count_increments(instruction_stack, address + 1)
+            if length:
+                return [PushConstant(namespace=instruction.namespace, debug_index=instruction.debug_index, value=value)], length + 1
+
+        if isinstance(instruction, (Add, Subtract)):
+            amount, length = self.count_increments(instruction_stack, address)
+            if length > 1:
+                symbol = '+' if isinstance(instruction, Add) else '-'
+                return [AddConstant(namespace=instruction.namespace, debug_index=instruction.debug_index, amount=amount, symbol=symbol)], length
+
+        if isinstance(instruction, PushVariable) and isinstance(next_instruction, (PopAdd, PopSubtract)):
+            fused = AddVariable if isinstance(next_instruction, PopAdd) else SubtractVariable
+            return [fused(namespace=instruction.namespace, debug_index=instruction.debug_index,
+                          name_parameter=instruction.name_parameter, operation_debug_index=next_instruction.debug_index)], 2
+
+        return [instruction], 1
+
+    def recognize_loop(self, instruction_stack: list[Instruction], address: int) -> tuple[list[Instruction], int]:
+        instruction = instruction_stack[address]
+
+        if isinstance(instruction, StartRepeat):
+            body = instruction_stack[address + 1:instruction.jump_address]
+            idiom = self.recognize_multiply_add(instruction, body) or self.recognize_repeat_push(instruction, body)
+            if idiom:
+                return [idiom, instruction], 1
+
+        if isinstance(instruction, StartWhile):
+            if idiom := self.recognize_set_to_variable(instruction_stack, address):
+                return [idiom, instruction], 1
+
+        return [instruction], 1
+
+    def recognize_multiply_add(self, instruction: StartRepeat, body: list[Instruction]) -> MultiplyAdd | None:
+        """'n[...]' where the body only adds constants and variables to the top of the stack"""
+        if not body:
+            return None
+        constant = 0
+        variables = list()
+        for body_instruction in body:
+            if isinstance(body_instruction, Add):
+                constant += 1
+            elif isinstance(body_instruction, Subtract):
+                constant -= 1
+            elif isinstance(body_instruction, AddConstant):
+                constant += body_instruction.amount
+            elif isinstance(body_instruction, SubtractVariable):
+                variables.append((-1, body_instruction.name_parameter))
+            elif isinstance(body_instruction, AddVariable):
+                variables.append((1, body_instruction.name_parameter))
+            else:
+                return None
+        return MultiplyAdd(namespace=instruction.namespace, debug_index=instruction.debug_index, jump_address=instruction.jump_address,
+                           name_parameter=instruction.name_parameter, constant=wrap(constant), variables=variables)
+
+    def recognize_repeat_push(self, instruction: StartRepeat, body: list[Instruction]) -> RepeatPush | None:
+        """'n[...]' where the body only pushes constants"""
+        if not body:
+            return None
+        values = list()
+        for body_instruction in body:
+            if isinstance(body_instruction, PushZero):
+                values.append(0)
+            elif isinstance(body_instruction, PushConstant):
+                values.append(body_instruction.value)
+            else:
+                return None
+        return RepeatPush(namespace=instruction.namespace, debug_index=instruction.debug_index, jump_address=instruction.jump_address,
+                          name_parameter=instruction.name_parameter, values=values)
+
+    def recognize_set_to_variable(self, instruction_stack: list[Instruction], address: int) -> SetToVariable | None:
+        """
+        '(?x#; ...)' where the body only adds a constant to the top of the stack.
+        Constant must be odd: then the top reaches every 16-bit value, so the loop always ends
+        with the top equal to 'x'; with an even constant the loop might never end.
+        """
+        block = instruction_stack[address:address + 6]
+        if len(block) < 6:
+            return None
+        start_while, compare, exit_block, end_compare, step, end_while = block
+        if not (isinstance(compare, StartCompare) and compare.jump_address == address + 3
+                and isinstance(exit_block, ExitBlock) and exit_block.context == Context.WHILE
+                and isinstance(end_compare, EndCompare)
+                and isinstance(end_while, EndWhile) and end_while.jump_address == address):
+            return None
+        if isinstance(step, (Add, Subtract)):
+            amount = 1
+        elif isinstance(step, AddConstant):
+            amount = step.amount
+        else:
+            return None
+        if amount % 2 == 0:
+            return None
+        return SetToVariable(namespace=start_while.namespace, debug_index=start_while.debug_index, jump_address=address + 5,
+                             name_parameter=compare.name_parameter)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import time
+from colorama import Fore
+from ccl_internals import MainProcedure, Procedure, Instruction, TraceEvent
+
+# Amount of source positions shown in the hot-spot report
+HOT_SPOTS = 20
+# Share of total time, from which a line of the heatmap is colored red or yellow
+HOT_SHARE = 0.10
+WARM_SHARE = 0.01
+
+
+class InstructionRecord:
+    __slots__ = ('procedure', 'instruction', 'count', 'time')
+
+    def __init__(self, procedure: str, instruction: Instruction):
+        self.procedure = procedure
+        self.instruction = instruction
+        self.count = 0
+        # Nanoseconds spent in the instruction itself; a call does not include the time of the called procedure
+        self.time = 0
+
+
+class Profiler:
+    """
+    Profiler of the default engine, built on the tracer of MainProcedure: counts executions and time of every instruction object.
+    Time of an instruction lasts until the next instruction starts, so a call does not include the time of the called procedure.
+    Records are grouped by instruction class, procedure and source position only when the report is printed,
+    so the tracer does a dict lookup and one clock read per instruction.
+    """
+    def __init__(self, main: MainProcedure, code: list[str]):
+        self.main = main
+        self.code = code
+        self.records: dict[int, InstructionRecord] = dict()
+        self.calls: dict[str, int] = dict()
+        self.record: InstructionRecord | None = None
+        self.start = 0
+        self.total_time = 0
+        self.measured_time = 0
+
+    def run(self):
+        """Runs the program until it exits (CCLExit is raised) or fails; records are kept in both cases"""
+        self.main.settrace(self.trace)
+        start_time = time.perf_counter_ns()
+        try:
+            self.main.run()
+        finally:
+            self.total_time = time.perf_counter_ns() - start_time
+            self.main.settrace(None)
+
+    def trace(self, event: TraceEvent, instruction: Instruction, argument: object):
+        if event is TraceEvent.INSTRUCTION:
+            now = time.perf_counter_ns()
+            # Time of the instruction, which raised an exception, is not recorded
+            if self.record is not None:
+                self.record.time += now - self.start
+            record = self.records.get(id(instruction))
+            if record is None:
+                name = instruction.namespace.name if isinstance(instruction.namespace, Procedure) else 'MainProcedure'
+                record = self.records[id(instruction)] = InstructionRecord(name, instruction)
+            record.count += 1
+            self.record = record
+            self.start = now
+        elif event is TraceEvent.CALL:
+            self.calls[argument.name] = self.calls.get(argument.name, 0) + 1
+
+    def group(self, key) -> list[tuple[object, int, int]]:
+        """Returns (key, count, time) of records grouped by 'key', sorted by time"""
+        groups = dict()
+        for record in self.records.values():
+            count, spent = groups.get(key(record), (0, 0))
+            groups[key(record)] = (count + record.count, spent + record.time)
+        return sorted(((group, count, spent) for group, (count, spent) in groups.items()), key=lambda item: -item[2])
+
+    def share(self, spent: int) -> float:
+        return spent / self.measured_time if self.measured_time else 0.0
+
+    def report(self):
+        total_count = sum(record.count for record in self.records.values())
+        self.measured_time = sum(record.time for record in self.records.values())
+        print('== PROFILE ==')
+        print(f'{total_count:,} instructions in {self.total_time / 1e9:.3f} s')
+        print()
+        self.report_instructions()
+        self.report_procedures()
+        self.report_hot_spots()
+        self.report_heatmap()
+
+    def report_instructions(self):
+        print('-- INSTRUCTIONS --')
+        print(f"{'INSTRUCTION':<20}{'COUNT':>14}{'TIME (ms)':>12}{'TIME %':>8}{'NS/EXEC':>10}")
+        for name, count, spent in self.group(lambda record: record.instruction.__class__.__name__):
+            print(f'{name:<20}{count:>14,}{spent / 1e6:>12.1f}{self.share(spent):>8.1%}{spent / count:>10.0f}')
+        print()
+
+    def report_procedures(self):
+        print('-- PROCEDURES --')
+        print(f"{'PROCEDURE':<20}{'CALLS':>12}{'INSTRUCTIONS':>14}{'TIME (ms)':>12}{'TIME %':>8}")
+        for name, count, spent in self.group(lambda record: record.procedure):
+            print(f'{name:<20}{self.calls.get(name, 0):>12,}{count:>14,}{spent / 1e6:>12.1f}{self.share(spent):>8.1%}')
+        print()
+
+    def report_hot_spots(self):
+        print('-- HOT SPOTS --')
+        print(f"{'POSITION':<14}{'COUNT':>14}{'TIME (ms)':>12}{'TIME %':>8}  SOURCE")
+        positions = self.group(lambda record: self.main.source_map.position(record.instruction.debug_index))
+        for position, count, spent in [item for item in positions if item[0] is not None][:HOT_SPOTS]:
+            line, symbol = position
+            source = self.code[line - 1] if 0 < line <= len(self.code) else ''
+            location = f'ln {line}:{symbol}'
+            print(f'{location:<14}{count:>14,}{spent / 1e6:>12.1f}{self.share(spent):>8.1%}  '
+                  f"{source[max(0, symbol - 10):symbol].lstrip()}{Fore.LIGHTRED_EX}{source[symbol:symbol + 1]}{Fore.RESET}{source[symbol + 1:symbol + 11].rstrip()}")
+        print()
+
+    def report_heatmap(self):
+        """Prints the source code with executions and share of time of every line"""
+        source_map = self.main.source_map
+        lines = {line: (count, spent) for line, count, spent in self.group(
+            lambda record: source_map.lines[record.instruction.debug_index] if record.instruction.debug_index >= 0 else None)}
+        print('-- HEATMAP --')
+        print(f"{'LINE':>6}{'COUNT':>14}{'TIME %':>8}  SOURCE")
+        for line, source in enumerate(self.code, start=1):
+            if line not in lines:
+                print(f"{line:>6}{'':>14}{'':>8}  {source}")
+                continue
+            count, spent = lines[line]
+            share = self.share(spent)
+            color = Fore.LIGHTRED_EX if share >= HOT_SHARE else Fore.LIGHTYELLOW_EX if share >= WARM_SHARE else Fore.LIGHTGREEN_EX
+            print(f'{color}{line:>6}{count:>14,}{share:>8.1%}{Fore.RESET}  {source}')
+        print()
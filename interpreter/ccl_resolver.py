@@ -0,0 +1,74 @@
+from __future__ import annotations
+from ccl_internals import (Context, MainProcedure, Instruction, Variables,
+                           DefineProcedure, CallProcedure, CreateLocal, ExitBlock, EndCompare,
+                           StartRepeat, EndRepeat, MultiplyAdd)
+
+
+class Resolver:
+    """
+    Assigns slots to variable names before the program runs, so that instructions index
+    global and local variables directly instead of looking them up by name.
+
+    Every name gets a slot in MainProcedure.global_variables.
+    Within a procedure, names created with '&' also get a slot in the frame of local variables;
+    only those names can refer to a local variable, so only they check the local slot first.
+    Counters of REPEAT blocks are indexed by the nesting level of the block within its procedure.
+    Calls, after which the procedure returns right away, are marked as tail calls.
+    Resolving is repeated after the instruction stack is rewritten (by the optimizer, or when it is loaded from the cache).
+    """
+    def __init__(self, main: MainProcedure):
+        self.main = main
+        self.global_variables: Variables = main.global_variables
+
+    def resolve(self) -> MainProcedure:
+        loop_depth = self.resolve_block(self.main.instruction_stack, dict())
+        self.main.loop_counters = [0] * loop_depth
+        return self.main
+
+    def resolve_block(self, instruction_stack: list[Instruction], local_slots: dict[str, int]) -> int:
+        """Returns the deepest nesting of REPEAT blocks, which is the amount of loop counters the block needs"""
+        depth = 0
+        loop_depth = 0
+        # Instruction classes are compared directly, since isinstance() checks of ABC subclasses are slow on large programs
+        for instruction in instruction_stack:
+            instruction_type = type(instruction)
+            if instruction_type is DefineProcedure:
+                local_names = list(dict.fromkeys(
+                    body_instruction.name_parameter for body_instruction in instruction.instruction_stack
+                    if type(body_instruction) is CreateLocal and body_instruction.name_parameter is not None
+                ))
+                instruction.local_names = local_names
+                instruction.loop_depth = self.resolve_block(instruction.instruction_stack, {name: slot for slot, name in enumerate(local_names)})
+                self.mark_tail_calls(instruction.instruction_stack)
+                continue
+
+            if instruction_type is StartRepeat:
+                instruction.counter_index = depth
+                depth += 1
+                loop_depth = max(loop_depth, depth)
+            elif instruction_type is EndRepeat:
+                depth -= 1
+                instruction.counter_index = depth
+            elif instruction_type is MultiplyAdd:
+                instruction.variable_slots = [
+                    (sign, -1, -1) if name is None else (sign, self.global_variables.slot(name), local_slots.get(name, -1))
+                    for sign, name in instruction.variables
+                ]
+
+            name = getattr(instruction, 'name_parameter', None)
+            if name is None or instruction_type is CallProcedure:
+                continue
+            instruction.slot = self.global_variables.slot(name)
+            instruction.local_slot = local_slots.get(name, -1)
+        return loop_depth
+
+    def mark_tail_calls(self, instruction_stack: list[Instruction]):
+        """Call is in tail position when it is followed by '}' or '#' of the procedure, with only ';' in between"""
+        returns = True
+        for instruction in reversed(instruction_stack):
+            if type(instruction) is CallProcedure:
+                instruction.tail_call = returns
+            if type(instruction) is ExitBlock and instruction.context == Context.PROCEDURE:
+                returns = True
+            elif type(instruction) is not EndCompare:
+                returns = False
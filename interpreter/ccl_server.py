@@ -0,0 +1,278 @@
+from __future__ import annotations
+import asyncio
+import json
+import os
+import pickle
+import signal
+import threading
+import time
+import _thread
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
+from ccl_exceptions import CCLParseError
+from ccl_internals import MainProcedure
+from ccl_parser import Parser
+from ccl_source import SourceCode
+from ccl import Program
+from ccl_batch import error_info
+
+# Requests are JSON objects, one per line; a request which does not end within this amount of bytes is rejected
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+DEFAULT_TIMEOUT = 10.0
+
+# Programs unpickled by a worker process, by their key in the registry of the server
+worker_programs: dict[str, Program] = dict()
+
+
+class RunTimeout(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Interrupts the run of a worker after 'timeout' seconds. Timer thread interrupts the main thread with
+    _thread.interrupt_main(), which works on every platform, unlike SIGALRM
+    """
+    def __init__(self, timeout: float):
+        self.lock = threading.Lock()
+        self.running = True
+        self.expired = False
+        self.timer = threading.Timer(timeout, self.expire)
+        self.timer.daemon = True
+
+    def start(self):
+        self.timer.start()
+
+    def expire(self):
+        with self.lock:
+            if self.running:
+                self.expired = True
+                _thread.interrupt_main()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+        self.timer.cancel()
+
+
+# Deadline of the request which a worker process runs
+deadline: Deadline | None = None
+
+
+def interrupt_run(signal_number: int, frame: object):
+    if deadline is None or not deadline.expired:
+        raise KeyboardInterrupt
+    # Interrupt may arrive after the run has ended, then there is nothing to stop
+    if deadline.running:
+        raise RunTimeout
+
+
+def run_request(key: str, pickled_program: bytes, input_text: str, engine: str, timeout: float) -> dict:
+    """
+    Runs one request in a worker process. Every worker unpickles a program once and keeps it for later requests;
+    the run is interrupted after 'timeout' seconds
+    """
+    global deadline
+    if key not in worker_programs:
+        worker_programs[key] = pickle.loads(pickled_program)
+    signal.signal(signal.SIGINT, interrupt_run)
+    deadline = Deadline(timeout)
+    deadline.start()
+    try:
+        result = worker_programs[key].run(input_text, engine)
+    except RunTimeout:
+        return {'exit_code': 1, 'output': '', 'error': {'type': 'Timeout', 'message': f'program did not finish in {timeout} seconds'},
+                'time': timeout, 'timeout': True}
+    except Exception as Error:
+        return {'exit_code': 1, 'output': '', 'error': error_info(Error), 'time': 0.0}
+    finally:
+        deadline.stop()
+    return {'exit_code': result.exit_code, 'output': result.output,
+            'error': None if result.error is None else error_info(result.error), 'time': result.stats['time']}
+
+
+def request_error(Error: Exception) -> dict:
+    """Errors of requests are the client's, so they are reported without a Python traceback"""
+    if isinstance(Error, CCLParseError):
+        return error_info(Error)
+    return {'type': Error.__class__.__name__, 'message': str(Error)}
+
+
+def warm_up():
+    """Run once per worker when the server starts, so that workers are spawned and have imported the interpreter before the first request"""
+
+
+class Metrics:
+    """Counters of the server, returned by the 'stats' request"""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.started = time.time()
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.requests = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.run_time = 0.0
+        self.queue_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """Requests which wait for a free worker"""
+        return max(0, self.in_flight - self.workers)
+
+    def submitted(self):
+        self.in_flight += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def finished(self, result: dict, queue_time: float):
+        self.in_flight -= 1
+        self.requests += 1
+        self.failed += result['exit_code'] != 0
+        self.timeouts += result.get('timeout', False)
+        self.run_time += result['time']
+        self.queue_time += queue_time
+
+    def as_dict(self, programs: int) -> dict:
+        return {
+            'uptime': time.time() - self.started,
+            'workers': self.workers,
+            'programs': programs,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'requests': self.requests,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'average_run_time': self.run_time / self.requests if self.requests else 0.0,
+            'average_queue_time': self.queue_time / self.requests if self.requests else 0.0,
+        }
+
+
+class ProgramServer:
+    """
+    Server, which runs programs for clients of a Unix or TCP socket, over a pool of warm worker processes.
+    Clients send requests as JSON lines and get one JSON line per request, with the 'id' of the request;
+    responses of one connection may come out of order, since requests run concurrently:
+        {"op": "compile", "name": <name>, "source": <code>}   registers a program under the name
+        {"op": "run", "program": <name or path>, "input": <text>, "timeout": <seconds>}
+                                                             runs a registered program; a path is compiled on first use
+        {"op": "stats"}                                      returns counters of the server, including the queue depth
+    Programs are compiled once, in this process, and kept in the registry pickled;
+    a worker unpickles a program when it runs it for the first time.
+    """
+    def __init__(self, parse: Callable[[Parser], MainProcedure], engine: str = 'default',
+                 workers: int | None = None, timeout: float = DEFAULT_TIMEOUT):
+        self.parse = parse
+        self.engine = engine
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        # Name: (key, pickled program); key changes when a name is compiled again, so workers do not run stale programs
+        self.registry: dict[str, tuple[str, bytes]] = dict()
+        self.compilations = 0
+        self.metrics = Metrics(self.workers)
+        self.executor: ProcessPoolExecutor | None = None
+
+    def register(self, name: str, program: Program):
+        self.compilations += 1
+        self.registry[name] = (f'{self.compilations}:{name}', pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def compile(self, request: dict) -> dict:
+        name, source = request.get('name'), request.get('source')
+        if not isinstance(name, str) or not isinstance(source, str):
+            raise ValueError("'compile' request needs a string 'name' and 'source'")
+        self.register(name, Program.from_main(self.parse(Parser(name, SourceCode.from_text(source))), name))
+        return {'ok': True, 'name': name}
+
+    async def run(self, request: dict) -> dict:
+        name, input_text = request.get('program'), request.get('input', '')
+        timeout = request.get('timeout', self.timeout)
+        if not isinstance(name, str) or not isinstance(input_text, str):
+            raise ValueError("'run' request needs a string 'program' and a string 'input'")
+        if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0:
+            raise ValueError("'timeout' must be a positive number of seconds")
+        if name not in self.registry:
+            self.register(name, Program.from_main(self.parse(Parser(name)), name))
+        key, pickled_program = self.registry[name]
+
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        self.metrics.submitted()
+        try:
+            result = await loop.run_in_executor(self.executor, run_request, key, pickled_program, input_text, self.engine, float(timeout))
+        except Exception as Error:
+            result = {'exit_code': 1, 'output': '', 'error': error_info(Error), 'time': 0.0}
+        self.metrics.finished(result, max(0.0, time.perf_counter() - submitted - result['time']))
+        result.pop('timeout', None)
+        return result
+
+    async def respond(self, line: bytes) -> dict:
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as Error:
+            return {'id': None, 'error': request_error(Error)}
+        response = {'id': request.get('id')}
+        try:
+            operation = request.get('op', 'run')
+            if operation == 'run':
+                response.update(await self.run(request))
+            elif operation == 'compile':
+                response.update(self.compile(request))
+            elif operation == 'stats':
+                response.update(self.metrics.as_dict(len(self.registry)))
+            else:
+                raise ValueError(f"unknown operation '{operation}'")
+        except (CCLParseError, OSError, ValueError) as Error:
+            response['error'] = request_error(Error)
+        return response
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves one connection until the client closes it"""
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def answer(line: bytes):
+            response = await self.respond(line)
+            async with lock:
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                if line.strip():
+                    task = asyncio.create_task(answer(line))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        except (ConnectionError, ValueError):
+            # ValueError: a line longer than MAX_REQUEST_SIZE
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, address: str):
+        """Serves forever on 'address': '<host>:<port>' for TCP, or the path of a Unix socket"""
+        host, _, port = address.rpartition(':')
+        with ProcessPoolExecutor(max_workers=self.workers) as self.executor:
+            await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(self.executor, warm_up) for _ in range(self.workers)))
+            if port.isdigit():
+                server = await asyncio.start_server(self.handle, host or 'localhost', int(port), limit=MAX_REQUEST_SIZE)
+            else:
+                server = await asyncio.start_unix_server(self.handle, address, limit=MAX_REQUEST_SIZE)
+            # SIGTERM stops the server like Ctrl+C, so that the workers are shut down with it
+            serving = asyncio.current_task()
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+            except NotImplementedError:
+                # Event loops of Windows do not support signal handlers
+                pass
+            try:
+                async with server:
+                    print(f'Serving on {address} with {self.workers} workers', flush=True)
+                    await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+            finally:
+                if not port.isdigit() and os.path.exists(address):
+                    os.remove(address)
@@ -0,0 +1,233 @@
+from __future__ import annotations
+import hashlib
+import os
+import pickle
+import signal
+import tempfile
+import zlib
+from pathlib import Path
+from ccl_internals import MainProcedure, Procedure, Frame, Variables, DefineProcedure, Instruction
+from ccl_streams import StreamOutput, StreamInput
+from ccl_cache import interpreter_version
+
+SNAPSHOT_VERSION = 1
+# Instructions run between two checks for a checkpoint; signals are answered after at most this many instructions
+CHECK_INTERVAL = 10000
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def program_fingerprint(code: bytes, optimize: bool) -> str:
+    """
+    Snapshot refers to instructions by their addresses, so it can only be resumed by the same program,
+    parsed (and optimized, or not) by the same interpreter
+    """
+    digest = hashlib.sha256(interpreter_version().encode())
+    digest.update(b'-O' if optimize else b'')
+    digest.update(code)
+    return digest.hexdigest()
+
+
+def definitions(instruction_stack: list[Instruction], found: dict[int, DefineProcedure] | None = None) -> dict[int, DefineProcedure]:
+    """Returns every DefineProcedure of the program by its debug index, which is how procedures refer to their definition"""
+    found = dict() if found is None else found
+    for instruction in instruction_stack:
+        if type(instruction) is DefineProcedure:
+            found[instruction.debug_index] = instruction
+            definitions(instruction.instruction_stack, found)
+    return found
+
+
+def save_variables(variables: Variables) -> tuple[list[int | None], list[int]]:
+    return list(variables.slots), list(variables.defined)
+
+
+def load_variables(variables: Variables, state: tuple[list[int | None], list[int]]) -> Variables:
+    slots, defined = state
+    variables.slots[:] = slots
+    variables.defined = dict.fromkeys(defined)
+    return variables
+
+
+class Snapshot:
+    """
+    State of a program of the default engine, between two instructions: everything that changes while it runs,
+    and nothing that can be rebuilt from the program itself.
+    Procedures are saved as the debug index of their DefineProcedure and the state of their innermost activation;
+    their instructions are created again from the definition when the snapshot is restored.
+    Values are plain lists and integers, so the pickled snapshot is small and compresses well.
+    """
+    def __init__(self, fingerprint: str, instructions: int, state: dict):
+        self.fingerprint = fingerprint
+        # Instructions run before the snapshot was taken
+        self.instructions = instructions
+        self.state = state
+
+    @classmethod
+    def capture(cls, main: MainProcedure, fingerprint: str, instructions: int = 0) -> Snapshot:
+        # Procedures which are defined or active, each saved once; call stack and names refer to them by index
+        procedures: list[Procedure] = list()
+        indexes: dict[int, int] = dict()
+        for procedure in (*main.defined_procedures.values(), *main.call_stack):
+            if id(procedure) not in indexes:
+                indexes[id(procedure)] = len(procedures)
+                procedures.append(procedure)
+        # Frames are saved by the procedure, whose earlier activation they hold: the one entered right after the frame was saved
+        frame_owners = [indexes[id(procedure)] for procedure in main.call_stack]
+
+        if isinstance(main.stdout, StreamOutput):
+            pending_output = ''.join(main.stdout.buffer)
+        else:
+            pending_output = ''.join(main.stdout)
+        stdin = main.stdin
+        state = {
+            'stack': list(main.stack),
+            'global_variables': save_variables(main.global_variables),
+            'instruction_pointer': main.instruction_pointer,
+            'loop_counters': list(main.loop_counters),
+            'procedures': [(procedure.definition, procedure.name, procedure.instruction_pointer,
+                            save_variables(procedure.local_variables), list(procedure.loop_counters))
+                           for procedure in procedures],
+            'defined_procedures': {name: indexes[id(procedure)] for name, procedure in main.defined_procedures.items()},
+            'call_stack': frame_owners,
+            'frames': [(frame.instruction_pointer, save_variables(frame.local_variables), list(frame.loop_counters))
+                       for frame in main.frames],
+            'pending_output': pending_output,
+            'input': (stdin.consumed, stdin.last_char) if isinstance(stdin, StreamInput) else None,
+        }
+        return cls(fingerprint, instructions, state)
+
+    def restore(self, main: MainProcedure, fingerprint: str):
+        """
+        Puts the state into a freshly parsed MainProcedure of the same program.
+        Streams must be opened before, since procedures take the output of MainProcedure when they are created
+        """
+        if fingerprint != self.fingerprint:
+            raise SnapshotError('snapshot was taken from a different program, or by a different version of the interpreter')
+        state = self.state
+        main.stack[:] = state['stack']
+        load_variables(main.global_variables, state['global_variables'])
+        main.instruction_pointer = state['instruction_pointer']
+        main.loop_counters[:] = state['loop_counters']
+
+        definitions_by_index = definitions(main.instruction_stack)
+        procedures = list()
+        for definition, name, instruction_pointer, local_variables, loop_counters in state['procedures']:
+            if definition not in definitions_by_index:
+                raise SnapshotError(f"snapshot refers to procedure '{name}', which is not defined by the program")
+            procedure = definitions_by_index[definition].create(main)
+            procedure.name = name
+            procedure.instruction_pointer = instruction_pointer
+            load_variables(procedure.local_variables, local_variables)
+            procedure.loop_counters = loop_counters
+            procedures.append(procedure)
+        main.defined_procedures.clear()
+        main.defined_procedures.update({name: procedures[index] for name, index in state['defined_procedures'].items()})
+        main.call_stack[:] = [procedures[index] for index in state['call_stack']]
+        main.frames[:] = [
+            Frame(instruction_pointer, load_variables(procedures[owner].local_variables.fresh(), local_variables), loop_counters)
+            for owner, (instruction_pointer, local_variables, loop_counters) in zip(state['call_stack'], state['frames'])
+        ]
+
+        for char in state['pending_output']:
+            main.stdout.append(char)
+        if state['input'] is not None and isinstance(main.stdin, StreamInput):
+            main.stdin.skip(*state['input'])
+
+    def dumps(self) -> bytes:
+        return zlib.compress(pickle.dumps((SNAPSHOT_VERSION, self.fingerprint, self.instructions, self.state),
+                                          protocol=pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def loads(cls, data: bytes) -> Snapshot:
+        try:
+            version, fingerprint, instructions, state = pickle.loads(zlib.decompress(data))
+        except (zlib.error, pickle.UnpicklingError, EOFError, ValueError, TypeError) as Error:
+            raise SnapshotError(f'not a snapshot file ({Error})') from None
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(f'snapshot has version {version}, but version {SNAPSHOT_VERSION} is supported')
+        return cls(fingerprint, instructions, state)
+
+    def save(self, path: str | Path):
+        """Writes to a temporary file first, so that a crash while saving never destroys the previous snapshot"""
+        path = Path(path)
+        descriptor, temporary_path = tempfile.mkstemp(dir=path.resolve().parent, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(self.dumps())
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str | Path) -> Snapshot:
+        return cls.loads(Path(path).read_bytes())
+
+
+class CheckpointStop(Exception):
+    """Raised by Checkpointer.run() after the snapshot was saved on SIGTERM"""
+
+
+class Checkpointer:
+    """
+    Runs a program of the default engine like MainProcedure.run(), and saves a snapshot of it to 'path'
+    every 'every' instructions, on SIGUSR1 (the program continues) and on SIGTERM (the program stops).
+    Instructions run in chunks of CHECK_INTERVAL between two checks, so checkpoints cost nothing in between
+    """
+    def __init__(self, main: MainProcedure, path: str | Path, fingerprint: str, every: int | None = None, instructions: int = 0):
+        self.main = main
+        self.path = path
+        self.fingerprint = fingerprint
+        self.every = every
+        self.instructions = instructions
+        self.next_checkpoint = instructions + every if every else None
+        self.requested = False
+        self.stopping = False
+
+    def request(self, signal_number: int, frame: object):
+        self.requested = True
+        self.stopping = self.stopping or signal_number == signal.SIGTERM
+
+    def checkpoint(self):
+        # Output written so far is written for good, so a resumed program continues it without repeating any
+        if self.main.streaming:
+            self.main.flush_stdout()
+        Snapshot.capture(self.main, self.fingerprint, self.instructions).save(self.path)
+        self.requested = False
+        if self.every:
+            self.next_checkpoint = self.instructions + self.every
+
+    def run(self):
+        """Runs the program until it exits (CCLExit is raised), fails or is stopped by SIGTERM (CheckpointStop is raised)"""
+        signals = [signal.SIGTERM] + ([signal.SIGUSR1] if hasattr(signal, 'SIGUSR1') else [])
+        handlers = {signal_number: signal.signal(signal_number, self.request) for signal_number in signals}
+        try:
+            self.run_chunks()
+        finally:
+            for signal_number, handler in handlers.items():
+                signal.signal(signal_number, handler)
+
+    def run_chunks(self):
+        main = self.main
+        call_stack = main.call_stack
+        console = not main.streaming
+        while True:
+            chunk = CHECK_INTERVAL if self.next_checkpoint is None else min(CHECK_INTERVAL, self.next_checkpoint - self.instructions)
+            # Instructions are counted before the chunk runs; a chunk cut short by CCLExit or an error is not saved anyway
+            self.instructions += chunk
+            if console:
+                for _ in range(chunk):
+                    procedure = call_stack[-1] if call_stack else main
+                    procedure.instruction_stack[procedure.instruction_pointer].execute()
+                    main.print_stdout()
+            else:
+                for _ in range(chunk):
+                    procedure = call_stack[-1] if call_stack else main
+                    procedure.instruction_stack[procedure.instruction_pointer].execute()
+            if self.requested or (self.next_checkpoint is not None and self.instructions >= self.next_checkpoint):
+                self.checkpoint()
+                if self.stopping:
+                    raise CheckpointStop
@@ -0,0 +1,114 @@
+from __future__ import annotations
+import mmap
+import os
+import re
+import stat
+from array import array
+from itertools import accumulate
+from typing import Sequence
+from ccl_exceptions import CCLTraceback
+
+# Line breaks of str.splitlines(), as they are encoded in UTF-8
+LINE_BREAK = re.compile(rb'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+# Bytes of line breaks other than '\n' and '\r\n', which need the slower LINE_BREAK search.
+# Last bytes of the multibyte breaks are searched alone, since single bytes are found much faster
+RARE_LINE_BREAK_BYTES = (b'\x0b', b'\x0c', b'\x1c', b'\x1d', b'\x1e', b'\x85', b'\xa8', b'\xa9')
+LONE_CARRIAGE_RETURN = re.compile(rb'\r(?!\n)')
+
+
+class SourceCode:
+    """
+    Lines of a source file, which is mapped into memory with mmap instead of being read into a string.
+    Only the offset of every line is kept; text of a line is decoded when it is accessed,
+    so a large program is not kept as a string per line while it is parsed and run.
+    Can be used like the list of lines of str.splitlines().
+    """
+    def __init__(self, source_filepath: str):
+        with open(source_filepath, 'rb') as source:
+            status = os.fstat(source.fileno())
+            if stat.S_ISREG(status.st_mode) and status.st_size:
+                self.data: mmap.mmap | bytes = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # Empty files cannot be mapped, pipes and devices are read as a whole
+                self.data = source.read()
+        # Offset of the start of every line, followed by the size of the file
+        self.offsets = array('q', [0])
+        self.index_lines()
+
+    @classmethod
+    def from_text(cls, text: str) -> SourceCode:
+        """Lines of a program, which is given as a string instead of a file"""
+        code = cls.__new__(cls)
+        code.data = text.encode('utf-8')
+        code.offsets = array('q', [0])
+        code.index_lines()
+        return code
+
+    def index_lines(self):
+        data = self.data
+        if isinstance(data, mmap.mmap) and not self.has_rare_line_breaks():
+            # Every line ends with '\n', so mmap.readline() finds the lines without a Python loop
+            self.offsets.extend(accumulate(map(len, iter(data.readline, b''))))
+            return
+        self.offsets.extend(match.end() for match in LINE_BREAK.finditer(data))
+        if self.offsets[-1] != len(data):
+            self.offsets.append(len(data))
+
+    def has_rare_line_breaks(self) -> bool:
+        data = self.data
+        if any(data.find(byte, 0) != -1 for byte in RARE_LINE_BREAK_BYTES):
+            return True
+        return data.find(b'\r', 0) != -1 and LONE_CARRIAGE_RETURN.search(data) is not None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int | slice) -> str | list[str]:
+        if isinstance(index, slice):
+            return [self[line_index] for line_index in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        line = self.data[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+        # Line ends with its line break, except for the last line of a file without a trailing newline
+        return line.splitlines()[0]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reduce__(self):
+        # Mapped file cannot be pickled (compiled program cache, batch workers), so the lines are pickled as a list
+        return list, (list(self),)
+
+
+class SourceMap:
+    """
+    Positions of instructions in the source code, kept apart from the instructions.
+    Every instruction holds an index into 'lines' and 'symbols' (-1 when it has no position),
+    and CCLTraceback is made from the index only when an error is reported or the debugger shows the instruction.
+    """
+    def __init__(self, source: Sequence[str] | None = None, lines: array | None = None, symbols: array | None = None):
+        self.source = source
+        self.lines = array('i') if lines is None else lines
+        self.symbols = array('i') if symbols is None else symbols
+
+    def add(self, line: int, symbol: int) -> int:
+        """Returns debug index of the position"""
+        self.lines.append(line)
+        self.symbols.append(symbol)
+        return len(self.lines) - 1
+
+    def position(self, debug_index: int) -> tuple[int, int] | None:
+        if debug_index < 0:
+            return None
+        return self.lines[debug_index], self.symbols[debug_index]
+
+    def traceback(self, debug_index: int) -> CCLTraceback | None:
+        if debug_index < 0:
+            return None
+        return CCLTraceback(position=(self.lines[debug_index], self.symbols[debug_index]), source=self.source)
+
+    def __len__(self) -> int:
+        return len(self.lines)
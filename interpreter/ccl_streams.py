@@ -0,0 +1,126 @@
+from __future__ import annotations
+import codecs
+from typing import Awaitable, Protocol, TextIO
+from ccl_exceptions import CCLRuntimeError, CCLTraceback
+
+# Amount of buffered characters, after which output is written even without a newline
+OUTPUT_BUFFER_SIZE = 8192
+# Amount of characters read from the input file at once
+INPUT_CHUNK_SIZE = 65536
+# Characters accepted by '>', same as on the console: \x03 (end of text) and \r read as a newline
+INPUT_CHARS = {char: ('\n' if char in '\x03\r' else char) for char in (*map(chr, range(32, 127)), '\t', '\n', '\r', '\x03')}
+
+
+class StreamOutput:
+    """
+    Output of a program, which is written to a file (or a pipe) as the program runs,
+    instead of being kept in a list and redrawn on the console.
+    Written characters are buffered until a newline, or until the buffer is full.
+    """
+    def __init__(self, file: TextIO, buffer_size: int = OUTPUT_BUFFER_SIZE):
+        self.file = file
+        self.buffer_size = buffer_size
+        self.buffer: list[str] = list()
+
+    def append(self, char: str):
+        self.buffer.append(char)
+        if char == '\n' or len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer.clear()
+        self.file.flush()
+
+
+class StreamInput:
+    """
+    Input of a program, which is read from a file (or a pipe) in large chunks instead of from the console.
+    Characters are not echoed into the output.
+    Input which does not end with a newline gets one, like the last line of a text file;
+    reading past the end of input is an error.
+    """
+    def __init__(self, file: TextIO, chunk_size: int = INPUT_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.chunk = ''
+        self.position = 0
+        # Characters of the chunks before the current one
+        self.offset = 0
+        self.last_char: str | None = None
+
+    def read_char(self, name_parameter: str, traceback: CCLTraceback) -> str:
+        if self.position == len(self.chunk):
+            self.offset += len(self.chunk)
+            self.chunk = self.read_chunk()
+            self.position = 0
+            if not self.chunk:
+                if self.last_char is None or self.last_char == '\n':
+                    raise CCLRuntimeError(f"Instruction '>{name_parameter}': end of input", traceback=traceback)
+                self.last_char = '\n'
+                return '\n'
+
+        char = self.chunk[self.position]
+        self.position += 1
+        if char not in INPUT_CHARS:
+            raise CCLRuntimeError(f"Instruction '>{name_parameter}': bad input provided; input must be a printable ASCII character", traceback=traceback)
+        self.last_char = INPUT_CHARS[char]
+        return self.last_char
+
+    def read_chunk(self) -> str:
+        return self.file.read(self.chunk_size)
+
+    @property
+    def consumed(self) -> int:
+        """Amount of characters read by '>' so far"""
+        return self.offset + self.position
+
+    def skip(self, count: int, last_char: str | None):
+        """Skips input, which was read before a snapshot of the program was taken"""
+        while self.offset + len(self.chunk) < count:
+            self.offset += len(self.chunk)
+            self.chunk, self.position = self.read_chunk(), 0
+            if not self.chunk:
+                break
+        self.position = min(len(self.chunk), count - self.offset)
+        self.last_char = last_char
+
+
+class AsyncReader(Protocol):
+    """Input of AsyncStreamInput, e.g. asyncio.StreamReader"""
+    def read(self, n: int) -> Awaitable[bytes | str]: ...
+
+
+class AsyncStreamInput(StreamInput):
+    """
+    Input of a program, which is read from an asynchronous stream (e.g. asyncio.StreamReader).
+    '>' cannot wait for the stream, so whoever runs the program must await fill() first, whenever needs_input() is True;
+    read_char() then reads the filled chunk, like StreamInput does.
+    """
+    def __init__(self, reader: AsyncReader, chunk_size: int = INPUT_CHUNK_SIZE):
+        super().__init__(None, chunk_size)
+        self.reader = reader
+        # Bytes are decoded as they arrive, a character may be split between two reads
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.end_of_input = False
+
+    def needs_input(self) -> bool:
+        return self.position == len(self.chunk) and not self.end_of_input
+
+    async def fill(self):
+        """Waits until the next chunk of input is available, or the stream ends"""
+        while self.needs_input():
+            data = await self.reader.read(self.chunk_size)
+            self.offset += len(self.chunk)
+            if not data:
+                self.end_of_input = True
+                self.chunk, self.position = self.decoder.decode(b'', final=True), 0
+            elif isinstance(data, str):
+                self.chunk, self.position = data, 0
+            else:
+                self.chunk, self.position = self.decoder.decode(data), 0
+
+    def read_chunk(self) -> str:
+        # Only called after the end of input, since fill() is awaited before every '>', which would need a new chunk
+        return ''
@@ -0,0 +1,461 @@
+from __future__ import annotations
+import os
+import sys
+from pathlib import Path
+from typing import Callable
+from colorama import Fore
+from ccl_exceptions import CCLRuntimeError
+from ccl_internals import (Context, MainProcedure, Instruction, print_error, report_stream,
+                           DefineProcedure, CallProcedure, EndProcedure,
+                           Add, Subtract, PopAdd, PopSubtract, Reverse,
+                           PushZero, Assign, CreateLocal, Delete, PushVariable,
+                           PushConstant, AddConstant, AddVariable, SubtractVariable,
+                           LoopIdiom, RepeatPush, SetToVariable,
+                           StdOut, StdIn,
+                           StartCompare, EndCompare,
+                           StartRepeat, EndRepeat, StartWhile, EndWhile,
+                           ExitBlock, ContinueBlock)
+
+# Python calls are used for CCL procedure calls, so recursion depth is limited by the recursion limit.
+# Deeper non-tail recursion raises CCLRuntimeError
+RECURSION_LIMIT = 100_000
+
+MODULE_HEADER = '''\
+# Generated by CCL! from {source!r}
+{path_setup}from ccl_exceptions import CCLRuntimeError, CCLTraceback
+
+PRINTABLE = {{code: ('\\n' if code in (3, 13) else chr(code)) for code in (*range(32, 127), 3, 9, 10, 13)}}
+LINES = {lines!r}
+TRACEBACKS = {tracebacks!r}
+
+
+def traceback(index):
+    line_number, symbol_index, line_index = TRACEBACKS[index]
+    return CCLTraceback(position=(line_number, symbol_index), line=LINES[line_index])
+
+
+def error(index, message):
+    return CCLRuntimeError(message, traceback=traceback(index))
+
+
+'''
+
+# Interpreter is found by the CCL_INTERPRETER environment variable, or where it was relative to the script when it was written
+SCRIPT_PATH_SETUP = '''\
+import os
+import sys
+sys.path.insert(0, os.environ.get('CCL_INTERPRETER') or os.path.join(os.path.dirname(os.path.abspath(__file__)), {interpreter_directory!r}))
+'''
+
+SCRIPT_FOOTER = '''
+
+if __name__ == '__main__':
+    from ccl_transpiler import run_script
+    run_script(run)
+'''
+
+
+class Scope:
+    """Procedure that is being transpiled. 'name' and 'function_name' are None for MainProcedure"""
+    def __init__(self, name: str | None, instruction_stack: list[Instruction], function_name: str | None = None):
+        self.name = name
+        self.function_name = function_name
+        # Only names created with '&' within the procedure itself can refer to local variables
+        self.local_names = {instruction.name_parameter for instruction in instruction_stack
+                            if isinstance(instruction, CreateLocal)}
+        self.while_ends = {instruction.jump_address: address for address, instruction in enumerate(instruction_stack)
+                           if isinstance(instruction, EndWhile)}
+
+
+class Transpiler:
+    """
+    Translates a parsed program into Python source code.
+    REPEAT blocks become 'for' loops, WHILE blocks become 'while True' loops,
+    compare blocks become 'if' statements and procedures become nested functions of 'run()'.
+    """
+    def __init__(self, main: MainProcedure, source_filepath: str):
+        self.main = main
+        self.source_filepath = source_filepath
+        self.lines: list[str] = list()
+        self.line_indexes: dict[int, int] = dict()
+        self.tracebacks: list[tuple[int, int, int]] = list()
+        self.traceback_indexes: dict[int, int] = dict()
+        self.functions: list[list[str]] = list()
+
+    def transpile(self, path_setup: str = '') -> str:
+        """Returns source of a Python module, which defines run(stack, global_variables, procedures, stdout, flush_before_input, read_char)"""
+        body = list()
+        self.emit_block(body, self.main.instruction_stack, 0, len(self.main.instruction_stack), 1, Scope(None, self.main.instruction_stack))
+        code = [
+            'def run(stack, global_variables, procedures, stdout, flush_before_input, read_char):',
+            '    push = stack.append',
+            '    pop = stack.pop',
+            '    write = stdout.append',
+            '',
+        ]
+        for function in self.functions:
+            code.extend(function)
+            code.append('')
+        code.extend(body)
+        header = MODULE_HEADER.format(source=self.source_filepath, path_setup=path_setup,
+                                      lines=self.lines, tracebacks=self.tracebacks)
+        return header + '\n'.join(code) + '\n'
+
+    def transpile_script(self, script_filepath: str) -> str:
+        """Returns source of a standalone Python script, to be written to 'script_filepath', which runs the program without parsing it"""
+        interpreter_directory = Path(__file__).resolve().parent
+        try:
+            interpreter_directory = os.path.relpath(interpreter_directory, Path(script_filepath).resolve().parent)
+        except ValueError:
+            # Script is on another drive than the interpreter, so only the absolute path leads there
+            interpreter_directory = str(interpreter_directory)
+        path_setup = SCRIPT_PATH_SETUP.format(interpreter_directory=interpreter_directory)
+        return self.transpile(path_setup) + SCRIPT_FOOTER
+
+    def traceback_index(self, debug_index: int) -> int:
+        """Returns index of the traceback of the instruction within TRACEBACKS of the generated module"""
+        if debug_index not in self.traceback_indexes:
+            traceback = self.main.source_map.traceback(debug_index)
+            if traceback.position[0] not in self.line_indexes:
+                self.line_indexes[traceback.position[0]] = len(self.lines)
+                self.lines.append(traceback.line)
+            self.traceback_indexes[debug_index] = len(self.tracebacks)
+            self.tracebacks.append((*traceback.position, self.line_indexes[traceback.position[0]]))
+        return self.traceback_indexes[debug_index]
+
+    def read_variable(self, name: str, scope: Scope) -> str:
+        """Returns Python expression which reads variable (local first, then global); raises KeyError if undefined"""
+        if name in scope.local_names:
+            return f'(local_variables[{name!r}] if {name!r} in local_variables else global_variables[{name!r}])'
+        return f'global_variables[{name!r}]'
+
+    def get_variable(self, name: str | None, scope: Scope) -> str:
+        """Returns Python expression which reads variable (local first, then global) or evaluates to None if undefined"""
+        if name is None:
+            return 'None'
+        if name in scope.local_names:
+            return f'(local_variables[{name!r}] if {name!r} in local_variables else global_variables.get({name!r}))'
+        return f'global_variables.get({name!r})'
+
+    def emit_lookup(self, code: list[str], indent: str, target: str, instruction: Instruction, message: str, scope: Scope):
+        name = instruction.name_parameter
+        index = self.traceback_index(instruction.debug_index)
+        code.append(f'{indent}try:')
+        code.append(f'{indent}    {target} = {self.read_variable(name, scope)}')
+        code.append(f'{indent}except KeyError:')
+        code.append(f'{indent}    raise error({index}, {message!r}) from None')
+
+    def emit_store(self, code: list[str], indent: str, name: str, value: str, scope: Scope):
+        if name in scope.local_names:
+            code.append(f'{indent}if {name!r} in local_variables:')
+            code.append(f'{indent}    local_variables[{name!r}] = {value}')
+            code.append(f'{indent}else:')
+            code.append(f'{indent}    global_variables[{name!r}] = {value}')
+            return
+        code.append(f'{indent}global_variables[{name!r}] = {value}')
+
+    def emit_procedure(self, instruction: DefineProcedure) -> str:
+        """Transpiles procedure body into a nested function and returns its name"""
+        function_name = f'procedure_{len(self.functions)}'
+        function = [f'    def {function_name}(local_variables):']
+        self.functions.append(function)
+        scope = Scope(instruction.name_parameter, instruction.instruction_stack, function_name)
+        # Recursive tail calls restart the function instead of calling it
+        if any(isinstance(body_instruction, CallProcedure) and body_instruction.tail_call
+               and body_instruction.name_parameter == instruction.name_parameter for body_instruction in instruction.instruction_stack):
+            function.append('        while True:')
+            self.emit_block(function, instruction.instruction_stack, 0, len(instruction.instruction_stack), 3, scope)
+            function.append('            return')
+            return function_name
+        self.emit_block(function, instruction.instruction_stack, 0, len(instruction.instruction_stack), 2, scope)
+        return function_name
+
+    def emit_block(self, code: list[str], instruction_stack: list[Instruction], start: int, end: int, depth: int, scope: Scope):
+        """Transpiles instructions in range [start, end) with the given indentation depth"""
+        indent = '    ' * depth
+        initial_length = len(code)
+        while_ends = scope.while_ends
+
+        address = start
+        while address < end:
+            instruction = instruction_stack[address]
+
+            if isinstance(instruction, LoopIdiom):
+                # Loop is computed in closed form; otherwise it runs as usual and reports the error
+                self.emit_loop_idiom(code, indent, instruction, scope)
+                code.append(f'{indent}else:')
+                self.emit_block(code, instruction_stack, address + 1, instruction.jump_address + 1, depth + 1, scope)
+                address = instruction.jump_address + 1
+                continue
+
+            if isinstance(instruction, StartRepeat):
+                name = instruction.name_parameter
+                self.emit_lookup(code, indent, 'amount', instruction, f"Instruction '{name}[...]': variable '{name}' is undefined", scope)
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}if amount < 0:')
+                code.append(f'{indent}    raise error({index}, f"Instruction \'{name}[...]\': parameter (\'{name}\' = {{amount}}) cannot be less than 0")')
+                code.append(f'{indent}for _ in range(amount):')
+                self.emit_block(code, instruction_stack, address + 1, instruction.jump_address, depth + 1, scope)
+                address = instruction.jump_address + 1
+                continue
+
+            if isinstance(instruction, StartWhile):
+                code.append(f'{indent}while True:')
+                self.emit_block(code, instruction_stack, address + 1, while_ends[address], depth + 1, scope)
+                address = while_ends[address] + 1
+                continue
+
+            if isinstance(instruction, StartCompare):
+                name = instruction.name_parameter
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}if not stack:')
+                code.append(f'{indent}    raise error({index}, "Instruction \'?\': cannot compare with an empty stack")')
+                self.emit_lookup(code, indent, 'value', instruction, f"Instruction '?{name}': variable '{name}' is undefined", scope)
+                code.append(f'{indent}if value == stack[-1]:')
+                self.emit_block(code, instruction_stack, address + 1, instruction.jump_address, depth + 1, scope)
+                address = instruction.jump_address + 1
+                continue
+
+            self.emit_instruction(code, indent, instruction, scope)
+            address += 1
+
+        if len(code) == initial_length:
+            code.append(f'{indent}pass')
+
+    def emit_loop_idiom(self, code: list[str], indent: str, instruction: LoopIdiom, scope: Scope):
+        """Emits 'if' statement, which computes the loop when it is safe to do so"""
+        if isinstance(instruction, SetToVariable):
+            code.append(f'{indent}value = {self.get_variable(instruction.name_parameter, scope)}')
+            code.append(f'{indent}if value is not None and stack:')
+            code.append(f'{indent}    stack[-1] = value')
+            return
+
+        code.append(f'{indent}amount = {self.get_variable(instruction.name_parameter, scope)}')
+        if isinstance(instruction, RepeatPush):
+            code.append(f'{indent}if amount is not None and amount >= 0:')
+            code.append(f'{indent}    stack.extend({instruction.values!r} * amount)')
+            return
+
+        values = [self.get_variable(name, scope) for _, name in instruction.variables]
+        code.append(f'{indent}values = ({"".join(value + ", " for value in values)})')
+        code.append(f'{indent}if amount is not None and amount >= 0 and (amount == 0 or stack and None not in values):')
+        delta = ''.join(f' {"+" if sign > 0 else "-"} values[{index}]' for index, (sign, _) in enumerate(instruction.variables))
+        code.append(f'{indent}    if amount:')
+        code.append(f'{indent}        stack[-1] = ((stack[-1] + amount * ({instruction.constant}{delta}) + 32768) & 65535) - 32768')
+
+    def emit_instruction(self, code: list[str], indent: str, instruction: Instruction, scope: Scope):
+        name = getattr(instruction, 'name_parameter', None)
+
+        if isinstance(instruction, DefineProcedure):
+            code.append(f'{indent}procedures[{name!r}] = {self.emit_procedure(instruction)}')
+
+        elif isinstance(instruction, CallProcedure):
+            index = self.traceback_index(instruction.debug_index)
+            if name is None:
+                code.append(f'{indent}raise error({index}, "Instruction \'@_\': name must be provided and cannot be \'_\'")')
+                return
+            code.append(f'{indent}if {name!r} not in procedures:')
+            code.append(f'{indent}    raise error({index}, "Instruction \'@{name}\': procedure \'{name}\' is undefined")')
+            if instruction.tail_call and name == scope.name:
+                # Local variables are kept, the caller no longer needs them
+                code.append(f'{indent}if procedures[{name!r}] is {scope.function_name}:')
+                code.append(f'{indent}    continue')
+            code.append(f'{indent}try:')
+            if name != scope.name:
+                code.append(f'{indent}    procedures[{name!r}](dict())')
+            else:
+                # Recursive call starts with a copy of caller's local variables, as Procedure.enter() does.
+                # Procedure of the same name may have been redefined, then the call is not recursive
+                code.append(f'{indent}    procedures[{name!r}](dict(local_variables) if procedures[{name!r}] is {scope.function_name} else dict())')
+            # Innermost calls may fail to build the error too, then it is built by one of their callers
+            code.append(f'{indent}except RecursionError:')
+            code.append(f'{indent}    raise error({index}, "Instruction \'@{name}\': procedure calls are nested too deeply for the python engine") from None')
+
+        elif isinstance(instruction, PushZero):
+            code.append(f'{indent}push(0)')
+
+        elif isinstance(instruction, (Add, Subtract)):
+            index = self.traceback_index(instruction.debug_index)
+            if isinstance(instruction, Add):
+                message, operation = "Instruction '+': cannot add to an empty stack", '-32768 if stack[-1] == 32767 else stack[-1] + 1'
+            else:
+                message, operation = "Instruction '-': cannot subtract from an empty stack", '32767 if stack[-1] == -32768 else stack[-1] - 1'
+            code.append(f'{indent}if not stack:')
+            code.append(f'{indent}    raise error({index}, {message!r})')
+            code.append(f'{indent}stack[-1] = {operation}')
+
+        elif isinstance(instruction, (PopAdd, PopSubtract)):
+            index = self.traceback_index(instruction.debug_index)
+            symbol = '*' if isinstance(instruction, PopAdd) else '~'
+            code.append(f'{indent}if len(stack) < 2:')
+            code.append(f'{indent}    raise error({index}, f"Instruction \'{symbol}\': not enough elements on the stack ({{len(stack)}}); at least 2 required")')
+            if isinstance(instruction, PopAdd):
+                code.append(f'{indent}stack[-1] = ((pop() + stack[-1] + 32768) & 65535) - 32768')
+            else:
+                code.append(f'{indent}value = pop()')
+                code.append(f'{indent}stack[-1] = ((stack[-1] - value + 32768) & 65535) - 32768')
+
+        elif isinstance(instruction, PushConstant):
+            code.append(f'{indent}push({instruction.value})')
+
+        elif isinstance(instruction, AddConstant):
+            index = self.traceback_index(instruction.debug_index)
+            if instruction.symbol == '+':
+                message = "Instruction '+': cannot add to an empty stack"
+            else:
+                message = "Instruction '-': cannot subtract from an empty stack"
+            code.append(f'{indent}if not stack:')
+            code.append(f'{indent}    raise error({index}, {message!r})')
+            code.append(f'{indent}stack[-1] = ((stack[-1] + {instruction.amount + 32768}) & 65535) - 32768')
+
+        elif isinstance(instruction, (AddVariable, SubtractVariable)):
+            if name is None:
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}raise error({index}, "Instruction \'$_\': name must be provided and cannot be \'_\'")')
+                return
+            self.emit_lookup(code, indent, 'value', instruction, f"Instruction '${name}': variable '{name}' is undefined", scope)
+            index = self.traceback_index(instruction.operation_debug_index)
+            symbol, sign = ('~', '-') if isinstance(instruction, SubtractVariable) else ('*', '+')
+            code.append(f'{indent}if not stack:')
+            code.append(f'{indent}    push(value)')
+            code.append(f'{indent}    raise error({index}, "Instruction \'{symbol}\': not enough elements on the stack (1); at least 2 required")')
+            code.append(f'{indent}stack[-1] = ((stack[-1] {sign} value + 32768) & 65535) - 32768')
+
+        elif isinstance(instruction, Reverse):
+            if not name:
+                code.append(f'{indent}stack.reverse()')
+                return
+            self.emit_lookup(code, indent, 'amount', instruction, f"Instruction '%{name}': variable '{name}' is undefined", scope)
+            index = self.traceback_index(instruction.debug_index)
+            code.append(f'{indent}if len(stack) < amount:')
+            code.append(f'{indent}    raise error({index}, f"Instruction \'%{name}\': parameter (\'{name}\' = {{amount}}) exceeds length of the stack ({{len(stack)}})")')
+            code.append(f'{indent}if amount < 1:')
+            code.append(f'{indent}    raise error({index}, f"Instruction \'%{name}\': parameter (\'{name}\' = {{amount}}) cannot be less than 1")')
+            code.append(f'{indent}stack[-amount:] = stack[-amount:][::-1]')
+
+        elif isinstance(instruction, Assign):
+            index = self.traceback_index(instruction.debug_index)
+            code.append(f'{indent}if not stack:')
+            code.append(f'{indent}    raise error({index}, "Instruction \'=\': cannot pop from an empty stack")')
+            if name is None:
+                code.append(f'{indent}pop()')
+                return
+            self.emit_store(code, indent, name, 'pop()', scope)
+
+        elif isinstance(instruction, CreateLocal):
+            index = self.traceback_index(instruction.debug_index)
+            if name is None:
+                code.append(f'{indent}raise error({index}, "Instruction \'&_\': name must be provided and cannot be \'_\'")')
+            elif scope.name is None:
+                code.append(f'{indent}raise error({index}, "Instruction \'&{name}\': cannot create local variable outside of procedure")')
+            else:
+                code.append(f'{indent}local_variables[{name!r}] = 0')
+
+        elif isinstance(instruction, Delete):
+            index = self.traceback_index(instruction.debug_index)
+            if name is None:
+                code.append(f'{indent}raise error({index}, "Instruction \'!_\': name must be provided and cannot be \'_\'")')
+                return
+            keyword = 'if'
+            if name in scope.local_names:
+                code.append(f'{indent}if {name!r} in local_variables:')
+                code.append(f'{indent}    del local_variables[{name!r}]')
+                keyword = 'elif'
+            code.append(f'{indent}{keyword} {name!r} in global_variables:')
+            code.append(f'{indent}    del global_variables[{name!r}]')
+            code.append(f'{indent}else:')
+            code.append(f'{indent}    raise error({index}, "Instruction \'!{name}\': variable \'{name}\' is undefined")')
+
+        elif isinstance(instruction, PushVariable):
+            if name is None:
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}raise error({index}, "Instruction \'$_\': name must be provided and cannot be \'_\'")')
+                return
+            self.emit_lookup(code, indent, 'value', instruction, f"Instruction '${name}': variable '{name}' is undefined", scope)
+            code.append(f'{indent}push(value)')
+
+        elif isinstance(instruction, StdOut):
+            if name is None:
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}raise error({index}, "Instruction \'<_\': name must be provided and cannot be \'_\'")')
+                return
+            self.emit_lookup(code, indent, 'value', instruction, f"Instruction '<{name}': variable '{name}' is undefined", scope)
+            index = self.traceback_index(instruction.debug_index)
+            code.append(f'{indent}if value not in PRINTABLE:')
+            code.append(f'{indent}    raise error({index}, f"Instruction \'<{name}\': character with code {{value}} is not a printable ASCII character")')
+            code.append(f'{indent}write(PRINTABLE[value])')
+
+        elif isinstance(instruction, StdIn):
+            code.append(f'{indent}flush_before_input()')
+            if name is None:
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}raise error({index}, "Instruction \'>_\': name must be provided and cannot be \'_\'")')
+                return
+            self.emit_lookup(code, indent, 'value', instruction, f"Instruction '>{name}': variable '{name}' is undefined", scope)
+            index = self.traceback_index(instruction.debug_index)
+            code.append(f'{indent}value = read_char({name!r}, traceback({index}))')
+            self.emit_store(code, indent, name, 'ord(value)', scope)
+
+        elif isinstance(instruction, ExitBlock):
+            code.append(f'{indent}return' if instruction.context == Context.PROCEDURE else f'{indent}break')
+
+        elif isinstance(instruction, ContinueBlock):
+            if instruction.context == Context.PROCEDURE:
+                index = self.traceback_index(instruction.debug_index)
+                code.append(f'{indent}raise error({index}, "Instruction \':\': cannot be used outside of REPEAT or WHILE block")')
+                return
+            code.append(f'{indent}continue')
+
+        elif isinstance(instruction, (EndProcedure, EndCompare, EndRepeat, EndWhile)):
+            pass
+
+        else:
+            raise TypeError(f"Cannot transpile instruction '{type(instruction).__name__}'")
+
+
+class PythonProgram:
+    """Transpiled program, compiled with compile() and executed by CPython"""
+    def __init__(self, main: MainProcedure, run_function: Callable):
+        self.main = main
+        self.run_function = run_function
+        self.stack: list[int] = list()
+        self.global_variables: dict[str, int] = dict()
+        self.defined_procedures: dict[str, Callable] = dict()
+
+    @classmethod
+    def from_source(cls, main: MainProcedure, source: str, filename: str = '<ccl>') -> PythonProgram:
+        namespace = dict()
+        exec(compile(source, filename, 'exec'), namespace)
+        return cls(main, namespace['run'])
+
+    def run(self):
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, RECURSION_LIMIT))
+        try:
+            self.run_function(self.stack, self.global_variables, self.defined_procedures,
+                              self.main.stdout, self.main.flush_before_input, self.main.read_char)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+        self.main.flush_stdout()
+
+    def export_state(self):
+        """Copies final state into MainProcedure, so that MainProcedure.debug() can print it"""
+        self.main.load_state(self.stack, self.global_variables, self.defined_procedures)
+
+
+def run_script(run_function: Callable):
+    """Entry point of standalone scripts produced by Transpiler.transpile_script()"""
+    main = MainProcedure()
+    main.instruction_stack.append(EndProcedure(namespace=main, debug_index=-1))
+    main.open_standard_streams()
+    program = PythonProgram(main, run_function)
+    try:
+        program.run()
+        program.export_state()
+        with report_stream(main):
+            print()
+            main.debug()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+    except CCLRuntimeError as Error:
+        with report_stream(main):
+            print_error(Error)
@@ -1,35 +1,94 @@
-import os, sys
-from colorama import just_fix_windows_console, Fore, Back
-from click import getchar
+import asyncio, sys
+from colorama import just_fix_windows_console, Fore
 from ccl_parser import Parser
 from ccl_exceptions import CCLExit, CCLParseError, CCLRuntimeError
-from ccl_internals import DefineProcedure, EndProcedure
+from ccl_internals import MainProcedure, DefineProcedure, print_error, report_stream
+from ccl_closures import ClosureEngine
+from ccl_transpiler import Transpiler, PythonProgram
+from ccl_bytecode import Lowering, VirtualMachine
+from ccl_cache import ProgramCache
+from ccl_optimizer import Optimizer
+from ccl_batch import BatchRunner
+from ccl_server import ProgramServer, DEFAULT_TIMEOUT
+from ccl_snapshot import Snapshot, SnapshotError, Checkpointer, CheckpointStop, program_fingerprint
+from ccl_profiler import Profiler
+from ccl_debugger import Debugger
 
 just_fix_windows_console()
 
 
 def print_usage():
     print('USAGE: CCL! <filepath> [-args...]')
+    print('       CCL! -batch <jobs.jsonl> [-workers <n>] [-engine <name>] [-O] [-nocache] [-cachedir <path>]')
+    print('       CCL! -serve <address> [-workers <n>] [-timeout <seconds>] [-engine <name>] [-O] [-nocache] [-cachedir <path>]')
     print('ARGUMENTS:')
-    print('    -showstack    Show entire instruction stack of the program and exit')
-    print('    -ss           Alias for `-showstack`')
-    print('    -debug        Interpret program in debug mode')
-    print('    -d            Alias for `-debug`')
+    print('    -showstack        Show entire instruction stack of the program and exit')
+    print('    -ss               Alias for `-showstack`')
+    print('    -debug            Interpret program in the debugger; it stops before the first instruction,')
+    print("                      type 'h' there for the list of commands")
+    print('    -break <position> Set a breakpoint in the debugger before the program starts, <position> is')
+    print('                      <line> or <line>:<symbol>; can be given more than once')
+    print('    -d                Alias for `-debug`')
+    print('    -profile          Interpret program with the default engine and report instruction counts and time')
+    print('                      per instruction, procedure and source position')
+    print('    -engine <name>    Interpret program with the given engine: default, closures, python, bytecode')
+    print('                      (python limits depth of non-tail recursion to about 100000 calls)')
+    print('    -transpile <path> Translate program into a standalone Python script and exit')
+    print('    -O                Optimize program before interpreting it')
+    print('    -nocache          Do not read or write the compiled program cache')
+    print('    -cachedir <path>  Store compiled programs in the given directory instead of `__cclcache__`')
+    print('    -stream           Write output as the program runs, without redrawing the console')
+    print('                      (default when stdout is not a terminal)')
+    print('    -console          Redraw the console on output, even when stdout is not a terminal')
+    print("    -input <path>     Read input of '>' from the file instead of the console")
+    print('                      (stdin is read instead of the console when it is not a terminal)')
+    print('    -checkpoint <path>')
+    print('                      Save a snapshot of the program (default engine) to the file on SIGUSR1, and on')
+    print('                      SIGTERM before it stops')
+    print('    -every <n>        With `-checkpoint`, also save a snapshot every n instructions')
+    print('    -resume <path>    Resume the program from a snapshot saved with `-checkpoint`')
+    print('    -batch <path>     Run every job of a JSON lines file over a pool of processes and write results')
+    print('                      as JSON lines; a job is {"program": <path>, "input": <text>, "id": <any>}')
+    print('                      (`-` reads jobs from stdin)')
+    print('    -serve <address>  Run programs for clients of a socket over a pool of warm worker processes;')
+    print('                      <address> is <host>:<port> for TCP or the path of a Unix socket. Requests are')
+    print('                      JSON lines: {"op": "run", "program": <name or path>, "input": <text>, "timeout": <s>},')
+    print('                      {"op": "compile", "name": <name>, "source": <code>} and {"op": "stats"}')
+    print('    -workers <n>      Amount of worker processes for `-batch` and `-serve` (default: amount of CPUs)')
+    print(f'    -timeout <s>      Default time limit of a request for `-serve` in seconds (default: {DEFAULT_TIMEOUT:g})')
     print()
 
 
-def check_argv(arglist: list[str]) -> Parser:
-    if len(sys.argv) == 1:
-        print_usage()
-        print('ERROR: <filepath> was not provided')
-        print()
-        sys.exit(1)
-    for arg in sys.argv[2:]:
+def check_args(args: list[str], arglist: list[str], valued_arglist: dict[str, list[str] | None]):
+    args = iter(args)
+    for arg in args:
+        if arg in valued_arglist:
+            value = next(args, None)
+            if value is None:
+                print_usage()
+                print(f"ERROR: argument '{arg}' requires a value")
+                print()
+                sys.exit(1)
+            if valued_arglist[arg] is not None and value not in valued_arglist[arg]:
+                print_usage()
+                print(f"ERROR: unknown value '{value}' for argument '{arg}'")
+                print()
+                sys.exit(1)
+            continue
         if arg not in arglist:
             print_usage()
             print(f"ERROR: unknown argument '{arg}'")
             print()
             sys.exit(1)
+
+
+def check_argv(arglist: list[str], valued_arglist: dict[str, list[str] | None]) -> Parser:
+    if len(sys.argv) == 1:
+        print_usage()
+        print('ERROR: <filepath> was not provided')
+        print()
+        sys.exit(1)
+    check_args(sys.argv[2:], arglist, valued_arglist)
     try:
         return Parser(sys.argv[1])
     except FileNotFoundError:
@@ -49,10 +108,108 @@ def check_argv(arglist: list[str]) -> Parser:
         sys.exit(1)
 
 
+def get_arg_value(arg: str, default: str | None = None) -> str | None:
+    """Returns value that follows the argument 'arg', or 'default' if argument was not provided"""
+    for index, name in enumerate(sys.argv[2:-1], start=2):
+        if name == arg:
+            return sys.argv[index + 1]
+    return default
+
+
+def get_arg_values(arg: str) -> list[str]:
+    """Returns values of every occurrence of the argument 'arg'"""
+    return [sys.argv[index + 1] for index, name in enumerate(sys.argv[2:-1], start=2) if name == arg]
+
+
+def parse(parser: Parser) -> MainProcedure:
+    """Parses the program, or loads it from the compiled program cache, and optimizes it if '-O' was provided"""
+    if '-nocache' in sys.argv:
+        main = parser.parse()
+    else:
+        directory = get_arg_value('-cachedir') or ProgramCache.default_directory(parser.source_filepath)
+        main = ProgramCache(directory).parse(parser)
+    if '-O' in sys.argv:
+        Optimizer(main).optimize()
+    return main
+
+
+def open_streams(main: MainProcedure):
+    """
+    Switches to streaming output when stdout is not a terminal or '-stream' was provided,
+    and reads input from a file when '-input' was provided or stdin is not a terminal
+    """
+    stream_output = True if '-stream' in sys.argv else False if '-console' in sys.argv else None
+    filepath = get_arg_value('-input')
+    input_file = None
+    if filepath is not None:
+        try:
+            input_file = open(filepath, 'r', encoding='utf-8', errors='replace')
+        except OSError as Error:
+            print_usage()
+            print(f"ERROR: cannot read input file '{filepath}': {Error.strerror}")
+            print()
+            sys.exit(1)
+    main.open_standard_streams(stream_output, input_file)
+
+
+def get_workers() -> int | None:
+    workers = get_arg_value('-workers')
+    if workers is not None and (not workers.isdigit() or int(workers) == 0):
+        print_usage()
+        print(f"ERROR: value of argument '-workers' must be a positive integer, not '{workers}'")
+        print()
+        sys.exit(1)
+    return workers and int(workers)
+
+
+def try_batch():
+    if sys.argv[1:2] != ['-batch']:
+        return
+    check_args(sys.argv[1:], ['-O', '-nocache'], {'-batch': None, '-workers': None, '-engine': list(ENGINES), '-cachedir': None})
+    workers = get_workers()
+    filepath = sys.argv[2]
+    try:
+        jobs_file = sys.stdin if filepath == '-' else open(filepath, 'r', encoding='utf-8')
+    except OSError as Error:
+        print_usage()
+        print(f"ERROR: cannot read jobs file '{filepath}': {Error.strerror}")
+        print()
+        sys.exit(1)
+    with jobs_file:
+        runner = BatchRunner(parse, get_arg_value('-engine', 'default'), workers)
+        success = runner.run(jobs_file)
+    sys.exit(0 if success else 1)
+
+
+def try_serve():
+    if sys.argv[1:2] != ['-serve']:
+        return
+    check_args(sys.argv[1:], ['-O', '-nocache'], {'-serve': None, '-workers': None, '-timeout': None, '-engine': list(ENGINES), '-cachedir': None})
+    workers = get_workers()
+    timeout = get_arg_value('-timeout', str(DEFAULT_TIMEOUT))
+    try:
+        if float(timeout) <= 0:
+            raise ValueError
+    except ValueError:
+        print_usage()
+        print(f"ERROR: value of argument '-timeout' must be a positive number of seconds, not '{timeout}'")
+        print()
+        sys.exit(1)
+    server = ProgramServer(parse, get_arg_value('-engine', 'default'), workers, float(timeout))
+    try:
+        asyncio.run(server.serve(sys.argv[2]))
+    except KeyboardInterrupt:
+        pass
+    except OSError as Error:
+        print(f"ERROR: cannot serve on '{sys.argv[2]}': {Error.strerror}")
+        sys.exit(1)
+    sys.exit(0)
+
+
 def try_show_stack(parser: Parser):
     if '-showstack' not in sys.argv and '-ss' not in sys.argv:
         return
-    main = parser.parse()
+    main = parse(parser)
     for instruction in main.instruction_stack:
         if isinstance(instruction, DefineProcedure):
             print(f"DefineProcedure(namespace={instruction.namespace}, traceback={instruction.traceback}, name_parameter='{instruction.name_parameter}')")
@@ -65,100 +222,198 @@ def try_show_stack(parser: Parser):
     sys.exit(0)
 
 
+def try_transpile(parser: Parser):
+    filepath = get_arg_value('-transpile')
+    if filepath is None:
+        return
+    try:
+        main = parse(parser)
+    except CCLParseError as Error:
+        print_error(Error)
+        sys.exit(1)
+    with open(filepath, 'w', encoding='utf-8') as script:
+        script.write(Transpiler(main, sys.argv[1]).transpile_script(filepath))
+    print(f"Program was translated into '{filepath}'")
+    sys.exit(0)
+
+
 def try_debug(parser: Parser):
     if '-debug' not in sys.argv and '-d' not in sys.argv:
         return
+    main = None
     try:
-        main = parser.parse()
-        main.debug_mode = True
-        while True:
-            os.system('cls')
-            if not (isinstance(main.instruction_stack[main.instruction_pointer], EndProcedure)
-                    and main.instruction_stack[main.instruction_pointer].traceback is None
-                    and len(main.call_stack) == 0):
-                if main.call_stack:
-                    instruction = main.call_stack[-1].instruction_stack[main.call_stack[-1].instruction_pointer]
-                    traceback = instruction.traceback
-                    index = traceback.position[1]
-                else:
-                    instruction = main.instruction_stack[main.instruction_pointer]
-                    traceback = instruction.traceback
-                    index = traceback.position[1]
-                print(f'[DEBUG]: at line {traceback.position[0]}, at symbol {traceback.position[1]}')
-                print(f'[DEBUG]: in namespace {instruction.namespace}')
-                formatted_line = (
-                    traceback.line[:index]
-                    + Back.LIGHTGREEN_EX + Fore.BLACK + traceback.line[index] + Back.RESET + Fore.RESET
-                    + traceback.line[index + 1:]
-                )
-                if traceback.position[0] - 2 >= 0:
-                    print(f'ln [ {traceback.position[0] - 1} ]: ' + parser.code[traceback.position[0] - 2])
-                print(Fore.LIGHTGREEN_EX + f'ln [ {traceback.position[0]} ]:' + Fore.RESET + ' ' + formatted_line)
-                try:
-                    print(f'ln [ {traceback.position[0] + 1} ]: ' + parser.code[traceback.position[0]])
-                except IndexError:
-                    pass
-                print()
-                print(f"[DEBUG]: ID of instruction namespace: {id(instruction.namespace)}")
-                print(f"[DEBUG]: ID of current instruction: {id(instruction)}")
-                if isinstance(instruction, DefineProcedure):
-                    print(f"[DEBUG]: DefineProcedure(namespace={instruction.namespace}, traceback=<...>, name_parameter='{instruction.name_parameter}', instruction_stack=<...>)")
-                else:
-                    print(f'[DEBUG]: {instruction}')
-                print()
-            main.next_instruction()
-            main.debug()
-            print()
-            print('[DEBUG]: press any key to continue...')
-            getchar()
+        main = parse(parser)
+        debugger = Debugger(main, parser.code)
+        for argument in get_arg_values('-break'):
+            print(debugger.add_breakpoint(argument))
+        debugger.run()
+        print('[DEBUG]: debugging stopped')
+        sys.exit(0)
     except CCLExit:
+        print()
         main.debug()
         print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
         sys.exit(0)
     except (CCLParseError, CCLRuntimeError) as Error:
-        main.debug()
-        print(f'Error occurred at line {Error.traceback.position[0]}:')
-        err_index = Error.traceback.position[1]
-        formatted_line = (
-            Error.traceback.line[:err_index]
-            + Back.LIGHTRED_EX + Fore.BLACK + Error.traceback.line[err_index] + Back.RESET + Fore.RESET
-            + Error.traceback.line[err_index + 1:]
-        )
-        print(formatted_line)
-        print(f'{Error.__class__.__name__}: {Error}\n')
-        print(Fore.LIGHTRED_EX + 'Process finished with exit code 1\n' + Fore.RESET)
+        if main is not None:
+            main.debug()
+        print_error(Error)
+        sys.exit(1)
+
+
+def try_profile(parser: Parser):
+    if '-profile' not in sys.argv:
+        return
+    main = None
+    profiler = None
+    try:
+        main = parse(parser)
+        open_streams(main)
+        profiler = Profiler(main, parser.code)
+        profiler.run()
+    except CCLExit:
+        with report_stream(main):
+            print()
+            main.debug()
+            profiler.report()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+        sys.exit(0)
+    except (CCLParseError, CCLRuntimeError) as Error:
+        with report_stream(main):
+            if profiler is not None:
+                profiler.report()
+            print_error(Error)
         sys.exit(1)
 
 
 def run_normally(parser: Parser):
+    main = None
     try:
-        main = parser.parse()
-        while True:
-            main.next_instruction()
-            main.print_stdout()
+        main = parse(parser)
+        open_streams(main)
+        if get_arg_value('-checkpoint') is None and get_arg_value('-resume') is None:
+            main.run()
+        else:
+            run_checkpointed(parser, main)
     except CCLExit:
+        with report_stream(main):
+            print()
+            main.debug()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+    except (CCLParseError, CCLRuntimeError) as Error:
+        with report_stream(main):
+            print_error(Error)
+    except CheckpointStop:
+        with report_stream(main):
+            print()
+            print(f"[CHECKPOINT]: program stopped, resume it with `-resume {get_arg_value('-checkpoint')}`")
+        sys.exit(1)
+
+
+def run_checkpointed(parser: Parser, main: MainProcedure):
+    """Restores the snapshot of '-resume', if it was provided, and runs the program with checkpoints, if '-checkpoint' was provided"""
+    fingerprint = program_fingerprint(parser.code.data, '-O' in sys.argv)
+    instructions = 0
+    resume_path = get_arg_value('-resume')
+    if resume_path is not None:
+        try:
+            snapshot = Snapshot.load(resume_path)
+            snapshot.restore(main, fingerprint)
+        except OSError as Error:
+            print(f"ERROR: cannot read snapshot '{resume_path}': {Error.strerror}")
+            sys.exit(1)
+        except SnapshotError as Error:
+            print(f"ERROR: cannot resume from '{resume_path}': {Error}")
+            sys.exit(1)
+        instructions = snapshot.instructions
+
+    checkpoint_path = get_arg_value('-checkpoint')
+    if checkpoint_path is None:
+        main.run()
+        return
+    every = get_arg_value('-every')
+    if every is not None and (not every.isdigit() or int(every) == 0):
+        print_usage()
+        print(f"ERROR: value of argument '-every' must be a positive integer, not '{every}'")
         print()
-        main.debug()
-        print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+        sys.exit(1)
+    Checkpointer(main, checkpoint_path, fingerprint, every and int(every), instructions).run()
+
+
+def run_closures(parser: Parser):
+    main = None
+    try:
+        main = parse(parser)
+        open_streams(main)
+        engine = ClosureEngine(main)
+        engine.run()
+        engine.export_state()
+        with report_stream(main):
+            print()
+            main.debug()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
     except (CCLParseError, CCLRuntimeError) as Error:
-        print(f'Error occurred at line {Error.traceback.position[0]}:')
-        err_index = Error.traceback.position[1]
-        formatted_line = (
-            Error.traceback.line[:err_index]
-            + Back.LIGHTRED_EX + Fore.BLACK + Error.traceback.line[err_index] + Back.RESET + Fore.RESET
-            + Error.traceback.line[err_index + 1:]
-        )
-        print(formatted_line)
-        print(f'{Error.__class__.__name__}: {Error}\n')
-        print(Fore.LIGHTRED_EX + 'Process finished with exit code 1\n' + Fore.RESET)
+        with report_stream(main):
+            print_error(Error)
+
+
+def run_python(parser: Parser):
+    main = None
+    try:
+        main = parse(parser)
+        open_streams(main)
+        program = PythonProgram.from_source(main, Transpiler(main, sys.argv[1]).transpile(), sys.argv[1])
+        program.run()
+        program.export_state()
+        with report_stream(main):
+            print()
+            main.debug()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+    except (CCLParseError, CCLRuntimeError) as Error:
+        with report_stream(main):
+            print_error(Error)
+
+
+def run_bytecode(parser: Parser):
+    main = None
+    try:
+        main = parse(parser)
+        open_streams(main)
+        program = Lowering(main).lower()
+        # Instruction objects are not needed anymore, only EndProcedure is kept for MainProcedure.debug()
+        del main.instruction_stack[:-1]
+        vm = VirtualMachine(program, main)
+        vm.run()
+        vm.export_state()
+        with report_stream(main):
+            print()
+            main.debug()
+            print(Fore.LIGHTGREEN_EX + 'Process finished with exit code 0\n' + Fore.RESET)
+    except (CCLParseError, CCLRuntimeError) as Error:
+        with report_stream(main):
+            print_error(Error)
+
+
+ENGINES = {
+    'default': run_normally,
+    'closures': run_closures,
+    'python': run_python,
+    'bytecode': run_bytecode,
+}
 
 
 def interpreter():
-    arglist = ['-showstack', '-ss', '-debug', '-d']
-    parser = check_argv(arglist)
+    arglist = ['-showstack', '-ss', '-debug', '-d', '-profile', '-O', '-nocache', '-stream', '-console']
+    valued_arglist = {'-engine': list(ENGINES), '-transpile': None, '-cachedir': None, '-input': None, '-break': None,
+                      '-checkpoint': None, '-every': None, '-resume': None}
+    try_batch()
+    try_serve()
+    parser = check_argv(arglist, valued_arglist)
     try_show_stack(parser)
+    try_transpile(parser)
     try_debug(parser)
-    run_normally(parser)
+    try_profile(parser)
+    ENGINES[get_arg_value('-engine', 'default')](parser)
 
 
 if __name__ == '__main__':